@@ -14,26 +14,43 @@
 # under the License.
 
 from pecan import make_app
+from pecan.configuration import conf_from_file
 from pecan.deploy import deploy
-from wsgiref import simple_server
 from managesf import model
+from managesf import server
+from managesf.controllers import tasks
+
+
+CONFIG_FILE = "/etc/managesf/config.py"
 
 
 def setup_app(config):
 
     model.init_model()
     app_conf = dict(config.app)
+    hooks = list(app_conf.pop('hooks', [])) + [model.SessionHook()]
 
-    return make_app(
+    app = make_app(
         app_conf.pop('root'),
         logging=getattr(config, 'logging', {}),
+        hooks=hooks,
         **app_conf
     )
+    # the tasks left by a previous process are resumed or interrupted now
+    # rather than on the first submission
+    tasks.start_queues()
+    return app
 
 
 def main():
-    app = deploy("/etc/managesf/config.py")
-    host = app.config['server']['host']
-    port = app.config['server']['port']
-    srv = simple_server.make_server(host, port, app)
-    srv.serve_forever()
+    # the workers load the application, the supervisor only needs to listen
+    config = conf_from_file(CONFIG_FILE).server
+    sock = server.listen(config['host'], config['port'])
+    server.Supervisor(
+        sock,
+        lambda: deploy(CONFIG_FILE),
+        workers=int(config.get('workers', server.WORKERS)),
+        threads=int(config.get('threads', server.THREADS)),
+        timeout=int(config.get('timeout', server.TIMEOUT)),
+        graceful_timeout=int(config.get('graceful_timeout',
+                                        server.GRACEFUL_TIMEOUT))).run()
@@ -28,6 +28,10 @@ class SFUserMapper:
     def set(self, sf_user_id, service, service_user_id):
         crud.set_service_mapping(sf_user_id, service, service_user_id)
 
+    def set_many(self, sf_user_id, mappings):
+        """Sets (service, service_user_id) mappings in one write."""
+        crud.set_service_mappings(sf_user_id, mappings)
+
     def get_service_mapping(self, service, sf_user_id):
         """Returns the service uid of user sf_user_id in service."""
         return crud.get_service_mapping(service, sf_user_id)
@@ -44,6 +48,7 @@ class SFUserMapper:
 
 class SFUserManager:
     mapping = SFUserMapper()
+    fields = [c.name for c in model.SFUser.__table__.columns]
 
     def get(self, id=None, username=None, email=None,
             fullname=None, cauth_id=None):
@@ -53,8 +58,33 @@ class SFUserManager:
     def all(self):
         return self.get()
 
+    def iterate(self, fields=None, limit=None, offset=None, after=None):
+        return crud.iterate(fields=fields, limit=limit, offset=offset,
+                            after=after)
+
+    def transaction(self):
+        """Context manager running the user and mapping operations done
+        within it in a single transaction, with a single session"""
+        return model.session_scope()
+
+    def provision(self, username, email, fullname, cauth_id=None):
+        """Finds the user by cauth_id or creates it, in one transaction.
+        Returns the user row and whether it was found by cauth_id."""
+        with self.transaction():
+            if cauth_id and cauth_id != -1:
+                user = crud.get(cauth_id=cauth_id)
+                if user:
+                    return user, True
+            return self._create(username, email, fullname, cauth_id), False
+
     def create(self, username, email,
                fullname, cauth_id=None):
+        with self.transaction():
+            return int(self._create(username, email, fullname,
+                                    cauth_id)['id'])
+
+    def _create(self, username, email,
+                fullname, cauth_id=None):
         msg = u'Creating user: username=%s, email=%s, full name=%s'
         if cauth_id:
             msg += ', cauth_id=%s' % cauth_id
@@ -67,7 +97,11 @@ class SFUserManager:
                 logger.info(msg % (repr(user), cauth_id))
                 crud.update(user['id'], username=username,
                             email=email, fullname=fullname)
-                return user['id']
+                for k, v in (('username', username), ('email', email),
+                             ('fullname', fullname)):
+                    if v:
+                        user[k] = v
+                return user
         # if not, check if we have a user with the same characteristics:
         user = crud.get(username=username, email=email, fullname=fullname)
         if user:
@@ -77,11 +111,12 @@ class SFUserManager:
                         ' user has been recreated in the Identity Provider)')
                 logger.info(msg % repr(user))
                 self.reset_cauth_id(user['id'], cauth_id)
+                user['cauth_id'] = str(cauth_id)
             else:
                 msg = u'User %s already exists, doing nothing'
                 logger.info(msg % repr(user))
-            return user['id']
-        return crud.create(username, email, fullname, cauth_id)
+            return user
+        return crud.create(username, email, fullname, cauth_id, as_dict=True)
 
     def update(self, id, username=None, email=None, fullname=None,
                idp_sync=None):
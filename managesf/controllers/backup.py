@@ -14,22 +14,94 @@
 # under the License.
 
 from pecan import conf
+import hashlib
 import logging
-from utils import RemoteUser
+import os
+import tempfile
+from utils import RemoteUser, file_lock
+from managesf.controllers import tasks
 
 logger = logging.getLogger(__name__)
 
+BACKUP_DIR = '/var/www/managesf/'
+BACKUP_FILE = 'sf_backup.tar.gz'
+# bytes read at once when hashing or sending the archive
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_backup_path():
+    return os.path.join(conf.managesf.get('backup_dir', BACKUP_DIR),
+                        BACKUP_FILE)
+
+
+def get_checksum(filepath):
+    """returns the SHA-256 of filepath. It is read from the filepath.sha256
+    sidecar file when that one is up to date, otherwise it is computed and
+    stored there, in the sha256sum format"""
+    sidecar = filepath + '.sha256'
+    try:
+        if os.stat(sidecar).st_mtime >= os.stat(filepath).st_mtime:
+            with open(sidecar) as f:
+                return f.read().split()[0]
+    except (IOError, OSError, IndexError):
+        pass
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    checksum = sha.hexdigest()
+    directory = os.path.dirname(os.path.abspath(filepath))
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.sha256')
+        with os.fdopen(fd, 'w') as f:
+            f.write('%s  %s\n' % (checksum, os.path.basename(filepath)))
+        os.rename(tmp, sidecar)
+    except (IOError, OSError) as e:
+        logger.warning("Could not store the checksum of %s: %s" % (filepath,
+                                                                   e))
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+    return checksum
+
 
 class Backup(object):
     def __init__(self):
         c = conf.managesf
         self.client = RemoteUser('root', c['host'], c['sshkey_update_path'])
 
-    def start(self):
+    def start(self, output):
+        """runs sf_backup, its output is appended to output. Returns the
+        exit code"""
         logger.debug("start backup")
-        self.client._ssh('sf_backup')
+        code = self.client._ssh_stream('sf_backup', output)
+        filepath = get_backup_path()
+        if not code and os.path.isfile(filepath):
+            # computed now rather than by the first download
+            get_checksum(filepath)
+        return code
 
 
-def backup_start():
+def run_backup(params, logs, worker):
     bkp = Backup()
-    bkp.start()
+    code = bkp.start(logs)
+    logs.result = {'exit_code': code}
+    if code:
+        logs.append(u'sf_backup exited with code %s' % code)
+    return not code
+
+
+backup_queue = tasks.TaskQueue('backup', run_backup)
+
+
+def backup_start():
+    """starts a backup job, unless one is in progress already. Returns the
+    job and whether it was started"""
+    # checked and started at once in every process
+    lockfile = os.path.join(os.path.dirname(get_backup_path()),
+                            '.sf_backup.lock')
+    with file_lock(lockfile):
+        active = backup_queue.get_active()
+        if active:
+            return active[0], False
+        return backup_queue.get(backup_queue.submit({})), True
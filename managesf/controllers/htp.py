@@ -13,8 +13,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import fcntl
+import os
 import random
 import string
+import tempfile
+import threading
 import htpasswd
 import logging
 
@@ -23,45 +28,100 @@ logger = logging.getLogger(__name__)
 
 
 class Htpasswd(object):
+    """The htpasswd file, parsed in memory and parsed again only when the
+    file changes on disk. Writes take an exclusive lock on a companion
+    .lock file, apply the change to the latest content and replace the file
+    with a rename, so concurrent workers neither lose updates nor leave a
+    partially written file behind."""
     def __init__(self, configuration):
         self.filename = None
+        self._users = collections.OrderedDict()
+        self._stat = None
+        self._lock = threading.Lock()
         if getattr(configuration, "htpasswd", None):
             self.filename = configuration.htpasswd.get('filename')
             # Ensure file exists
             open(self.filename, "a").close()
 
+    def _signature(self):
+        st = os.stat(self.filename)
+        # the inode changes on each rename
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _load(self):
+        """returns the users, reading the file again if it changed"""
+        with self._lock:
+            stat = self._signature()
+            if stat != self._stat:
+                users = collections.OrderedDict()
+                with open(self.filename) as userdb:
+                    for line in userdb:
+                        if ':' in line:
+                            user, password = line.split(':', 1)
+                            users[user] = password
+                self._users = users
+                self._stat = stat
+            return self._users
+
+    def _update(self, change):
+        """calls change() on a copy of the latest users, and writes them if
+        it returns True"""
+        lockfile = open(self.filename + '.lock', 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            users = self._load().copy()
+            if not change(users):
+                return
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.htpasswd')
+            try:
+                with os.fdopen(fd, 'w') as userdb:
+                    for user, password in users.items():
+                        userdb.write('%s:%s' % (user, password))
+                    userdb.flush()
+                    os.fsync(userdb.fileno())
+                os.chmod(tmp, os.stat(self.filename).st_mode & 0o777)
+                os.rename(tmp, self.filename)
+            except (IOError, OSError) as e:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise IOError(unicode(e))
+            with self._lock:
+                self._users = users
+                self._stat = self._signature()
+        finally:
+            lockfile.close()
+
     def user_has_api_password(self, user):
         try:
-            with htpasswd.Basic(self.filename) as userdb:
-                return user in userdb.users
-        except IOError as e:
+            return user in self._load()
+        except (IOError, OSError) as e:
             logger.debug('Could not check htpasswd: %s' % unicode(e))
-            raise e
+            raise IOError(unicode(e))
 
     def delete(self, user):
+        def pop(users):
+            # we don't care if the user has no password
+            return users.pop(user, None) is not None
         try:
-            with htpasswd.Basic(self.filename) as userdb:
-                userdb.pop(user)
-        except htpasswd.basic.UserNotExists:
-            # we don't care
-            pass
-        except IOError as e:
+            self._update(pop)
+        except (IOError, OSError) as e:
             logger.debug('Could not update htpasswd: %s' % unicode(e))
-            raise e
+            raise IOError(unicode(e))
 
     def set_api_password(self, user):
         password = ''.join(
             random.SystemRandom().choice(string.letters + string.digits)
             for _ in range(12))
+        hashed = htpasswd.Basic(self.filename)._encrypt_password(password)
+
+        def change_password(users):
+            users[user] = hashed + '\n'
+            return True
         try:
-            with htpasswd.Basic(self.filename) as userdb:
-                try:
-                    userdb.add(user, password)
-                except htpasswd.basic.UserExists:
-                    pass
-                userdb.change_password(user, password)
-                logger.debug('Updated htpasswd entry for user %s' % user)
-        except IOError as e:
+            self._update(change_password)
+            logger.debug('Updated htpasswd entry for user %s' % user)
+        except (IOError, OSError) as e:
             logger.debug('Could not update htpasswd: %s' % unicode(e))
-            raise e
+            raise IOError(unicode(e))
         return password
@@ -13,8 +13,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import hashlib
+import hmac
 import logging
+import os
+import threading
+import time
 
+from pecan import conf
 from managesf import model
 from basicauth import decode, DecodeError
 from passlib.hash import pbkdf2_sha256
@@ -23,6 +30,12 @@ from passlib.hash import pbkdf2_sha256
 logger = logging.getLogger(__name__)
 
 
+# defaults, overridable in conf.localuser
+HASH_ROUNDS = 200
+BIND_CACHE_SIZE = 1024
+BIND_CACHE_TTL = 60
+
+
 class UserNotFound(Exception):
     pass
 
@@ -46,6 +59,92 @@ AUTHORIZED_KEYS = ('username',
                    'fullname')
 
 
+class BindCache(object):
+    """Successful binds, remembered for ttl seconds by this process.
+
+    An entry holds an HMAC of the username and password and an HMAC of the
+    password hash the bind was verified against, under a key drawn at
+    startup and never stored, so the cache keeps neither the password nor
+    a digest that could be brute-forced offline. An entry is only used
+    while the user's stored hash is the same, so a password change or a
+    deletion made by any API process is seen by the next bind."""
+
+    def __init__(self, size=BIND_CACHE_SIZE, ttl=BIND_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._key = os.urandom(32)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, *values):
+        msg = b'\0'.join(v.encode('utf8') if isinstance(v, unicode) else v
+                          for v in values)
+        return hmac.new(self._key, msg, hashlib.sha256).digest()
+
+    def get(self, username, password, hashed_password):
+        """tells if password was verified against hashed_password"""
+        digest = self._digest(username, password, hashed_password)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return False
+            e_digest, timestamp = entry
+            if time.time() - timestamp > self.ttl:
+                del self._entries[username]
+                return False
+            return hmac.compare_digest(e_digest, digest)
+
+    def set(self, username, password, hashed_password):
+        if self.ttl <= 0 or self.size <= 0:
+            return
+        digest = self._digest(username, password, hashed_password)
+        with self._lock:
+            self._entries.pop(username, None)
+            self._entries[username] = (digest, time.time())
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+
+_bind_cache = None
+_bind_cache_lock = threading.Lock()
+
+
+def _get_conf(key, default):
+    try:
+        return int(conf.localuser.get(key, default))
+    except AttributeError:
+        return default
+
+
+def get_bind_cache():
+    global _bind_cache
+    with _bind_cache_lock:
+        if _bind_cache is None:
+            _bind_cache = BindCache(
+                size=_get_conf('bind_cache_size', BIND_CACHE_SIZE),
+                ttl=_get_conf('bind_cache_ttl', BIND_CACHE_TTL))
+        return _bind_cache
+
+
+def encrypt_password(password):
+    return pbkdf2_sha256.encrypt(password,
+                                 rounds=_get_conf('hash_rounds', HASH_ROUNDS),
+                                 salt_size=16)
+
+
+def needs_rehash(hashed_password):
+    """tells if the hash was computed with other rounds than configured"""
+    try:
+        rounds = pbkdf2_sha256.from_string(hashed_password).rounds
+    except ValueError:
+        return False
+    return rounds != _get_conf('hash_rounds', HASH_ROUNDS)
+
+
 def verify_input(infos):
     for key in infos.keys():
         if key not in AUTHORIZED_KEYS:
@@ -57,10 +156,7 @@ def hash_password(infos):
     if password is None:
         return
     del infos['password']
-    hash = pbkdf2_sha256.encrypt(password,
-                                 rounds=200,
-                                 salt_size=16)
-    infos['hashed_password'] = hash
+    infos['hashed_password'] = encrypt_password(password)
 
 
 def update_user(username, infos):
@@ -77,6 +173,7 @@ def update_user(username, infos):
         verify_input(infos)
         hash_password(infos)
         ret = model.update_user(username, infos)
+    get_bind_cache().invalidate(username)
     if not ret:
         raise BadUserInfos(
             'Bad infos input%s.' % (': %s' % reason))
@@ -86,6 +183,7 @@ def update_user(username, infos):
 
 def delete_user(username):
     ret = model.delete_user(username)
+    get_bind_cache().invalidate(username)
     if not ret:
         raise UserNotFound("%s not found" % username)
     return ret
@@ -108,8 +206,17 @@ def bind_user(authorization):
     ret = model.get_user(username)
     if not ret:
         raise UserNotFound("%s not found" % username)
-    if pbkdf2_sha256.verify(password, ret['hashed_password']):
-        del ret['hashed_password']
+    hashed_password = ret.pop('hashed_password')
+    cache = get_bind_cache()
+    if cache.get(username, password, hashed_password):
+        return ret
+    if pbkdf2_sha256.verify(password, hashed_password):
+        if needs_rehash(hashed_password):
+            logger.info(u'Rehashing the password of %s' % username)
+            hashed_password = encrypt_password(password)
+            model.update_user(username,
+                              {'hashed_password': hashed_password})
+        cache.set(username, password, hashed_password)
         return ret
     else:
         raise BindForbidden("Authentication failed")
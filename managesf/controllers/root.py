@@ -13,8 +13,12 @@
 # under the License.
 
 import base64
+import binascii
+import hashlib
+import json
 import logging
 import os.path
+from multiprocessing.pool import ThreadPool
 
 from pecan import conf
 from pecan import expose
@@ -22,11 +26,15 @@ from pecan import abort
 from pecan.rest import RestController
 from pecan import request, response
 from stevedore import driver
+from webob.static import FileIter
 
 from managesf.controllers import backup, localuser, introspection, htp
 from managesf.controllers import SFuser
+from managesf.controllers import tasks
+from managesf.controllers import utils
 from managesf.services import base
 from managesf.services import exceptions
+from managesf import model
 from managesf import policy
 from managesf.model.yamlbkd.engine import SFResourceBackendEngine
 
@@ -46,6 +54,13 @@ SF_SERVICES = []
 DEFAULT_SERVICES = ['SFGerrit', 'SFStoryboard', 'SFJenkins',
                     'SFNodepool']
 SERVICES = {}
+# users provisioned concurrently by a bulk import, and users written to the
+# database in one transaction
+BULK_WORKERS = 4
+BULK_BATCH = 100
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/jsonl')
+# threads running the resources apply jobs
+APPLY_WORKERS = 1
 
 
 def load_services():
@@ -74,6 +89,111 @@ def load_services():
             logger.error('Could not load service %s: %s' % (service, e))
 
 
+def load_services_fanout():
+    try:
+        c = conf.services_fanout
+    except AttributeError:
+        c = {}
+    timeouts = c.get('timeouts') or {}
+    return utils.ServicesFanout(
+        workers=int(c.get('workers', utils.FANOUT_WORKERS)),
+        timeout=int(c.get('timeout', utils.FANOUT_TIMEOUT)),
+        timeouts=dict((name, int(timeouts[name])) for name in timeouts))
+
+
+def get_bulk_setting(key, default):
+    try:
+        c = conf.services_fanout
+    except AttributeError:
+        c = {}
+    return int(c.get(key, default))
+
+
+def run_bulk(params, logs, worker):
+    return RootController.services_users.bulk.run(params['users'], logs)
+
+
+def _find_commit(commits, ref):
+    """returns the SHA of commits matching ref (master, or a SHA that may
+    be abbreviated), None if there is none"""
+    if ref == 'master':
+        return commits[0] if commits else None
+    for sha in commits:
+        if sha.startswith(ref):
+            return sha
+    return None
+
+
+def _apply_commits(eng, repo, ref, logs):
+    """applies ref along with the newer commits waiting in the queue: the
+    diff from the last applied commit to the newest one is applied once,
+    and the queued applies it covers have nothing left to do. Commits
+    queued after a direct apply are left to run after it"""
+    last = applied_commits.get(repo)
+    new = eng.get_new_commits(repo, since=last)
+    if new is None:
+        logs.append(u'Last applied commit %s is unknown to the repository, '
+                    u'applying the commit alone' % last)
+        last = None
+        new = eng.get_new_commits(repo)
+    commit = _find_commit(new, ref)
+    if commit is None:
+        if last and _find_commit(eng.get_new_commits(repo), ref):
+            logs.append(u'Commit %s is already applied (last applied '
+                        u'commit: %s)' % (ref, last))
+            return True
+        # let the engine report the unknown ref
+        status, _ = eng.apply(repo, '%s^1' % ref, repo, ref, logs=logs)
+        return status
+    if last is None:
+        prev, target = '%s^1' % commit, commit
+    else:
+        prev, target = last, commit
+        for task in tasks.crud.get_by_status(apply_queue.kind,
+                                             [tasks.QUEUED]):
+            params = json.loads(task['params'])
+            if 'COMMIT' not in params:
+                # a direct apply keeps its place, the commits queued
+                # after it are not applied before it
+                break
+            queued = _find_commit(new, params['COMMIT'])
+            if queued and new.index(queued) < new.index(target):
+                target = queued
+        if target != commit:
+            logs.append(u'Applying the commits from %s to %s at once' % (
+                        last, target))
+    status, _ = eng.apply(repo, prev, repo, target, logs=logs)
+    if status:
+        applied_commits.set(repo, target)
+    return status
+
+
+def run_apply(params, logs, worker):
+    # each worker has its own clone of the config repository
+    workdir = 'apply' if not worker else 'apply-%s' % worker
+    eng = SFResourceBackendEngine(
+        os.path.join(conf.resources['workdir'], workdir),
+        conf.resources['subdir'])
+    repo = conf.resources['master_repo']
+    # the applies of a repository run one at a time, in every process
+    lockfile = os.path.join(conf.resources['workdir'], 'apply-%s.lock' %
+                            hashlib.sha1(repo).hexdigest()[:12])
+    with utils.file_lock(lockfile):
+        if 'COMMIT' in params:
+            return _apply_commits(eng, repo, params['COMMIT'], logs)
+        status, _ = eng.direct_apply(params['prev'], params['new'],
+                                     logs=logs)
+        return status
+
+
+def load_apply_queue():
+    try:
+        workers = int(conf.resources.get('apply_workers', APPLY_WORKERS))
+    except AttributeError:
+        workers = APPLY_WORKERS
+    return tasks.TaskQueue('resources-apply', run_apply, workers=workers)
+
+
 def _decode_project_name(name):
     if name.startswith('==='):
         try:
@@ -114,7 +234,37 @@ def authorize(rule_name, target):
     return policy.authorize(rule_name, target, credentials)
 
 
+def set_snapshot_age(manager):
+    """Tells how old the listing served from memory is"""
+    snapshot = getattr(manager, 'snapshot', None)
+    if snapshot is not None and snapshot.age is not None:
+        response.headers['Age'] = str(int(snapshot.age))
+
+
 class BackupController(RestController):
+    class BackupJobController(RestController):
+        @expose('json')
+        def get(self, id, **kwargs):
+            _policy = 'managesf.backup:status'
+            if not authorize(_policy,
+                             target={}):
+                return abort(401,
+                             detail='Failure to comply with policy %s' %
+                             _policy)
+            offset = kwargs.get('offset')
+            try:
+                offset = int(offset or 0)
+                if offset < 0:
+                    raise ValueError
+            except ValueError:
+                abort(400, detail=u'Invalid offset value: %s' % offset)
+            job = backup.backup_queue.get(id, offset)
+            if not job:
+                abort(404, detail=u'No backup job %s' % id)
+            return job
+
+    jobs = BackupJobController()
+
     @expose('json')
     def get(self):
         _policy = 'managesf.backup:get'
@@ -122,12 +272,32 @@ class BackupController(RestController):
                          target={}):
             return abort(401,
                          detail='Failure to comply with policy %s' % _policy)
-        filepath = os.path.join(conf.managesf.get('backup_dir',
-                                                  '/var/www/managesf/'),
-                                'sf_backup.tar.gz')
+        filepath = backup.get_backup_path()
         if not os.path.isfile(filepath):
             abort(404)
-        response.body_file = open(filepath, 'rb')
+        checksum = backup.get_checksum(filepath)
+        f = open(filepath, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            response.content_type = 'application/x-gzip'
+            response.content_length = stat.st_size
+            response.last_modified = stat.st_mtime
+            response.etag = checksum
+            response.headers['Digest'] = 'SHA-256=%s' % base64.b64encode(
+                binascii.unhexlify(checksum))
+            response.accept_ranges = 'bytes'
+            file_wrapper = request.environ.get('wsgi.file_wrapper')
+            if request.range is None and file_wrapper is not None:
+                # lets the server use sendfile
+                response.app_iter = file_wrapper(f, backup.CHUNK_SIZE)
+            else:
+                response.app_iter = FileIter(f)
+        except Exception:
+            # the file is closed by the server once the response is sent
+            f.close()
+            raise
+        # webob answers the Range, If-Range and If-None-Match requests
+        response.conditional_response = True
         return response
 
     @expose('json')
@@ -138,10 +308,13 @@ class BackupController(RestController):
             return abort(401,
                          detail='Failure to comply with policy %s' % _policy)
         try:
-            backup.backup_start()
-            response.status = 204
+            job, started = backup.backup_start()
         except Exception as e:
             return report_unhandled_error(e)
+        # a backup in progress is returned instead of starting another
+        response.status = 202 if started else 200
+        response.headers['Location'] = '/backup/jobs/%s' % job['id']
+        return {'job_id': int(job['id']), 'status': job['status']}
 
 
 class LocalUserController(RestController):
@@ -225,8 +398,176 @@ class LocalUserBindController(RestController):
         return ret
 
 
+class ServicesUsersBulkController(RestController):
+    """Provisions a list of users, given as a JSON list or as NDJSON (one
+    JSON object per line), in a background job. The users are created in
+    the services concurrently and written to the database by batches. The
+    job result holds a result per user"""
+
+    class BulkJobController(RestController):
+        @expose('json')
+        def get(self, id, **kwargs):
+            _policy = 'managesf.user:bulk-status'
+            if not authorize(_policy,
+                             target={}):
+                return abort(401,
+                             detail='Failure to comply with policy %s' %
+                             _policy)
+            offset = kwargs.get('offset')
+            try:
+                offset = int(offset or 0)
+                if offset < 0:
+                    raise ValueError
+            except ValueError:
+                abort(400, detail=u'Invalid offset value: %s' % offset)
+            job = bulk_queue.get(id, offset)
+            if not job:
+                abort(404, detail=u'No bulk job %s' % id)
+            return job
+
+    jobs = BulkJobController()
+
+    def __init__(self, users):
+        self.users = users
+
+    def _parse(self):
+        content_type = request.content_type or ''
+        if content_type in NDJSON_CONTENT_TYPES:
+            lines = request.body.decode('utf-8').splitlines()
+            return [json.loads(line) for line in lines if line.strip()]
+        return request.json
+
+    def _check(self, users):
+        """returns the results of the invalid users, and the index and
+        infos of the others"""
+        results = [None] * len(users)
+        # the same user provisioned twice concurrently would be created twice
+        seen = set()
+        pending = []
+        for i, infos in enumerate(users):
+            username = infos.get('username') if isinstance(infos, dict) \
+                else None
+            if not isinstance(infos, dict) or \
+               not all(infos.get(k)
+                       for k in ('username', 'email', 'full_name')):
+                results[i] = {'username': username, 'status': 'error',
+                              'errors': u'Incomplete user information: %r' %
+                              infos}
+            elif username in seen:
+                results[i] = {'username': username, 'status': 'error',
+                              'errors': u'Duplicate user in the list'}
+            else:
+                seen.add(username)
+                pending.append((i, infos))
+        return results, pending
+
+    def _in_transaction(self, items, func):
+        """calls func on the (index, item) items in one transaction. If it
+        fails, each item is retried in a transaction of its own, so that a
+        bad user does not fail the others. Returns the results by index,
+        an exception for the items that failed"""
+        try:
+            with sfmanager.user.transaction():
+                return dict((i, func(item)) for i, item in items)
+        except Exception:
+            logger.exception('[bulk] batch failed, retrying user by user')
+        results = {}
+        for i, item in items:
+            try:
+                with sfmanager.user.transaction():
+                    results[i] = func(item)
+            except Exception as e:
+                logger.exception('[bulk] could not provision %r' % (item, ))
+                results[i] = e
+        return results
+
+    def _call_services(self, provisioned):
+        try:
+            return self.users._call_services(*provisioned)
+        except Exception as e:
+            logger.exception('[bulk] could not provision user #%s' %
+                             provisioned[0])
+            return e
+
+    def _run_batch(self, batch, results, pool):
+        provisioned = self._in_transaction(
+            batch, self.users._provision_local)
+        # the provisioned infos of a known user may lack the username,
+        # it is not updatable in every service
+        usernames = dict((i, infos['username']) for i, infos in batch)
+        ready = []
+        for i, infos in batch:
+            if isinstance(provisioned[i], Exception):
+                results[i] = {'username': usernames[i],
+                              'status': 'error',
+                              'errors': unicode(provisioned[i])}
+            else:
+                ready.append(i)
+        # the services are called outside of any transaction
+        called = pool.map(self._call_services,
+                          [provisioned[i] for i in ready])
+        to_map = []
+        for i, c in zip(ready, called):
+            if isinstance(c, Exception):
+                results[i] = {'username': usernames[i],
+                              'id': provisioned[i][0], 'status': 'error',
+                              'errors': unicode(c)}
+            else:
+                to_map.append((i, provisioned[i] + (c, )))
+        errors = self._in_transaction(
+            to_map, lambda args: self.users._map_services(*args))
+        for i, (user_id, status, infos, mapped, called) in to_map:
+            result = {'username': usernames[i], 'id': user_id,
+                      'status': status}
+            if isinstance(errors[i], Exception):
+                result.update(status='error', errors=unicode(errors[i]))
+            elif errors[i]:
+                result.update(status='error',
+                              errors=dict((n, unicode(e))
+                                          for n, e in errors[i].items()))
+            results[i] = result
+
+    def run(self, users, logs):
+        results, pending = self._check(users)
+        batch = get_bulk_setting('bulk_batch', BULK_BATCH)
+        pool = ThreadPool(get_bulk_setting('bulk_workers', BULK_WORKERS))
+        try:
+            for n in range(0, len(pending), batch):
+                self._run_batch(pending[n:n + batch], results, pool)
+                done = [results[i] for i, infos in pending[n:n + batch]]
+                logs.extend(u'%s: %s' % (r['username'], r['status'])
+                            for r in done)
+        finally:
+            pool.close()
+        logs.result = results
+        failed = len([r for r in results if r['status'] == 'error'])
+        logs.append(u'%s user(s) provisioned, %s error(s)' % (
+                    len(results) - failed, failed))
+        return not failed
+
+    @expose('json')
+    def post(self):
+        _policy = 'managesf.user:bulk'
+        if not authorize(_policy, target={}):
+            return abort(401,
+                         detail='Failure to comply with policy %s' % _policy)
+        try:
+            users = self._parse() if request.content_length else []
+        except ValueError as e:
+            abort(400, detail=u'Invalid user list: %s' % e)
+        if not isinstance(users, list):
+            abort(400, detail=u'A list of users is expected')
+        job_id = bulk_queue.submit({'users': users})
+        response.status = 202
+        response.headers['Location'] = '/services_users/bulk/jobs/%s' % job_id
+        return {'job_id': job_id, 'status': tasks.QUEUED}
+
+
 class ServicesUsersController(RestController):
 
+    def __init__(self):
+        self.bulk = ServicesUsersBulkController(self)
+
     def _remove_non_updatable_fields(self, infos):
         forbidden = sum([s.user.check_forbidden_fields(**infos)
                          for s in SF_SERVICES], [])
@@ -235,38 +576,28 @@ class ServicesUsersController(RestController):
         return dict((u, infos[u]) for u in infos.keys()
                     if u not in forbidden and infos[u] is not None)
 
-    def _update(self, user_id, infos):
+    def _update_local(self, user_id, infos):
+        """updates the user, returns its mappings by service name"""
         sfmanager.user.update(user_id,
                               username=infos.get('username'),
                               email=infos.get('email'),
                               fullname=infos.get('full_name'),
                               idp_sync=infos.get('idp_sync'))
-        for service in SF_SERVICES:
-            s_id = sfmanager.user.mapping.get_service_mapping(
-                service.service_name,
-                user_id)
-            if s_id:
-                try:
-                    service.user.update(uid=s_id, **infos)
-                except exceptions.UnavailableActionError:
-                    pass
-            else:
-                full_name = infos.get('full_name')
-                username = infos.get('username')
-                ssh_keys = infos.get('ssh_keys', [])
-                email = infos.get('email')
-                cauth_id = infos.get('external_id')
-                try:
-                    s_id = service.user.create(username=username,
-                                               email=email,
-                                               full_name=full_name,
-                                               ssh_keys=ssh_keys,
-                                               cauth_id=cauth_id)
-                    sfmanager.user.mapping.set(user_id,
-                                               service.service_name,
-                                               s_id)
-                except exceptions.UnavailableActionError:
-                    pass
+        return dict((s.service_name,
+                     sfmanager.user.mapping.get_service_mapping(
+                         s.service_name,
+                         user_id)) for s in SF_SERVICES)
+
+    def _update(self, user_id, infos):
+        """updates the user and creates it in the services where it is not
+        mapped yet. Returns the errors by service"""
+        # no transaction is kept open while the services are called
+        with sfmanager.user.transaction():
+            mapped = self._update_local(user_id, infos)
+        results = self._call_services(user_id, 'updated', infos, mapped)
+        with sfmanager.user.transaction():
+            return self._map_services(user_id, 'updated', infos, mapped,
+                                      results)
 
     @expose('json')
     def put(self, id=None, email=None, username=None):
@@ -301,7 +632,9 @@ class ServicesUsersController(RestController):
             abort(400,
                   detail=msg)
         try:
-            self._update(d_id, sanitized)
+            errors = self._update(d_id, sanitized)
+            if errors:
+                raise exceptions.ServicesError(errors)
             response.status = 200
             return {'updated_fields': sanitized}
         except Exception as e:
@@ -318,87 +651,147 @@ class ServicesUsersController(RestController):
             return abort(401,
                          detail='Failure to comply with policy %s' % _policy)
         try:
-            known_user = None
-            if infos.get('external_id', -1) != -1:
-                known_user = sfmanager.user.get(cauth_id=infos['external_id'])
-                if known_user:
-                    msg = (u'found user #%(id)s %(username)s (%(email)s) '
-                           u'by cauth ID #%(cauth_id)s, user needs update')
-                    logger.debug(msg % known_user)
-                    u = known_user['id']
-                    clean_infos = self._remove_non_updatable_fields(infos)
-                    if known_user.get('idp_sync'):
-                        self._update(u, clean_infos)
-                    else:
-                        logger.info("Skipping user information update because"
-                                    "idp_sync is disabled")
-            # if we still cannot find it, let's create it
-            if not known_user:
-                u = sfmanager.user.create(username=infos['username'],
-                                          email=infos['email'],
-                                          fullname=infos['full_name'],
-                                          cauth_id=infos.get('external_id'))
-                self._create_user_in_services(u, infos)
+            user_id, status, errors = self._provision(infos)
+            # the mappings of the services that succeeded are kept
+            if errors:
+                raise exceptions.ServicesError(errors)
         except Exception as e:
             return report_unhandled_error(e)
         # TODO(mhu) later, this should return the local id and the user data
         response.status = 201
 
-    def _create_user_in_services(self, user_id, infos):
-        for service in SF_SERVICES:
-            try:
-                s_id = (service.user.get(username=infos.get('username')) or
-                        service.user.get(username=infos.get('email')))
-                if s_id:
-                    msg = u'[%s] user %s exists, skipping creation'
-                    logger.debug(msg % (service.service_name,
-                                        infos.get('username')))
-                    mapped = sfmanager.user.mapping.get_user_mapping(
-                        service.service_name,
-                        s_id)
-                    if not mapped:
-                        sfmanager.user.mapping.set(user_id,
-                                                   service.service_name,
-                                                   s_id)
-                        msg = u'[%s] user %s mapped to id %s'
-                        logger.debug(msg % (service.service_name,
-                                            infos.get('username'),
-                                            s_id))
-                else:
-                    full_name = infos.get('full_name')
-                    username = infos.get('username')
-                    ssh_keys = infos.get('ssh_keys', [])
-                    email = infos.get('email')
-                    cauth_id = infos.get('external_id')
-                    s_id = service.user.create(username=username,
-                                               email=email,
-                                               full_name=full_name,
-                                               ssh_keys=ssh_keys,
-                                               cauth_id=cauth_id)
-                    # we might have a mapping, but to a wrong user id in the
-                    # service (because the user existed before but was removed
-                    # directly from the service, for example)
-                    mapped = sfmanager.user.mapping.get_service_mapping(
-                        service.service_name,
-                        user_id)
-                    if mapped and mapped != s_id:
-                        msg = u'[%s] user %s wrongly mapped to id %s, removing'
-                        logger.debug(msg % (service.service_name,
-                                            infos.get('username'),
-                                            mapped))
-                        sfmanager.user.mapping.delete(user_id,
-                                                      service.service_name,
-                                                      mapped)
-                    sfmanager.user.mapping.set(user_id,
-                                               service.service_name,
-                                               s_id)
-                    msg = u'[%s] user %s mapped to %s id %s'
+    def _provision(self, infos):
+        """looks up or creates the user, then creates or updates it in the
+        services. Returns the user id, what was done ('created', 'updated'
+        or 'skipped') and the errors by service"""
+        # the lookup or creation is a transaction of its own, the services
+        # are called outside of it and the mappings written afterwards
+        with sfmanager.user.transaction():
+            provisioned = self._provision_local(infos)
+        results = self._call_services(*provisioned)
+        with sfmanager.user.transaction():
+            errors = self._map_services(*(provisioned + (results, )))
+        return provisioned[0], provisioned[1], errors
+
+    def _provision_local(self, infos):
+        """looks up or creates the user, and updates it if needed. Returns
+        the user id, what is done ('created', 'updated' or 'skipped'), the
+        infos for the services and, for an update, the user mappings"""
+        user, known = sfmanager.user.provision(
+            username=infos['username'],
+            email=infos['email'],
+            fullname=infos['full_name'],
+            cauth_id=infos.get('external_id'))
+        u = int(user['id'])
+        if known:
+            msg = (u'found user #%(id)s %(username)s (%(email)s) '
+                   u'by cauth ID #%(cauth_id)s, user needs update')
+            logger.debug(msg % user)
+            clean_infos = self._remove_non_updatable_fields(infos)
+            if user.get('idp_sync'):
+                return (u, 'updated', clean_infos,
+                        self._update_local(u, clean_infos))
+            logger.info("Skipping user information update because"
+                        "idp_sync is disabled")
+            return u, 'skipped', clean_infos, None
+        # if we still cannot find it, let's create it
+        return u, 'created', infos, None
+
+    def _call_services(self, user_id, status, infos, mapped):
+        """creates or updates the user in all the services concurrently.
+        Returns the results of the fan-out"""
+        def update_in_service(service):
+            s_id = mapped[service.service_name]
+            if s_id:
+                service.user.update(uid=s_id, **infos)
+                return s_id
+            return service.user.create(username=infos.get('username'),
+                                       email=infos.get('email'),
+                                       full_name=infos.get('full_name'),
+                                       ssh_keys=infos.get('ssh_keys', []),
+                                       cauth_id=infos.get('external_id'))
+
+        def create_in_service(service):
+            s_id = (service.user.get(username=infos.get('username')) or
+                    service.user.get(username=infos.get('email')))
+            if s_id:
+                return s_id, True
+            s_id = service.user.create(username=infos.get('username'),
+                                       email=infos.get('email'),
+                                       full_name=infos.get('full_name'),
+                                       ssh_keys=infos.get('ssh_keys', []),
+                                       cauth_id=infos.get('external_id'))
+            return s_id, False
+
+        if status == 'updated':
+            return services_fanout.map(update_in_service, SF_SERVICES)
+        if status == 'created':
+            return services_fanout.map(create_in_service, SF_SERVICES)
+        return []
+
+    def _map_services(self, user_id, status, infos, mapped, results):
+        """writes the mappings of the services the user was created in.
+        Returns the errors by service"""
+        if status == 'updated':
+            sfmanager.user.mapping.set_many(
+                user_id,
+                [(service.service_name, s_id)
+                 for service, s_id, error in results
+                 if error is None and not mapped[service.service_name]])
+            return utils.fanout_errors(results)
+        mappings = []
+        for service, result, error in results:
+            if error is not None:
+                continue
+            s_id, existed = result
+            if existed:
+                msg = u'[%s] user %s exists, skipping creation'
+                logger.debug(msg % (service.service_name,
+                                    infos.get('username')))
+                mapped = sfmanager.user.mapping.get_user_mapping(
+                    service.service_name,
+                    s_id)
+                if not mapped:
+                    mappings.append((service.service_name, s_id))
+                    msg = u'[%s] user %s mapped to id %s'
                     logger.debug(msg % (service.service_name,
                                         infos.get('username'),
-                                        service.service_name,
                                         s_id))
-            except exceptions.UnavailableActionError:
-                pass
+            else:
+                # we might have a mapping, but to a wrong user id in the
+                # service (because the user existed before but was removed
+                # directly from the service, for example)
+                mapped = sfmanager.user.mapping.get_service_mapping(
+                    service.service_name,
+                    user_id)
+                if mapped and mapped != s_id:
+                    msg = u'[%s] user %s wrongly mapped to id %s, removing'
+                    logger.debug(msg % (service.service_name,
+                                        infos.get('username'),
+                                        mapped))
+                    sfmanager.user.mapping.delete(user_id,
+                                                  service.service_name,
+                                                  mapped)
+                mappings.append((service.service_name, s_id))
+                msg = u'[%s] user %s mapped to %s id %s'
+                logger.debug(msg % (service.service_name,
+                                    infos.get('username'),
+                                    service.service_name,
+                                    s_id))
+        sfmanager.user.mapping.set_many(user_id, mappings)
+        return utils.fanout_errors(results)
+
+    def _get_paging_value(self, kwargs, key):
+        value = kwargs.pop(key, None)
+        if value is None:
+            return None
+        try:
+            number = int(value)
+        except ValueError:
+            number = -1
+        if number < 0:
+            abort(400, detail=u'Invalid %s value: %s' % (key, value))
+        return number
 
     @expose('json')
     def get(self, **kwargs):
@@ -407,7 +800,26 @@ class ServicesUsersController(RestController):
                          target={'username': kwargs.get('username')}):
             return abort(401,
                          detail='Failure to comply with policy %s' % _policy)
-        return sfmanager.user.get(**kwargs)
+        limit = self._get_paging_value(kwargs, 'limit')
+        offset = self._get_paging_value(kwargs, 'offset')
+        after = self._get_paging_value(kwargs, 'after')
+        fields = kwargs.pop('fields', None)
+        if fields:
+            fields = fields.split(',')
+            unknown = set(fields) - set(sfmanager.user.fields)
+            if unknown:
+                abort(400, detail=u'Unknown fields: %s' % ', '.join(unknown))
+        if any(kwargs.values()):
+            user = sfmanager.user.get(**kwargs)
+            if fields:
+                user = dict((k, v) for k, v in user.items() if k in fields)
+            return user
+        # the list is streamed as it is read from the database, page by page
+        users = sfmanager.user.iterate(fields=fields, limit=limit,
+                                       offset=offset, after=after)
+        response.content_type = 'application/json'
+        response.app_iter = utils.json_list_stream(users)
+        return response
 
     @expose()
     def delete(self, id=None, email=None, username=None):
@@ -426,13 +838,16 @@ class ServicesUsersController(RestController):
             return
         logger.debug(u'found %s %s with id %s' % (email, username, d_id))
         try:
-            for service in SF_SERVICES:
-                try:
-                    service.user.delete(email=email, username=username)
+            results = services_fanout.map(
+                lambda s: s.user.delete(email=email, username=username),
+                SF_SERVICES)
+            for service, result, error in results:
+                if error is None:
                     sfmanager.user.mapping.delete(d_id,
                                                   service.service_name)
-                except exceptions.UnavailableActionError:
-                    pass
+            errors = utils.fanout_errors(results)
+            if errors:
+                raise exceptions.ServicesError(errors)
             sfmanager.user.delete(id=d_id)
         except Exception as e:
             return report_unhandled_error(e)
@@ -560,19 +975,38 @@ class ResourcesController(RestController):
             response.status = 200
         return logs
 
+    class ApplyJobController(RestController):
+        @expose('json')
+        def get(self, id, **kwargs):
+            _policy = 'managesf.resources:apply-status'
+            if not authorize(_policy,
+                             target={}):
+                return abort(401,
+                             detail='Failure to comply with policy %s' %
+                             _policy)
+            offset = kwargs.get('offset')
+            try:
+                offset = int(offset or 0)
+                if offset < 0:
+                    raise ValueError
+            except ValueError:
+                abort(400, detail=u'Invalid offset value: %s' % offset)
+            job = apply_queue.get(id, offset)
+            if not job:
+                abort(404, detail=u'No apply job %s' % id)
+            return job
+
+    jobs = ApplyJobController()
+
     @expose('json')
-    def put(self):
+    def put(self, **kwargs):
+        """applies the resources in a background job. With async=true the
+        job id is returned at once, the job status and logs are then read
+        from /resources/jobs/<id>"""
         self.check_policy('managesf.resources:apply')
         infos = request.json if request.content_length else {}
-        eng = SFResourceBackendEngine(
-            os.path.join(conf.resources['workdir'], 'apply'),
-            conf.resources['subdir'])
         if not infos or 'COMMIT' in infos:
-            commit = infos.get('COMMIT', 'master')
-            status, logs = eng.apply(conf.resources['master_repo'],
-                                     '%s^1' % commit,
-                                     conf.resources['master_repo'],
-                                     commit)
+            params = {'COMMIT': infos.get('COMMIT', 'master')}
         else:
             try:
                 prev = infos.get('prev', None)
@@ -583,7 +1017,17 @@ class ResourcesController(RestController):
                 response.status = 400
                 return ['Unable to find the "new" and/or "prev" '
                         'keys in the json payload']
-            status, logs = eng.direct_apply(prev, new)
+            params = {'prev': prev, 'new': new}
+        if kwargs.get('async') == 'true':
+            job_id = apply_queue.submit(params)
+            response.status = 202
+            response.headers['Location'] = '/resources/jobs/%s' % job_id
+            return {'job_id': job_id, 'status': tasks.QUEUED}
+        result = apply_queue.submit(params, wait=True)
+        if result is None:
+            response.status = 500
+            return ['The apply job could not be run']
+        status, logs = result
         if not status:
             response.status = 409
         else:
@@ -608,7 +1052,7 @@ class NodesController(RestController):
     class ImageController(RestController):
 
         @expose('json')
-        def get(self, provider_name=None, image_name=None):
+        def get(self, provider_name=None, image_name=None, **kwargs):
             _policy = 'managesf.node:image-get'
             if not authorize(_policy,
                              target={"image": image_name,
@@ -620,8 +1064,11 @@ class NodesController(RestController):
             response.status = 200
             provider = AGENTSPROVIDERS[0]
             try:
-                r = provider.image.get(provider_name, image_name)
+                refresh = kwargs.get('refresh') == 'true'
+                r = provider.image.get(provider_name, image_name,
+                                       refresh=refresh)
                 results[provider.service_name] = r
+                set_snapshot_age(provider.image)
             except Exception as e:
                 response.status = 500
                 d = {'error_description': unicode(e)}
@@ -652,10 +1099,17 @@ class NodesController(RestController):
                 return d
 
         @expose('json')
-        def get(self, id):
+        def get(self, id, **kwargs):
             _policy = 'managesf.node:image-update-status'
             provider = AGENTSPROVIDERS[0]
-            info = provider.image.get_update_info(id)
+            offset = kwargs.get('offset')
+            if offset is not None:
+                try:
+                    offset = int(offset)
+                except ValueError:
+                    response.status = 400
+                    return {'error_description': 'offset must be an integer'}
+            info = provider.image.get_update_info(id, offset=offset)
             if not info:
                 return abort(404)
             if not authorize(_policy,
@@ -708,7 +1162,7 @@ class NodesController(RestController):
         authorize_key = SSHKeyController()
 
         @expose('json')
-        def get(self, node_id):
+        def get(self, node_id, **kwargs):
             try:
                 node_id = int(node_id)
             except:
@@ -723,8 +1177,10 @@ class NodesController(RestController):
             provider = AGENTSPROVIDERS[0]
             try:
                 results = {}
-                r = provider.node.get(node_id)
+                refresh = kwargs.get('refresh') == 'true'
+                r = provider.node.get(node_id, refresh=refresh)
                 results[provider.service_name] = r
+                set_snapshot_age(provider.node)
                 response.status = 200
                 return results
             except Exception as e:
@@ -790,7 +1246,7 @@ class NodesController(RestController):
     id = NodeByIdController()
 
     @expose('json')
-    def get(self):
+    def get(self, **kwargs):
         _policy = 'managesf.node:get'
         if not authorize(_policy,
                          target={}):
@@ -800,8 +1256,10 @@ class NodesController(RestController):
         provider = AGENTSPROVIDERS[0]
         try:
             results = {}
-            r = provider.node.get()
+            refresh = kwargs.get('refresh') == 'true'
+            r = provider.node.get(refresh=refresh)
             results[provider.service_name] = r
+            set_snapshot_age(provider.node)
             response.status = 200
             return results
         except Exception as e:
@@ -915,7 +1373,7 @@ class JobsController(RestController):
         response.status = 400
         if not job_name:
             return {'error_description': 'missing job name'}
-        allowed_filter_opts = ['change', 'patchset']
+        allowed_filter_opts = ['change', 'patchset', 'limit', 'offset']
         # precedence is query args, then json payload
         if not kwargs:
             kwargs = request.json if request.content_length else {}
@@ -932,6 +1390,8 @@ class JobsController(RestController):
                 results[jobrunner.service_name] = r
             response.status = 200
             return results
+        except exceptions.InvalidParameterError as e:
+            return {'error_description': unicode(e)}
         except Exception as e:
             response.status = 500
             return {'error_description': str(e)}
@@ -960,6 +1420,10 @@ class JobsController(RestController):
 
 
 load_services()
+services_fanout = load_services_fanout()
+apply_queue = load_apply_queue()
+bulk_queue = tasks.TaskQueue('users-bulk', run_bulk)
+applied_commits = model.AppliedCommitsCRUD()
 
 
 JOBRUNNERS = [s for s in SF_SERVICES
@@ -0,0 +1,244 @@
+#
+# Copyright (C) 2017 Red Hat <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from Queue import Queue
+
+from managesf import model
+
+
+logger = logging.getLogger(__name__)
+
+
+QUEUED = 'QUEUED'
+RUNNING = 'RUNNING'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+INTERRUPTED = 'INTERRUPTED'
+
+crud = model.TasksCRUD()
+
+# the queues created, started by start_queues once the app is loaded
+QUEUES = []
+
+# a task output is written every FLUSH_LINES lines or FLUSH_INTERVAL seconds
+FLUSH_LINES = 100
+FLUSH_INTERVAL = 2
+
+
+def get_owner():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def _owner_is_dead(owner):
+    """tells if the task owner is a process of this host that is gone"""
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        # our own tasks are not known yet, so they come from a previous
+        # process that had the same pid
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class TaskLog(list):
+    """list of log lines also appended to the task output. The lines are
+    written by batches of flush_lines, or once flush_interval seconds
+    passed since the last write, and by flush when the task ends.
+    The task may set its result attribute to a value recorded with it"""
+
+    def __init__(self, task_id, flush_lines=FLUSH_LINES,
+                 flush_interval=FLUSH_INTERVAL):
+        super(TaskLog, self).__init__()
+        self.task_id = task_id
+        self.result = None
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    def append(self, line):
+        self.extend([line])
+
+    def extend(self, lines):
+        lines = list(lines)
+        super(TaskLog, self).extend(lines)
+        with self._lock:
+            self._pending.extend(lines)
+            if (len(self._pending) < self.flush_lines and
+                    time.time() - self._flushed < self.flush_interval):
+                return
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            crud.append_output(self.task_id,
+                               u''.join(u'%s\n' % l for l in self._pending))
+            self._pending = []
+        self._flushed = time.time()
+
+    def flush(self):
+        """writes the lines not written yet to the task output"""
+        with self._lock:
+            self._flush()
+
+
+class TaskQueue(object):
+    """Runs the tasks of a kind in a pool of threads, in submission order.
+
+    run(params, logs, worker) is called with the decoded task parameters,
+    a TaskLog and the index of the worker thread, and returns whether the
+    task succeeded, with the value of logs.result if it is set. The tasks
+    are recorded in the database: the queued
+    tasks left by a stopped process are taken over when the queue starts,
+    and the ones it was running are marked INTERRUPTED. The queues start
+    when the application is loaded, see start_queues."""
+
+    def __init__(self, kind, run, workers=1):
+        self.kind = kind
+        self.run = run
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        self._results = {}
+        self._lock = threading.Lock()
+        QUEUES.append(self)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work, args=(i, ),
+                                     name='%s-%s' % (self.kind, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self.recover()
+
+    def recover(self):
+        owner = get_owner()
+        for task in crud.get_by_status(self.kind, [QUEUED, RUNNING]):
+            if not _owner_is_dead(task['owner']):
+                continue
+            if task['status'] == RUNNING:
+                # the other processes of this host recover it too
+                if not crud.interrupt(task['id']):
+                    continue
+                logger.info('[%s] task %s was interrupted' % (self.kind,
+                                                              task['id']))
+                crud.append_output(task['id'],
+                                   u'Interrupted by a restart of managesf\n')
+            else:
+                logger.info('[%s] resuming task %s' % (self.kind,
+                                                       task['id']))
+                crud.update(task['id'], owner=owner)
+                self._queue.put(int(task['id']))
+
+    def _work(self, worker):
+        while True:
+            task_id = self._queue.get()
+            try:
+                self._run(task_id, worker)
+            except Exception:
+                logger.exception('[%s] task %s failed' % (self.kind,
+                                                          task_id))
+            finally:
+                model.Session.remove()
+                with self._lock:
+                    waiting = self._results.get(task_id)
+                if waiting:
+                    waiting[0].set()
+
+    def _run(self, task_id, worker):
+        if not crud.claim(task_id, get_owner()):
+            return
+        task = crud.get(task_id)
+        logs = TaskLog(task_id)
+        try:
+            success = self.run(json.loads(task['params']), logs, worker)
+        except Exception as e:
+            logger.exception('[%s] task %s failed' % (self.kind, task_id))
+            logs.append(unicode(e))
+            success = False
+        try:
+            logs.flush()
+        except Exception:
+            logger.exception('[%s] could not write the output of task %s' %
+                             (self.kind, task_id))
+        with self._lock:
+            if task_id in self._results:
+                self._results[task_id][1] = (success, list(logs))
+        result = None
+        if logs.result is not None:
+            result = json.dumps(logs.result)
+        crud.update(task_id, status=SUCCESS if success else FAILURE,
+                    finished=time.time(), result=result)
+
+    def submit(self, params, wait=False):
+        """queues a task and returns its id. With wait, waits for the task
+        and returns whether it succeeded and its logs instead"""
+        self.start()
+        task_id = crud.create(self.kind, json.dumps(params), get_owner())
+        if not wait:
+            self._queue.put(task_id)
+            return task_id
+        event = threading.Event()
+        with self._lock:
+            self._results[task_id] = [event, None]
+        self._queue.put(task_id)
+        event.wait()
+        with self._lock:
+            return self._results.pop(task_id)[1]
+
+    def _format(self, task, offset=0):
+        task.pop('params')
+        task['result'] = json.loads(task['result']) if task['result'] else None
+        task['output'], task['offset'] = crud.get_output(int(task['id']),
+                                                         offset)
+        return task
+
+    def get(self, task_id, offset=0):
+        """returns the task with its output from offset on"""
+        task = crud.get(task_id)
+        if not task or task['kind'] != self.kind:
+            return {}
+        return self._format(task, offset)
+
+    def get_active(self):
+        """returns the queued and running tasks, oldest first"""
+        # the tasks interrupted by a restart are not active anymore
+        self.start()
+        return [self._format(t)
+                for t in crud.get_by_status(self.kind, [QUEUED, RUNNING])]
+
+
+def start_queues():
+    """starts the queues and recovers the tasks left by a previous process.
+    To be called by each process serving the API once the app is loaded"""
+    for queue in QUEUES:
+        queue.start()
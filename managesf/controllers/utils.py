@@ -13,14 +13,28 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from subprocess import Popen, PIPE
+from contextlib import contextmanager
+from subprocess import Popen, PIPE, STDOUT
 from pwd import getpwnam
 from grp import getgrnam
+import fcntl
 import os
+import json
 import logging
+import threading
+import time
+
+from six.moves import queue
+
+from managesf.services import exceptions
 
 logger = logging.getLogger(__name__)
 
+# threads running the service plugin calls of all the requests
+FANOUT_WORKERS = 8
+# seconds to wait for a service plugin call
+FANOUT_TIMEOUT = 60
+
 
 def chown(path, user, group):
     uid = getpwnam(group).pw_uid
@@ -48,6 +62,17 @@ class RemoteUser(object):
         cmd = ['ssh'] + self.opt + [self.host] + cmd.split()
         return self._exe(cmd)
 
+    def _ssh_stream(self, cmd, output):
+        """runs cmd, appending the lines of its stdout and stderr to output
+        as they come. Returns the exit code"""
+        cmd = ['ssh'] + self.opt + [self.host] + cmd.split()
+        logger.debug(cmd)
+        p = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+        for line in iter(p.stdout.readline, b''):
+            output.append(line.rstrip('\n').decode('utf-8', 'replace'))
+        p.stdout.close()
+        return p.wait()
+
     def _scpFromRemote(self, src, dest):
         src = '%s:%s' % (self.host, src)
         cmd = ['scp'] + self.opt + [src, dest]
@@ -57,3 +82,147 @@ class RemoteUser(object):
         dest = '%s:%s' % (self.host, dest)
         cmd = ['scp'] + self.opt + [src, dest]
         return self._exe(cmd)
+
+
+class _FanoutCall(object):
+    """A service plugin call, run by a ServicesFanout worker"""
+    def __init__(self, func, service):
+        self.func = func
+        self.service = service
+        self.started = None
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.done = threading.Event()
+
+    def start(self):
+        """tells if the call is to be run, and records when it started"""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.started = time.time()
+            self.running.set()
+            return True
+
+    def cancel(self):
+        """cancels the call if it did not start yet, tells if it did"""
+        with self.lock:
+            if self.started is None:
+                self.cancelled = True
+            return not self.cancelled
+
+    def run(self):
+        try:
+            self.result = self.func(self.service)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+
+class ServicesFanout(object):
+    """Calls a function on several service plugins concurrently.
+
+    The calls of every request run on a fixed pool of worker threads. A
+    service gets timeout seconds, or its own value in timeouts, to answer
+    once its call runs, and as long to get a free worker: a call still
+    queued then is dropped. A call that times out keeps its worker busy
+    until it returns, the pool is never grown."""
+    def __init__(self, workers=FANOUT_WORKERS, timeout=FANOUT_TIMEOUT,
+                 timeouts=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self._queue = queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            if call.start():
+                call.run()
+
+    def _start(self):
+        # the workers are started by the process serving the requests,
+        # threads do not survive a fork
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work,
+                                     name='fanout-%s' % i)
+                t.daemon = True
+                t.start()
+            self._pid = os.getpid()
+
+    def get_timeout(self, service):
+        return self.timeouts.get(service.service_name, self.timeout)
+
+    def _wait(self, call, submitted):
+        """returns the result and the error of call"""
+        timeout = self.get_timeout(call.service)
+        name = call.service.service_name
+        # wait for a worker, then for the call
+        call.running.wait(max(0, submitted + timeout - time.time()))
+        if not call.running.is_set() and not call.cancel():
+            msg = '[%s] no worker free after %ss' % (name, timeout)
+            return None, exceptions.ServiceTimeoutError(msg)
+        call.done.wait(max(0, call.started + timeout - time.time()))
+        if not call.done.is_set():
+            msg = '[%s] no answer after %ss' % (name, timeout)
+            return None, exceptions.ServiceTimeoutError(msg)
+        return call.result, call.error
+
+    def map(self, func, services):
+        """returns a (service, result, error) tuple per service, in the
+        services order. A late service gets a ServiceTimeoutError naming
+        it"""
+        self._start()
+        submitted = time.time()
+        calls = [_FanoutCall(func, service) for service in services]
+        for call in calls:
+            self._queue.put(call)
+        results = []
+        for call in calls:
+            result, error = self._wait(call, submitted)
+            if isinstance(error, exceptions.ServiceTimeoutError):
+                logger.warning(str(error))
+            results.append((call.service, result, error))
+        return results
+
+
+def fanout_errors(results):
+    """returns the errors of a fan-out by service name, ignoring the
+    services that do not implement the action"""
+    errors = {}
+    for service, result, error in results:
+        if error is None or \
+           isinstance(error, exceptions.UnavailableActionError):
+            continue
+        logger.error('[%s] %s' % (service.service_name, error))
+        errors[service.service_name] = error
+    return errors
+
+
+def json_list_stream(items):
+    """yields items as a JSON list, one item at a time"""
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ','
+    yield ']'
+
+
+@contextmanager
+def file_lock(path):
+    """holds an exclusive lock on path, shared by the processes and the
+    threads (each call opens its own file description)"""
+    lockfile = open(path, 'a')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+    finally:
+        lockfile.close()
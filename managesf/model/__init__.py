@@ -14,12 +14,14 @@
 # under the License.
 
 import logging
+import time
 
 from pecan import conf  # noqa
+from pecan.hooks import PecanHook
 from sqlalchemy import create_engine, Column, String, Unicode, UnicodeText
 from sqlalchemy import Boolean, Integer, exc, event
-from sqlalchemy import ForeignKey, UniqueConstraint
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import ForeignKey, Index, UniqueConstraint, inspect
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
@@ -27,19 +29,34 @@ from contextlib import contextmanager
 
 Base = declarative_base()
 engine = None
+# thread-local sessions, created by init_model()
+Session = None
+
+# connection pool defaults, overridable in conf.sqlalchemy (not sqlite)
+POOL_DEFAULTS = {'pool_size': 10,
+                 'max_overflow': 20,
+                 'pool_timeout': 30,
+                 'pool_recycle': 600}
+
+# rows read per query when iterating over the users
+PAGE_SIZE = 500
 
 
 logger = logging.getLogger(__name__)
 
 
+def _stringify(value):
+    # TODO: Fix test and remove bellow hack!
+    if not isinstance(value, basestring) and \
+       not isinstance(value, bool):
+        return str(value)
+    return value
+
+
 def row2dict(row):
     ret = {}
     for column in row.__table__.columns:
-        ret[column.name] = getattr(row, column.name)
-        # TODO: Fix test and remove bellow hack!
-        if not isinstance(ret[column.name], basestring) and \
-           not isinstance(ret[column.name], bool):
-            ret[column.name] = str(ret[column.name])
+        ret[column.name] = _stringify(getattr(row, column.name))
     return ret
 
 
@@ -75,7 +92,7 @@ class SFUser(Base):
     fullname = Column(Unicode(255), nullable=True)
     # Gerrit requires email unicity
     email = Column(String(255), nullable=False, unique=True)
-    cauth_id = Column(Integer(), nullable=False)
+    cauth_id = Column(Integer(), nullable=False, index=True)
     idp_sync = Column(Boolean(), default=True)
 
 
@@ -89,10 +106,13 @@ class SFUserServiceMapping(Base):
     service = Column(String(255), nullable=False)
     # for extended future compatibility, don't limit to integers
     service_user_id = Column(String(255), nullable=False)
+    # lookups by (service, sf_user_id) are served by the unique constraint
     __table_args__ = (UniqueConstraint('sf_user_id',
                                        'service',
                                        'service_user_id',
-                                       name='unique_service_user'), )
+                                       name='unique_service_user'),
+                      Index('ix_service_user_id',
+                            'service', 'service_user_id'), )
 
 
 class SFUserCRUD:
@@ -103,6 +123,13 @@ class SFUserCRUD:
                                      service_user_id=service_user_id)
             session.add(r)
 
+    def set_service_mappings(self, sf_user_id, mappings):
+        with session_scope() as session:
+            session.add_all([SFUserServiceMapping(sf_user_id=sf_user_id,
+                                                  service=service,
+                                                  service_user_id=s_id)
+                             for service, s_id in mappings])
+
     def get_service_mapping(self, service, sf_user_id):
         with session_scope() as session:
             filtering = {'service': service,
@@ -168,6 +195,40 @@ class SFUserCRUD:
                 all = [row2dict(ret) for ret in session.query(SFUser)]
                 return all
 
+    def iterate(self, fields=None, limit=None, offset=None, after=None,
+                page_size=PAGE_SIZE):
+        """Yields the users ordered by id, as dicts restricted to fields.
+        after is the id of the last user already seen (keyset pagination).
+        The rows are read page_size at a time, each page in its own
+        session, so that the memory used does not grow with the table."""
+        columns = [c for c in SFUser.__table__.columns
+                   if c.name != 'id' and (not fields or c.name in fields)]
+        names = ['id'] + [c.name for c in columns]
+        if fields and 'id' not in fields:
+            names[0] = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size
+            if remaining is not None:
+                size = min(size, remaining)
+            with session_scope() as session:
+                query = session.query(SFUser.id, *columns)
+                if after is not None:
+                    query = query.filter(SFUser.id > after)
+                query = query.order_by(SFUser.id)
+                if offset:
+                    query = query.offset(offset)
+                    offset = None
+                rows = query.limit(size).all()
+            for row in rows:
+                yield dict((name, _stringify(value))
+                           for name, value in zip(names, row) if name)
+            if len(rows) < size:
+                return
+            after = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
     def update(self, id, username=None, email=None,
                fullname=None, cauth_id=None, idp_sync=None):
         with session_scope() as session:
@@ -183,7 +244,7 @@ class SFUserCRUD:
                     ret.cauth_id = cauth_id
                 if idp_sync is not None:
                     ret.idp_sync = idp_sync
-                session.commit()
+                session.flush()
             except MultipleResultsFound:
                 msg = 'SF_USERS table has multiple row with the same id!'
                 logger.error(msg)
@@ -193,7 +254,7 @@ class SFUserCRUD:
                 return
 
     def create(self, username, email,
-               fullname, cauth_id=None):
+               fullname, cauth_id=None, as_dict=False):
         with session_scope() as session:
             if username and email and fullname:
                 # assign a dummy value in case we lack the information
@@ -205,7 +266,9 @@ class SFUserCRUD:
                               fullname=fullname,
                               cauth_id=cid)
                 session.add(user)
-                session.commit()
+                session.flush()
+                if as_dict:
+                    return row2dict(user)
                 return user.id
             else:
                 msg = "Missing info required for user creation: %s|%s|%s"
@@ -228,7 +291,7 @@ class SFUserCRUD:
             try:
                 ret = session.query(SFUser).filter_by(**filtering).one()
                 session.delete(ret)
-                session.commit()
+                session.flush()
                 return True
             except MultipleResultsFound:
                 # TODO(mhu) find a better Error
@@ -256,7 +319,7 @@ class ImageUpdatesCRUD():
                               provider=provider,
                               image=image)
                 session.add(img_update)
-                session.commit()
+                session.flush()
                 return img_update.id
             else:
                 msg = "Missing info required for image update: %s|%s"
@@ -275,7 +338,17 @@ class ImageUpdatesCRUD():
                     u.output = output
                 if stderr:
                     u.stderr = stderr
-                session.commit()
+                session.flush()
+            except NoResultFound:
+                logger.warn("Could not update image-update %s: not found" % id)
+                return
+
+    def append_output(self, id, output):
+        with session_scope() as session:
+            try:
+                u = session.query(NodepoolImageUpdate).filter_by(id=id).one()
+                u.output = (u.output or u'') + output
+                session.flush()
             except NoResultFound:
                 logger.warn("Could not update image-update %s: not found" % id)
                 return
@@ -290,35 +363,209 @@ class ImageUpdatesCRUD():
                 return {}
 
 
+class Task(Base):
+    """A job run in the background by a worker of the API"""
+    __tablename__ = 'SF_TASKS'
+    id = Column(Integer(), primary_key=True)
+    kind = Column(String(255), nullable=False, index=True)
+    status = Column(String(255), default="QUEUED")
+    # JSON encoded
+    params = Column(UnicodeText(4294967295), default=u"")
+    # JSON encoded, set by the task if it has a result besides its status
+    result = Column(UnicodeText(4294967295), default=u"")
+    # hostname:pid of the process the task was submitted to
+    owner = Column(String(255), default="")
+    created = Column(Integer(), default=0)
+    started = Column(Integer(), default=0)
+    finished = Column(Integer(), default=0)
+
+
+class TaskOutput(Base):
+    """A chunk of the output of a task. The output is appended chunk by
+    chunk, without reading back what was written before"""
+    __tablename__ = 'SF_TASK_OUTPUTS'
+    id = Column(Integer(), primary_key=True)
+    task_id = Column(Integer(), ForeignKey('SF_TASKS.id'), nullable=False,
+                     index=True)
+    # offset of the chunk in the whole output
+    start = Column(Integer(), nullable=False)
+    output = Column(UnicodeText(4294967295), default=u"")
+
+
+class TasksCRUD():
+    def create(self, kind, params, owner):
+        with session_scope() as session:
+            task = Task(kind=kind, params=params, owner=owner,
+                        status="QUEUED", created=int(time.time()))
+            session.add(task)
+            session.flush()
+            return task.id
+
+    def claim(self, id, owner):
+        """marks a queued task as running, returns False if it was not
+        queued anymore (another process took it)"""
+        with session_scope() as session:
+            t = session.query(Task).filter_by(id=id, status="QUEUED")
+            return bool(t.update({'status': "RUNNING",
+                                  'owner': owner,
+                                  'started': int(time.time())},
+                                 synchronize_session=False))
+
+    def update(self, id, status=None, owner=None, finished=None,
+               result=None):
+        with session_scope() as session:
+            try:
+                t = session.query(Task).filter_by(id=id).one()
+                if status:
+                    t.status = status
+                if owner:
+                    t.owner = owner
+                if finished:
+                    t.finished = int(finished)
+                if result is not None:
+                    t.result = result
+                session.flush()
+            except NoResultFound:
+                logger.warn("Could not update task %s: not found" % id)
+                return
+
+    def interrupt(self, id):
+        """marks a running task as interrupted, returns False if it was not
+        running anymore"""
+        with session_scope() as session:
+            t = session.query(Task).filter_by(id=id, status="RUNNING")
+            return bool(t.update({'status': "INTERRUPTED",
+                                  'finished': int(time.time())},
+                                 synchronize_session=False))
+
+    def append_output(self, id, output):
+        with session_scope() as session:
+            last = session.query(TaskOutput).filter_by(task_id=id)
+            last = last.order_by(TaskOutput.id.desc()).first()
+            start = last.start + len(last.output) if last else 0
+            session.add(TaskOutput(task_id=id, start=start, output=output))
+
+    def get_output(self, id, offset=0):
+        """returns the output of the task from offset on, and the length of
+        the whole output. Only the chunks from offset on are read"""
+        with session_scope() as session:
+            chunks = session.query(TaskOutput).filter_by(task_id=id)
+            first = chunks.filter(TaskOutput.start <= offset)
+            first = first.order_by(TaskOutput.start.desc()).first()
+            if first is None:
+                return u'', 0
+            chunks = chunks.filter(TaskOutput.start >= first.start)
+            output = u''.join(c.output
+                              for c in chunks.order_by(TaskOutput.id))
+            return output[offset - first.start:], first.start + len(output)
+
+    def get(self, id):
+        with session_scope() as session:
+            try:
+                t = session.query(Task).filter_by(id=id).one()
+                return row2dict(t)
+            except NoResultFound:
+                return {}
+
+    def get_by_status(self, kind, statuses):
+        with session_scope() as session:
+            tasks = session.query(Task).filter(Task.kind == kind,
+                                               Task.status.in_(statuses))
+            return [row2dict(t) for t in tasks.order_by(Task.id)]
+
+
+class AppliedCommit(Base):
+    """The last commit of a config repository applied with success"""
+    __tablename__ = 'SF_APPLIED_COMMITS'
+    repo = Column(String(255), primary_key=True)
+    sha = Column(String(255), nullable=False)
+    applied = Column(Integer(), default=0)
+
+
+class AppliedCommitsCRUD():
+    def get(self, repo):
+        with session_scope() as session:
+            try:
+                c = session.query(AppliedCommit).filter_by(repo=repo).one()
+                return c.sha
+            except NoResultFound:
+                return None
+
+    def set(self, repo, sha):
+        with session_scope() as session:
+            c = session.query(AppliedCommit).get(repo)
+            if c is None:
+                c = AppliedCommit(repo=repo)
+                session.add(c)
+            c.sha = sha
+            c.applied = int(time.time())
+            session.flush()
+
+
 def init_model():
     c = dict(conf.sqlalchemy)
     url = c.pop('url')
     if url.startswith('mysql') and not url.endswith('?charset=utf8'):
         url += '?charset=utf8'
-    globals()['engine'] = create_engine(url, pool_recycle=600, **c)
+    if not url.startswith('sqlite'):
+        for k, v in POOL_DEFAULTS.items():
+            c.setdefault(k, v)
+    if engine is not None:
+        engine.dispose()
+    globals()['engine'] = create_engine(url, **c)
     if url.startswith('mysql'):
         event.listen(engine, 'checkout', checkout_listener)
+    Base.metadata.bind = engine
     Base.metadata.create_all(engine)
+    migrate_indexes(engine)
+    globals()['Session'] = scoped_session(sessionmaker(bind=engine))
+
+
+def migrate_indexes(engine):
+    """Adds the indexes missing from tables created by a previous version.
+    create_all only creates the indexes of new tables."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s on %s" % (index.name,
+                                                         table.name))
+                index.create(engine)
 
 
 def start_session():
-    Base.metadata.bind = engine
-    dbsession = sessionmaker(bind=engine)
-    session = dbsession()
-    return session
+    """returns the session of the current thread"""
+    return Session()
+
+
+class SessionHook(PecanHook):
+    """Discards the session of the request's thread once it is served"""
+    def after(self, state):
+        if Session is not None:
+            Session.remove()
 
 
 @contextmanager
 def session_scope():
+    """Nested scopes share the thread's session, only the outermost one
+    commits (or rolls back) and releases the connection. The CRUD methods
+    only flush, so that callers can group them in one transaction"""
     session = start_session()
+    depth = session.info.get('scope_depth', 0)
+    session.info['scope_depth'] = depth + 1
     try:
         yield session
-        session.commit()
+        if not depth:
+            session.commit()
     except:
-        session.rollback()
+        if not depth:
+            session.rollback()
         raise
     finally:
-        session.close()
+        session.info['scope_depth'] = depth
+        if not depth:
+            session.close()
 
 
 def add_user(user):
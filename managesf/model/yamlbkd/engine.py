@@ -15,6 +15,7 @@
 
 import os
 import re
+import git
 import yaml
 import deepdiff
 import logging
@@ -65,7 +66,8 @@ class SFResourceBackendEngine(object):
         well as simple type like str.
 
         This function acts at the resource[rtype][rid]
-        level only.
+        level only. The changed keys are None (unknown) when
+        DeepDiff reports a kind of change not handled here.
         """
         r_key_changes = {}
         for rid in rids:
@@ -88,8 +90,11 @@ class SFResourceBackendEngine(object):
                         key = key.groups()[0]
                         r_key_changes[rid]['changed'].add(key)
                 else:
-                    logger.info('Unexpected change type '
-                                'detected for rid: %s' % rid)
+                    logger.info('Unexpected change type %s '
+                                'detected for rid: %s' % (ctype, rid))
+                    # Callbacks must consider that any key changed
+                    r_key_changes[rid]['changed'] = None
+                    break
         return r_key_changes
 
     def _get_data_diff(self, prev, new):
@@ -216,7 +221,7 @@ class SFResourceBackendEngine(object):
                                 "validations failed")
                         # Check key changes are possible
                         if not all([r.is_mutable(k) for
-                                    k in data['changed']]):
+                                    k in data['changed'] or []]):
                             raise YAMLDBException(
                                 "Resource [type: %s, ID: %s] contains changed "
                                 "resource keys that are immutable. "
@@ -248,9 +253,14 @@ class SFResourceBackendEngine(object):
         """
         partial_errors = False
         priorities = self._get_resources_priority()
+        contexts = dict((rtype, MAPPING[rtype].new_run_context())
+                        for rtype, priority in priorities)
         for rtype, priority in priorities:
             if rtype not in sanitized_changes:
                 continue
+            context = {}
+            if contexts[rtype] is not None:
+                context['context'] = contexts[rtype]
             for ctype, datas in sanitized_changes[rtype].items():
                 for rid, data in datas.items():
                     apply_logs.append(
@@ -261,15 +271,18 @@ class SFResourceBackendEngine(object):
                         if ctype == 'update':
                             # Resource set_defaults is done in
                             # get_update_change for resources that
-                            # need to be updated
+                            # need to be updated. The changed keys
+                            # are unknown (None) for resources that
+                            # need a refresh because of their deps.
                             logs = MAPPING[rtype].CALLBACKS[ctype](
-                                conf, new, data['data'])
+                                conf, new, data['data'],
+                                data.get('changed'), **context)
                         else:
                             r = MAPPING[rtype](rid, data)
                             r.set_defaults()
                             _data = r.get_resource()
                             logs = MAPPING[rtype].CALLBACKS[ctype](
-                                conf, new, _data)
+                                conf, new, _data, **context)
                     except Exception, e:
                         logs.append(
                             "Resource [type: %s, ID: %s] %s op error (%s)." % (
@@ -286,6 +299,9 @@ class SFResourceBackendEngine(object):
                         apply_logs.append(
                             "Resource [type: %s, ID: %s] has been %s." % (
                                 rtype, rid, ctype + 'd'))
+        for rtype, priority in priorities:
+            apply_logs.extend(
+                MAPPING[rtype].get_apply_summary(contexts[rtype]))
         return partial_errors
 
     def _resolv_resources_need_refresh(self, sanitized_changes, tree):
@@ -318,6 +334,12 @@ class SFResourceBackendEngine(object):
                                         rtype, rid))
                                 sanitized_changes[rtype]['update'][rid] = {
                                     'data': data}
+                            else:
+                                # The resource has changed keys but
+                                # a dependency changed too so the
+                                # update cannot be limited to them.
+                                sanitized_changes[rtype]['update'][rid].pop(
+                                    'changed', None)
         logs = []
         # Do it 3 times to resolv deps of max 3 depths
         for _ in xrange(3):
@@ -468,14 +490,15 @@ class SFResourceBackendEngine(object):
         return True, validation_logs
 
     def apply(self, repo_prev_uri, prev_ref,
-              repo_new_uri, new_ref):
-        """ Top level apply function
+              repo_new_uri, new_ref, logs=None):
+        """ Top level apply function. The logs are appended to the logs
+        list if one is given.
         """
         logger.info("Resources engine: apply resources requested"
                     "(old ref: %s, new ref: %s)" % (prev_ref, new_ref))
         if not os.path.isdir(self.workdir):
             os.mkdir(self.workdir)
-        apply_logs = []
+        apply_logs = logs if logs is not None else []
         try:
             prev, new = self._load_resources_data(
                 repo_prev_uri, prev_ref, repo_new_uri, new_ref)
@@ -504,17 +527,43 @@ class SFResourceBackendEngine(object):
                               "%s_cache" % self.workdir.rstrip('/'))
         return current.get_data()
 
-    def direct_apply(self, prev, new):
+    def get_new_commits(self, repo_uri, since=None):
+        """ Return the SHAs of the commits of the master branch of
+        the GIT repository that are not ancestors of the since commit,
+        newest first. Every commit is returned if since is None, and
+        None if since is unknown to the repository.
+        """
+        if not os.path.isdir(self.workdir):
+            os.mkdir(self.workdir)
+        cpath = os.path.join(self.workdir, 'history')
+        if not os.path.isdir(cpath):
+            os.mkdir(cpath)
+        repo = git.Git(cpath)
+        repo.init()
+        repo.execute(['git', 'fetch', '-f', repo_uri,
+                      'master:refs/remotes/origin/master'])
+        cmd = ['git', 'rev-list', '--topo-order', 'origin/master']
+        if since:
+            try:
+                repo.execute(['git', 'cat-file', '-e', '%s^{commit}' % since])
+            except git.GitCommandError:
+                logger.info("Commit %s is unknown to %s" % (since, repo_uri))
+                return None
+            cmd.append('^%s' % since)
+        return repo.execute(cmd).split()
+
+    def direct_apply(self, prev, new, logs=None):
         """ Top level direct_apply function. This function should be
         called only under specific conditions.
 
         The yamls will be checked for consistencies then resources
         deduced from the diff of both will be applied. It is needed to
         understand that using this will de-synchronize the config
-        respository from the reality.
+        respository from the reality. The logs are appended to the logs
+        list if one is given.
         """
         logger.info("Resources engine: direct apply resources requested")
-        direct_apply_logs = []
+        direct_apply_logs = logs if logs is not None else []
         try:
             try:
                 prev = yaml.safe_load(StringIO(prev))
@@ -60,7 +60,8 @@ class BaseResource(object):
     # over all resources of a given type. Leave it at None if not the case
     PRIMARY_KEY = None
     CALLBACKS = {
-        'update': lambda conf, new, kwargs: NotImplementedError,
+        'update': lambda conf, new, kwargs, changed=None:
+            NotImplementedError,
         'create': lambda conf, new, kwargs: NotImplementedError,
         'delete': lambda conf, new, kwargs: NotImplementedError,
         'extra_validations': lambda conf, new, kwargs: NotImplementedError,
@@ -228,6 +229,24 @@ class BaseResource(object):
             return ''
         return {}
 
+    @staticmethod
+    def new_run_context():
+        """ Return the object shared by the create, update and
+        delete callbacks of the resource type during an apply run.
+        It is passed to them as the context keyword argument, unless
+        it is None (the default).
+        """
+        return None
+
+    @staticmethod
+    def get_apply_summary(context):
+        """ Return a list of informational logs about the
+        apply run that just ended, from its run context. These
+        logs are not errors and are added at the end of the apply
+        logs.
+        """
+        return []
+
     def set_defaults(self):
         """ Enrich the data MODEL. This method add
         missing fields to the resource. Missing fields are
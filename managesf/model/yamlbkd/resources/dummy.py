@@ -72,7 +72,7 @@ class Dummy(BaseResource):
     PRIMARY_KEY = 'name'
     PRIORITY = 50
     CALLBACKS = {
-        'update': lambda conf, new, kwargs:
+        'update': lambda conf, new, kwargs, changed=None:
             DummyOps(conf, new).update(**kwargs),
         'create': lambda conf, new, kwargs:
             DummyOps(conf, new).create(**kwargs),
@@ -136,7 +136,7 @@ class ACL(BaseResource):
     PRIORITY = 30
     PRIMARY_KEY = 'file'
     CALLBACKS = {
-        'update': lambda conf, new, kwargs: [],
+        'update': lambda conf, new, kwargs, changed=None: [],
         'create': lambda conf, new, kwargs: [],
         'delete': lambda conf, new, kwargs: [],
         'extra_validations': lambda conf, new, kwargs:
@@ -285,7 +285,7 @@ class GitRepository(BaseResource):
     PRIORITY = 20
     PRIMARY_KEY = 'name'
     CALLBACKS = {
-        'update': lambda conf, new, kwargs:
+        'update': lambda conf, new, kwargs, changed=None:
             GitRepositoryOps(conf, new).update(**kwargs),
         'create': lambda conf, new, kwargs:
             GitRepositoryOps(conf, new).create(**kwargs),
@@ -325,7 +325,7 @@ class Group(BaseResource):
     PRIORITY = 40
     PRIMARY_KEY = 'name'
     CALLBACKS = {
-        'update': lambda conf, new, kwargs:
+        'update': lambda conf, new, kwargs, changed=None:
             GroupOps(conf, new).update(**kwargs),
         'create': lambda conf, new, kwargs:
             GroupOps(conf, new).create(**kwargs),
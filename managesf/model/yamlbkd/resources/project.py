@@ -17,17 +17,21 @@ import logging
 
 from managesf.model.yamlbkd.resource import BaseResource
 from managesf.model.yamlbkd.resources.storyboard import StoryboardOps
+from managesf.model.yamlbkd.resources.storyboard import StoryboardCatalog
 
 logger = logging.getLogger(__name__)
 
+# Project keys that are reflected on Storyboard
+STORYBOARD_KEYS = ('name', 'issue-tracker', 'source-repositories')
+
 
 class ProjectOps(object):
 
-    def __init__(self, conf, new):
+    def __init__(self, conf, new, catalog=None):
         self.conf = conf
         self.new = new
         self.client = None
-        self.stb_ops = StoryboardOps(conf, new)
+        self.stb_ops = StoryboardOps(conf, new, catalog)
 
     def create(self, **kwargs):
         logs = []
@@ -40,9 +44,14 @@ class ProjectOps(object):
                 logs.append(msg)
         return logs
 
-    def update(self, **kwargs):
+    def update(self, changed=None, **kwargs):
         logs = []
         if self.stb_ops.is_activated(**kwargs):
+            if (changed is not None and
+                    not set(changed) & set(STORYBOARD_KEYS)):
+                # Only keys unknown to Storyboard have been changed
+                self.stb_ops.skip_write()
+                return logs
             try:
                 self.stb_ops.update_project_groups(**kwargs)
             except Exception, e:
@@ -163,17 +172,27 @@ class Project(BaseResource):
     PRIORITY = 10
     PRIMARY_KEY = 'name'
     CALLBACKS = {
-        'update': lambda conf, new, kwargs:
-            ProjectOps(conf, new).update(**kwargs),
-        'create': lambda conf, new, kwargs:
-            ProjectOps(conf, new).create(**kwargs),
-        'delete': lambda conf, new, kwargs:
-            ProjectOps(conf, new).delete(**kwargs),
+        'update': lambda conf, new, kwargs, changed=None, context=None:
+            ProjectOps(conf, new, context).update(changed=changed,
+                                                  **kwargs),
+        'create': lambda conf, new, kwargs, context=None:
+            ProjectOps(conf, new, context).create(**kwargs),
+        'delete': lambda conf, new, kwargs, context=None:
+            ProjectOps(conf, new, context).delete(**kwargs),
         'extra_validations': lambda conf, new, kwargs:
             ProjectOps(conf, new).extra_validations(**kwargs),
         'get_all': lambda conf, new: ([], {}),
     }
 
+    @staticmethod
+    def new_run_context():
+        # the Storyboard catalog is shared by the callbacks of a run
+        return StoryboardCatalog()
+
+    @staticmethod
+    def get_apply_summary(context):
+        return StoryboardOps(None, None, context).get_apply_summary()
+
     def get_deps(self, keyname=False):
         if keyname:
             return 'source-repositories'
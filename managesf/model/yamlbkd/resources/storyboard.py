@@ -26,12 +26,96 @@ NAME_MIN_LEN = 5
 NAME_MAX_LEN = 50
 
 
+# Storyboard listings are fetched by pages of that size (this is
+# the default page_size_maximum of the Storyboard API)
+CATALOG_PAGE_SIZE = 500
+
+
+class StoryboardCatalog(object):
+    """ Name indexed view of the Storyboard projects and project
+    groups. Listings are done once, by pages, and the catalog is
+    updated in place by StoryboardOps when items are created, updated
+    or deleted. That way callbacks called during the same apply do not
+    need to query Storyboard for each project name.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        # Count Storyboard writes avoided because nothing changed
+        self.skipped_writes = 0
+        self._projects = None
+        self._project_groups = None
+        self._members = {}
+
+    def _list(self, manager):
+        items = {}
+        offset = 0
+        while True:
+            page = manager.get_all(offset=offset, limit=CATALOG_PAGE_SIZE)
+            # the server may return shorter pages than asked when its
+            # page_size_maximum is lower, only an empty one ends the list
+            if not page:
+                break
+            for item in page:
+                items[item.name] = item
+            offset += len(page)
+        return items
+
+    @property
+    def projects(self):
+        if self._projects is None:
+            self._projects = self._list(self.client.projects)
+            logger.info("Storyboard catalog: %s projects loaded" % (
+                len(self._projects)))
+        return self._projects
+
+    @property
+    def project_groups(self):
+        if self._project_groups is None:
+            self._project_groups = self._list(self.client.project_groups)
+            logger.info("Storyboard catalog: %s project groups loaded" % (
+                len(self._project_groups)))
+        return self._project_groups
+
+    def get_project(self, name):
+        return self.projects.get(name)
+
+    def set_project(self, project):
+        self.projects[project.name] = project
+
+    def get_project_group(self, name):
+        return self.project_groups.get(name)
+
+    def set_project_group(self, pg):
+        self.project_groups[pg.name] = pg
+        self._members.setdefault(pg.id, set())
+
+    def del_project_group(self, pg):
+        self.project_groups.pop(pg.name, None)
+        self._members.pop(pg.id, None)
+
+    def get_members(self, pg):
+        """ Return the set of project ids included in the project
+        group. The returned set is the one kept by the catalog so
+        callers must update it when they change the group.
+        """
+        if pg.id not in self._members:
+            self._members[pg.id] = set([
+                p.id for p in
+                self.client.project_groups.get(id=pg.id).projects.get_all()])
+        return self._members[pg.id]
+
+
 class StoryboardOps(object):
 
-    def __init__(self, conf, new={}):
+    def __init__(self, conf, new={}, catalog=None):
+        """ catalog is the StoryboardCatalog shared by the callbacks
+        of an apply run, a new one is used if it is not given.
+        """
         self.conf = conf
         self.new = new
         self.client = None
+        self.catalog = catalog
 
     def is_activated(self, **kwargs):
         if ("SFStoryboard" in self.conf.services and
@@ -44,6 +128,30 @@ class StoryboardOps(object):
             stb = SoftwareFactoryStoryboard(self.conf)
             self.client = stb.get_client()
 
+    def _get_run_catalog(self):
+        if self.catalog is None:
+            self.catalog = StoryboardCatalog()
+        return self.catalog
+
+    def _set_catalog(self):
+        self._set_client()
+        catalog = self._get_run_catalog()
+        if not catalog.client:
+            catalog.client = self.client
+
+    def skip_write(self):
+        self._get_run_catalog().skipped_writes += 1
+
+    def get_apply_summary(self):
+        logs = []
+        catalog = self.catalog
+        # only report runs that used Storyboard
+        if catalog is not None and (catalog.client or
+                                    catalog.skipped_writes):
+            logs.append("Storyboard: %s write(s) skipped as the project "
+                        "data was unchanged." % catalog.skipped_writes)
+        return logs
+
     def extra_validations(self, **kwargs):
         logs = []
         if len(kwargs['name']) < NAME_MIN_LEN:
@@ -71,17 +179,20 @@ class StoryboardOps(object):
         return logs
 
     def update_project(self, name, description):
-        self._set_client()
-        project = [p for p in self.client.projects.get_all(name=name)
-                   if p.name == name]
-        if project:
-            project = project[0]
+        self._set_catalog()
+        project = self.catalog.get_project(name)
+        if project and getattr(project, 'description', None) == description:
+            self.skip_write()
+        elif project:
             self.client.projects.update(
                 id=project.id, description=description)
+            project.description = description
         else:
             # Create the project
-            self.client.projects.create(
+            project = self.client.projects.create(
                 name=name, description=description)
+            self.catalog.set_project(project)
+        return project
 
     def delete_project(self, name):
         raise NotImplementedError('Not supported by Storyboard')
@@ -89,46 +200,37 @@ class StoryboardOps(object):
     def update_project_groups(self, **kwargs):
         name = kwargs['name']
         sources_repositories = kwargs['source-repositories']
-        self._set_client()
-        pg = [p for p in self.client.project_groups.get_all(name=name)
-              if p.name == name]
+        self._set_catalog()
+        pg = self.catalog.get_project_group(name)
         if not pg:
             # Create the project group
             pg = self.client.project_groups.create(
                 name=name, title=name)
-        else:
-            pg = pg[0]
-        included_ids = [
-            p.id for p in
-            self.client.project_groups.get(id=pg.id).projects.get_all()]
+            self.catalog.set_project_group(pg)
+        included_ids = self.catalog.get_members(pg)
         wanted_included = []
         for sr_name in sources_repositories:
             sr = self.new['resources']['repos'][sr_name]
-            self.update_project(name=sr_name,
-                                description=sr['description'])
-            project = [p for p in self.client.projects.get_all(name=sr_name)
-                       if p.name == sr_name]
-            if project:
-                wanted_included.append(project[0].id)
-        to_add = set(wanted_included) - set(included_ids)
-        to_remove = set(included_ids) - set(wanted_included)
+            project = self.update_project(name=sr_name,
+                                          description=sr['description'])
+            wanted_included.append(project.id)
+        to_add = set(wanted_included) - included_ids
+        to_remove = included_ids - set(wanted_included)
         for id in to_add:
             self.client.project_groups.update(id=pg.id).projects.put(id=id)
+            included_ids.add(id)
         for id in to_remove:
             self.client.project_groups.update(id=pg.id).projects.delete(id=id)
+            included_ids.discard(id)
 
     def delete_project_groups(self, **kwargs):
         name = kwargs['name']
-        self._set_client()
-        pg = [p for p in self.client.project_groups.get_all(name=name)
-              if p.name == name]
-        pg = pg[0]
-        included_ids = [
-            p.id for p in
-            self.client.project_groups.get(id=pg.id).projects.get_all()]
-        for id in included_ids:
+        self._set_catalog()
+        pg = self.catalog.get_project_group(name)
+        for id in list(self.catalog.get_members(pg)):
             self.client.project_groups.update(id=pg.id).projects.delete(id=id)
         self.client.project_groups.delete(id=pg.id)
+        self.catalog.del_project_group(pg)
 
 
 if __name__ == '__main__':
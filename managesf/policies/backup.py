@@ -31,6 +31,9 @@ rules = [
     policy.RuleDefault(
         name=POLICY_ROOT % 'create',
         check_str=base.RULE_ADMIN_API),
+    policy.RuleDefault(
+        name=POLICY_ROOT % 'status',
+        check_str=base.RULE_ADMIN_API),
 ]
 
 
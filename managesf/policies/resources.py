@@ -34,6 +34,9 @@ rules = [
     policy.RuleDefault(
         name=POLICY_ROOT % 'apply',
         check_str=base.RULE_ADMIN_OR_SERVICE),
+    policy.RuleDefault(
+        name=POLICY_ROOT % 'apply-status',
+        check_str=base.RULE_ADMIN_OR_SERVICE),
 ]
 
 
@@ -38,6 +38,12 @@ rules = [
     policy.RuleDefault(
         name=POLICY_ROOT % 'update',
         check_str=CREATE_OR_UPDATE),
+    policy.RuleDefault(
+        name=POLICY_ROOT % 'bulk',
+        check_str=base.RULE_ADMIN_API),
+    policy.RuleDefault(
+        name=POLICY_ROOT % 'bulk-status',
+        check_str=base.RULE_ADMIN_API),
 ]
 
 
@@ -20,6 +20,7 @@
 
 import logging
 import os.path
+import threading
 
 from pecan import conf
 from oslo_policy import policy
@@ -31,6 +32,9 @@ logger = logging.getLogger(__name__)
 
 
 _ENFORCER = None
+# the policy file state _ENFORCER was built from
+_ENFORCER_KEY = None
+_LOCK = threading.Lock()
 
 
 class FakeOsloPolicy:
@@ -88,30 +92,45 @@ def register_rules(enforcer):
                 enforcer.rules[default.name] = default.check
 
 
+def _policy_file_key(policy_file):
+    st = os.stat(policy_file)
+    return (policy_file, st.st_ino, st.st_mtime, st.st_size)
+
+
 def authorize(rule_name, target, credentials):
-    reset()
+    global _ENFORCER_KEY
     try:
         policy_file = conf['policy'].get('policy_file')
     except KeyError:
         logger.info('Policy file not defined, going with default rules')
         policy_file = ''
-    if not policy_file or not os.path.isfile(policy_file):
-        msg = ('Policy file %s not found, initializing default policy '
-               'engine (this is normal when bootstrapping '
-               'Software Factory)')
-        logger.info(msg % policy_file)
-        init()
-    else:
-        init(policy_file=policy_file)
-    try:
-        result = _ENFORCER.enforce(rule_name, target, credentials,
-                                   do_raise=False)
-    except policy.PolicyNotRegistered:
-        logger.error('Policy %s not registered' % rule_name)
-        return -1
-    except Exception:
-        logger.debug('Policy check for %(rule)s failed with credentials '
-                     '%(credentials)s' % {'rule': rule_name,
-                                          'credentials': credentials})
-        raise
+    # the enforcer is shared by the request threads, it is only rebuilt
+    # when the policy file changes
+    with _LOCK:
+        if not policy_file or not os.path.isfile(policy_file):
+            key = None
+        else:
+            key = _policy_file_key(policy_file)
+        if _ENFORCER is None or key != _ENFORCER_KEY:
+            reset()
+            if key is None:
+                msg = ('Policy file %s not found, initializing default policy '
+                       'engine (this is normal when bootstrapping '
+                       'Software Factory)')
+                logger.info(msg % policy_file)
+                init()
+            else:
+                init(policy_file=policy_file)
+            _ENFORCER_KEY = key
+        try:
+            result = _ENFORCER.enforce(rule_name, target, credentials,
+                                       do_raise=False)
+        except policy.PolicyNotRegistered:
+            logger.error('Policy %s not registered' % rule_name)
+            return -1
+        except Exception:
+            logger.debug('Policy check for %(rule)s failed with credentials '
+                         '%(credentials)s' % {'rule': rule_name,
+                                              'credentials': credentials})
+            raise
     return result
@@ -0,0 +1,323 @@
+#
+# Copyright (C) 2017 Red Hat <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""the standalone server of managesf-api.
+
+A supervisor process opens the listening socket and forks the workers,
+each serving the requests with a pool of threads. SIGHUP starts new workers
+(which read the configuration again) then, once they have loaded the
+application, stops the old ones gracefully. SIGTERM or SIGINT stops every
+worker gracefully. A worker that crashes is replaced, after a delay that
+grows while its replacements fail to load the application."""
+
+
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import threading
+import time
+from Queue import Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+# overridable in conf.server
+WORKERS = 1
+THREADS = 8
+# seconds a client connection may stay silent
+TIMEOUT = 120
+# seconds given to the requests in progress when a worker stops
+GRACEFUL_TIMEOUT = 30
+BACKLOG = 128
+# seconds a new worker has to load the application
+READY_TIMEOUT = 60
+# seconds before replacing a crashed worker, doubled on each failure in a
+# row to load the application, up to MAX_BACKOFF
+BACKOFF = 1
+MAX_BACKOFF = 60
+# failures in a row after which the supervisor gives up
+CRASH_LIMIT = 10
+
+
+class RequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.info('%s - %s' % (self.client_address[0], format % args))
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server accepting the connections in the calling thread and
+    handling them in a fixed pool of threads."""
+
+    def __init__(self, sock, app, threads=THREADS, timeout=TIMEOUT):
+        WSGIServer.__init__(self, sock.getsockname()[:2], RequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        self.timeout = timeout
+        self._requests = Queue()
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._work,
+                                 name='managesf-worker-%s' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.timeout)
+        self._requests.put((request, client_address))
+
+    def stop(self, timeout=GRACEFUL_TIMEOUT):
+        """stops accepting connections and waits for the ones accepted to
+        be served. To be called from another thread than serve_forever"""
+        self.shutdown()
+        for t in self._threads:
+            self._requests.put(None)
+        deadline = time.time() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time.time()))
+        busy = len([t for t in self._threads if t.is_alive()])
+        if busy:
+            logger.warning('%s request(s) still running, exiting' % busy)
+
+
+def listen(host, port, backlog=BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def serve(sock, load_app, threads=THREADS, timeout=TIMEOUT,
+          graceful_timeout=GRACEFUL_TIMEOUT, ready=None):
+    """serves the application on sock until SIGTERM or SIGINT. ready is
+    called once the application is loaded"""
+    server = ThreadPoolWSGIServer(sock, load_app(), threads, timeout)
+    if ready is not None:
+        ready()
+
+    def stop(signum, frame):
+        # serve_forever runs in this thread, it cannot wait for itself
+        threading.Thread(target=server.stop,
+                         args=(graceful_timeout, )).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    server.stop(graceful_timeout)
+
+
+class Supervisor(object):
+    """forks and watches the workers serving the listening socket"""
+
+    def __init__(self, sock, load_app, workers=WORKERS, threads=THREADS,
+                 timeout=TIMEOUT, graceful_timeout=GRACEFUL_TIMEOUT,
+                 ready_timeout=READY_TIMEOUT, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, crash_limit=CRASH_LIMIT):
+        self.sock = sock
+        self.load_app = load_app
+        self.workers = workers
+        self.threads = threads
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.ready_timeout = ready_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.crash_limit = crash_limit
+        self.children = set()
+        # workers asked to stop, not to be replaced
+        self.retiring = set()
+        # replacements in a row that failed to load the application
+        self.failures = 0
+        self._reload = False
+        self._stop = False
+
+    def spawn(self):
+        """forks a worker, returns its pid and the pipe it writes to once
+        the application is loaded"""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(w)
+            self.children.add(pid)
+            return pid, r
+        os.close(r)
+        status = 0
+
+        def ready():
+            os.write(w, b'1')
+            os.close(w)
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            serve(self.sock, self.load_app, self.threads, self.timeout,
+                  self.graceful_timeout, ready)
+        except Exception:
+            logger.exception('worker %s failed' % os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def wait_ready(self, spawned):
+        """waits for the spawned workers to load the application, the
+        ones that fail to are stopped. Returns the pids of the others"""
+        pending = dict((r, pid) for pid, r in spawned)
+        ready = set()
+        deadline = time.time() + self.ready_timeout
+        while pending and not self._stop:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            try:
+                readable = select.select(list(pending), [], [], left)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for r in readable:
+                worker = pending.pop(r)
+                # nothing to read means the worker exited before being ready
+                if os.read(r, 1):
+                    ready.add(worker)
+                os.close(r)
+        for r in pending:
+            os.close(r)
+        failed = [pid for pid, r in spawned if pid not in ready]
+        if failed:
+            logger.error('worker(s) %s failed to load the application' %
+                         ', '.join(str(pid) for pid in failed))
+            self.kill(failed)
+        return ready
+
+    def start(self, count):
+        """starts count workers, returns how many loaded the application"""
+        return len(self.wait_ready([self.spawn() for i in range(count)]))
+
+    def replace(self):
+        """replaces a crashed worker, waiting longer on each failure in a
+        row of the replacements to load the application"""
+        while not self._stop and not self._reload:
+            if self.failures:
+                if self.failures >= self.crash_limit:
+                    logger.error('%s workers failed in a row, stopping' %
+                                 self.failures)
+                    self._stop = True
+                    return
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (self.failures - 1))
+                logger.info('replacing the worker in %s second(s)' % delay)
+                self.sleep(delay)
+                if self._stop or self._reload:
+                    return
+            if self.start(1):
+                self.failures = 0
+                return
+            self.failures += 1
+
+    def sleep(self, delay):
+        deadline = time.time() + delay
+        while not self._stop and not self._reload and time.time() < deadline:
+            time.sleep(min(0.5, max(0, deadline - time.time())))
+
+    def kill(self, pids):
+        for pid in pids:
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def on_reload(self, signum, frame):
+        self._reload = True
+
+    def on_stop(self, signum, frame):
+        self._stop = True
+
+    def reload(self):
+        """starts a new generation of workers, the old one is only stopped
+        if every new worker loaded the application"""
+        logger.info('reloading the workers')
+        old = self.children - self.retiring
+        if self.start(self.workers) == self.workers:
+            self.failures = 0
+            self.kill(old)
+            return
+        logger.error('keeping the running workers')
+        self.kill(self.children - old)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_reload)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        missing = self.workers - self.start(self.workers)
+        if missing == self.workers:
+            logger.error('no worker could load the application')
+            self._stop = True
+        elif missing:
+            self.failures = 1
+            for i in range(missing):
+                self.replace()
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self.reload()
+                continue
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.children:
+                self.children.discard(pid)
+                if pid in self.retiring:
+                    self.retiring.discard(pid)
+                elif not self._stop:
+                    msg = 'worker %s exited (%s), restarting'
+                    logger.error(msg % (pid, status))
+                    self.replace()
+        self.kill(self.children)
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+                self.children.discard(pid)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                if e.errno != errno.EINTR:
+                    raise
@@ -105,6 +105,13 @@ class UserManager(BaseCRUDManager):
         """Update operation"""
         raise exc.UnavailableActionError()
 
+    def delete_many(self, emails=None, usernames=None):
+        """Delete operation on several users, found by email or username"""
+        for email in emails or []:
+            self.delete(email=email)
+        for username in usernames or []:
+            self.delete(username=username)
+
 
 @six.add_metaclass(abc.ABCMeta)
 class GroupManager(BaseCRUDManager):
@@ -238,7 +245,7 @@ class ImageManager(BaseCRUDManager):
         """updates (rebuild) the image image_name on provider provider_name"""
         raise exc.UnavailableActionError()
 
-    def get_update_info(self, id):
+    def get_update_info(self, id, offset=None):
         """fetches relevant info on an image update possibly still
         in progress"""
         raise exc.UnavailableActionError()
@@ -43,3 +43,22 @@ class UpdateGroupException(Exception):
 class GroupNotFoundException(Exception):
     """Raised if a group lookup failed"""
     pass
+
+
+class InvalidParameterError(ValueError):
+    """Raised if a parameter of the requested action is invalid"""
+    pass
+
+
+class ServiceTimeoutError(Exception):
+    """Raised if a service did not answer in time"""
+    pass
+
+
+class ServicesError(Exception):
+    """Raised if an action failed on one or several services"""
+    def __init__(self, errors):
+        self.errors = errors
+        msg = '; '.join('%s: %s' % (name, errors[name])
+                        for name in sorted(errors))
+        super(ServicesError, self).__init__(msg)
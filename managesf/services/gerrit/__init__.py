@@ -16,11 +16,13 @@
 
 
 import logging
+import threading
 import time
 
 from pysflib.sfgerrit import GerritUtils
 from pysflib.sfauth import get_cookie
 from requests.auth import HTTPBasicAuth
+from requests.exceptions import HTTPError
 
 from managesf.services import base
 from managesf.services.gerrit import project
@@ -48,11 +50,74 @@ class Gerrit(base.BaseCodeReviewServicePlugin):
         raise NotImplementedError
 
 
-ADMIN_COOKIE = None
-ADMIN_COOKIE_DATE = 0
 COOKIE_VALIDITY = 60
 
 
+class GerritClientPool(object):
+    """The Gerrit REST clients shared by the threads of the process.
+
+    A client, and the connections it keeps, is reused as long as its
+    credentials are valid. The admin cookie is renewed when it expires or
+    when Gerrit rejects it, by one thread: the others wait for the new
+    cookie instead of requesting theirs from cauth."""
+
+    def __init__(self, url, get_cookie, validity=COOKIE_VALIDITY):
+        self.url = url
+        self.get_cookie = get_cookie
+        self.validity = validity
+        # requests served with the current cookie, and cookie renewals
+        self.hits = 0
+        self.misses = 0
+        self._client = None
+        self._date = 0
+        self._lock = threading.Lock()
+
+    def get(self, stale=None):
+        """returns the client of the admin cookie, renewed if it expired
+        or if stale (a client Gerrit rejected) is still the current one"""
+        with self._lock:
+            if self._client is None or self._client is stale or \
+               time.time() - self._date > self.validity:
+                self.misses += 1
+                self._client = GerritUtils(self.url,
+                                           auth_cookie=self.get_cookie())
+                self._date = time.time()
+            else:
+                self.hits += 1
+            return self._client
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class PooledGerritClient(object):
+    """Proxy to the client of a pool, calls rejected with a 401 are retried
+    once with a renewed cookie"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        if not callable(getattr(GerritUtils, name, None)):
+            return getattr(self.pool.get(), name)
+
+        def call(*args, **kwargs):
+            client = self.pool.get()
+            try:
+                return getattr(client, name)(*args, **kwargs)
+            except HTTPError as e:
+                if getattr(e.response, 'status_code', None) != 401:
+                    raise
+                logger.debug('[gerrit] admin cookie rejected, renewing it')
+                client = self.pool.get(stale=client)
+                return getattr(client, name)(*args, **kwargs)
+        return call
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
 class SoftwareFactoryGerrit(Gerrit):
     """"""
 
@@ -62,32 +127,40 @@ class SoftwareFactoryGerrit(Gerrit):
         self.user = user.SFGerritUserManager(self)
         self.review = review.SFGerritReviewManager(self)
         self.group = group.SFGerritGroupManager(self)
+        self._basic_client = None
+
+    def get_pool(self):
+        """returns the client pool of this Gerrit, shared by the plugin
+        instances of the process"""
+        url = self.conf['url']
+        with _pools_lock:
+            if url not in _pools:
+                c = self._full_conf
+
+                def admin_cookie():
+                    return get_cookie(c.auth['host'], c.admin['name'],
+                                      c.admin['http_password'])
+                _pools[url] = GerritClientPool(url, admin_cookie)
+            return _pools[url]
 
     def get_client(self, cookie=None):
         if not cookie:
+            if self._basic_client is not None:
+                return self._basic_client
             try:
                 basic = HTTPBasicAuth(self.conf['admin_user'],
                                       'password')
                 msg = '[%s] using direct basic auth to connect to gerrit'
                 logger.debug(msg % self.service_name)
-                g = GerritUtils(self.conf['url'] + 'api',
-                                auth=basic)
-                return g
+                self._basic_client = GerritUtils(self.conf['url'] + 'api',
+                                                 auth=basic)
+                return self._basic_client
             except Exception as e:
                 # if we can't get the admin credentials from the config,
                 # let's not panic
                 msg = ('[%s] simple auth raised error: %s, '
                        'going with SF cauth-based authentication')
                 logger.debug(msg % (self.service_name, e))
-            # Use an admin cookie
-            if int(time.time()) - globals()['ADMIN_COOKIE_DATE'] > \
-                    globals()['COOKIE_VALIDITY']:
-                cookie = get_cookie(self._full_conf.auth['host'],
-                                    self._full_conf.admin['name'],
-                                    self._full_conf.admin['http_password'])
-                globals()['ADMIN_COOKIE'] = cookie
-                globals()['ADMIN_COOKIE_DATE'] = int(time.time())
-            else:
-                cookie = globals()['ADMIN_COOKIE']
+            return PooledGerritClient(self.get_pool())
         return GerritUtils(self.conf['url'],
                            auth_cookie=cookie)
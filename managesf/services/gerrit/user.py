@@ -27,6 +27,11 @@ from managesf.services import exceptions as exc
 logger = logging.getLogger(__name__)
 
 
+# caches holding the accounts, flushed once they are deleted
+ACCOUNT_CACHES = ('accounts', 'accounts_byemail', 'accounts_byname',
+                  'groups_members')
+
+
 class SFGerritUserManager(base.UserManager):
 
     _immutable_fields_ = ['username', ]
@@ -159,13 +164,51 @@ class SFGerritUserManager(base.UserManager):
             msg = u"[%s] Could not delete user %s in base: %s"
             logger.debug(msg % (self.plugin.service_name,
                                 email or username, unicode(e)))
-        # flush gerrit caches
-        ge = G.Gerrit(self.plugin.conf['host'],
-                      self.plugin._full_conf.admin['name'],
-                      keyfile=self.plugin.conf['sshkey_priv_path'])
-        for cache in ('accounts', 'accounts_byemail', 'accounts_byname',
-                      'groups_members'):
-            ge._ssh('gerrit flush-caches --cache %s' % cache)
+        self._flush_caches()
         logger.debug(u'[%s] %s (id %s) deleted' % (self.plugin.service_name,
                                                    email or username,
                                                    account_id))
+
+    def delete_many(self, emails=None, usernames=None):
+        """deletes the accounts in one transaction, then flushes the gerrit
+        caches once. Returns the ids of the deleted accounts"""
+        queries = [{'email': e} for e in emails or []] + \
+                  [{'username': u} for u in usernames or []]
+        ids = set()
+        for query in queries:
+            account_id = self.get(**query)
+            if not account_id:
+                msg = u'[%s] %s not found, skip deletion'
+                logger.debug(msg % (self.plugin.service_name,
+                                    query.values()[0]))
+                continue
+            ids.add(int(account_id))
+        if not ids:
+            return []
+        ids = sorted(ids)
+        in_ids = ', '.join(str(i) for i in ids)
+        try:
+            for table in ('account_group_members', 'accounts',
+                          'account_external_ids'):
+                self.session.execute("DELETE FROM %s "
+                                     "WHERE account_id IN (%s);" % (table,
+                                                                    in_ids))
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            msg = u"[%s] Could not delete users %s in base: %s"
+            logger.error(msg % (self.plugin.service_name,
+                                in_ids, unicode(e)))
+            raise
+        self._flush_caches()
+        logger.debug(u'[%s] %s users deleted (ids %s)' % (
+                     self.plugin.service_name, len(ids), in_ids))
+        return ids
+
+    def _flush_caches(self):
+        # one command, so one SSH connection
+        ge = G.Gerrit(self.plugin.conf['host'],
+                      self.plugin._full_conf.admin['name'],
+                      keyfile=self.plugin.conf['sshkey_priv_path'])
+        ge._ssh('gerrit flush-caches %s' % ' '.join(
+                '--cache %s' % cache for cache in ACCOUNT_CACHES))
@@ -17,43 +17,108 @@
 
 import os
 import re
-# import shutil
+import atexit
+import shutil
 import shlex
+import signal
 import stat
 import logging
 import tempfile
+import threading
 import subprocess
 
 
 logger = logging.getLogger(__name__)
 
 
+# seconds a command may run, overridable with gerrit.exec_timeout
+EXEC_TIMEOUT = 600
+# git subcommands talking to a remote over SSH
+REMOTE_GIT_COMMANDS = ('clone', 'fetch', 'push', 'ls-remote', 'review')
+# seconds an idle shared SSH connection is kept open, overridable with
+# gerrit.ssh_control_persist
+CONTROL_PERSIST = 60
+
+_ssh_limiter = None
+_ssh_limiter_lock = threading.Lock()
+_ssh_wrappers = {}
+_ssh_wrappers_lock = threading.Lock()
+_ssh_masters_lock = threading.Lock()
+
+
 class LocalProcessError(Exception):
     pass
 
 
-def _exec(cmd, cwd=None, env=None):
+class _NoLimit(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+def _exec(cmd, cwd=None, env=None, timeout=EXEC_TIMEOUT, limiter=None):
+    """runs cmd in cwd and returns its output. It is killed if it runs for
+    more than timeout seconds. limiter is an optional semaphore (or any
+    context manager) bounding the number of commands run at once"""
     cmd = shlex.split(cmd)
-    ocwd = os.getcwd()
-    if cwd:
-        os.chdir(cwd)
     if not env:
         env = os.environ.copy()
-    try:
-        std_out = subprocess.check_output(cmd, env=env, cwd=cwd,
-                                          stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as err:
+    if limiter is None:
+        limiter = _NoLimit()
+    with limiter:
+        # close_fds: another thread's child must not inherit our pipes.
+        # The command runs in a process group of its own, killed as a
+        # whole on timeout: its children (git's ssh) share the pipe
+        p = subprocess.Popen(cmd, env=env, cwd=cwd, close_fds=True,
+                             preexec_fn=os.setsid,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+        try:
+            std_out, _ = p.communicate()
+        finally:
+            timer.cancel()
+    if timed_out:
+        msg = u'"%s" timed out after %ss: %s' % (' '.join(cmd), timeout,
+                                                 std_out)
+        logger.error(msg)
+        raise LocalProcessError(msg)
+    if p.returncode:
         msg = u'"%s" failed with error code %s: %s'
-        msg = msg % (' '.join(cmd), err.returncode, err.output)
-        logger.exception(msg)
+        msg = msg % (' '.join(cmd), p.returncode, std_out)
+        logger.error(msg)
         raise LocalProcessError(msg)
 
     logger.info("[gerrit] cmd %s output" % cmd)
     logger.info(std_out)
-    os.chdir(ocwd)
     return std_out
 
 
+def get_ssh_limiter(conf):
+    """returns the semaphore shared by the git operations over SSH, of
+    gerrit.ssh_concurrency slots. None if it is not set (no limit)"""
+    global _ssh_limiter
+    size = int(conf.gerrit.get('ssh_concurrency') or 0)
+    if not size:
+        return None
+    with _ssh_limiter_lock:
+        if _ssh_limiter is None:
+            _ssh_limiter = threading.BoundedSemaphore(size)
+        return _ssh_limiter
+
+
 def ssh_wrapper_setup(filename):
     ssh_wrapper = "ssh -o StrictHostKeyChecking=no -i %s \"$@\"" % filename
     wrapper_path = os.path.join(tempfile.mkdtemp(), 'ssh_wrapper.sh')
@@ -62,6 +127,86 @@ def ssh_wrapper_setup(filename):
     return wrapper_path
 
 
+def get_ssh_wrapper(ssh_key, control_persist=CONTROL_PERSIST):
+    """returns the GIT_SSH wrapper of ssh_key shared by the process. The
+    connections it opens to a host go through the master connection
+    started by start_ssh_master, if there is one, kept control_persist
+    seconds once idle. The masters and the wrapper are removed when the
+    process exits"""
+    key = (os.getpid(), ssh_key)
+    with _ssh_wrappers_lock:
+        if key not in _ssh_wrappers:
+            tmpdir = tempfile.mkdtemp(prefix='managesf-ssh-')
+            options = ['-o', 'StrictHostKeyChecking=no', '-i', ssh_key,
+                       '-o', 'ControlPath=%s' % os.path.join(tmpdir,
+                                                             '%r@%h:%p'),
+                       '-o', 'ControlPersist=%s' % control_persist]
+            # the wrapper never starts a master itself: it would stay in
+            # the background with the stderr of git, captured by _exec
+            ssh_wrapper = "#!/bin/sh\nssh %s -o ControlMaster=no \"$@\"\n" % (
+                ' '.join(options))
+            wrapper_path = os.path.join(tmpdir, 'ssh_wrapper.sh')
+            file(wrapper_path, 'w').write(ssh_wrapper)
+            os.chmod(wrapper_path, stat.S_IRWXU)
+            _ssh_wrappers[key] = (wrapper_path, options)
+        return _ssh_wrappers[key][0]
+
+
+def start_ssh_master(wrapper_path, user, host, port):
+    """starts the master connection of the wrapper to user@host:port,
+    unless it is running already. It runs in a session of its own, with
+    its standard streams on /dev/null"""
+    with _ssh_wrappers_lock:
+        options = [o for path, o in _ssh_wrappers.values()
+                   if path == wrapper_path]
+    if not options:
+        return
+    options = options[0]
+    tmpdir = os.path.dirname(wrapper_path)
+    control_path = os.path.join(tmpdir, '%s@%s:%s' % (user, host, port))
+    destination = ['-p', str(port), '%s@%s' % (user, host)]
+    with _ssh_masters_lock:
+        with open(os.devnull, 'r+') as devnull:
+            if os.path.exists(control_path) and not subprocess.call(
+                    ['ssh'] + options + ['-O', 'check'] + destination,
+                    stdin=devnull, stdout=devnull, stderr=devnull,
+                    close_fds=True):
+                return
+            # ssh -f returns once the master is connected
+            code = subprocess.call(
+                ['ssh'] + options + ['-o', 'ConnectTimeout=30',
+                                     '-fNM'] + destination,
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+        if code:
+            # the commands connect on their own, and report the error
+            logger.warning('[gerrit] could not start the SSH master '
+                           'connection to %s:%s (%s)' % (host, port, code))
+
+
+def close_ssh_wrappers():
+    """stops the master connections of the shared wrappers and removes
+    them. The wrappers inherited from a parent process are left to it"""
+    pid = os.getpid()
+    with _ssh_wrappers_lock:
+        for key in [k for k in _ssh_wrappers if k[0] == pid]:
+            tmpdir = os.path.dirname(_ssh_wrappers.pop(key)[0])
+            for name in os.listdir(tmpdir):
+                path = os.path.join(tmpdir, name)
+                if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                    continue
+                with open(os.devnull, 'w') as devnull:
+                    # the destination is ignored, the socket names the host
+                    subprocess.call(['ssh', '-o', 'ControlPath=%s' % path,
+                                     '-O', 'exit', 'gerrit'],
+                                    stdout=devnull, stderr=devnull,
+                                    close_fds=True)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+atexit.register(close_ssh_wrappers)
+
+
 def set_gitssh_wrapper_from_str(ssh_key):
     tmpf = tempfile.NamedTemporaryFile(delete=False)
     tmpf.close()
@@ -91,7 +236,9 @@ class GerritRepo(object):
                      {'admin': self.conf.admin['name'],
                       'email': self.conf.admin['email']}
         ssh_key = self.conf.gerrit['sshkey_priv_path']
-        self.wrapper_path = ssh_wrapper_setup(ssh_key)
+        self.wrapper_path = get_ssh_wrapper(
+            ssh_key, self.conf.gerrit.get('ssh_control_persist',
+                                          CONTROL_PERSIST))
         self.env = os.environ.copy()
         self.env['GIT_SSH'] = self.wrapper_path
         # Commit will be reject by gerrit if the commiter info
@@ -100,9 +247,20 @@ class GerritRepo(object):
         self.env['GIT_COMMITTER_EMAIL'] = self.conf.admin['email']
         # This var is used by git-review to set the remote via git review -s
         self.env['USERNAME'] = self.conf.admin['name']
+        self.timeout = int(self.conf.gerrit.get('exec_timeout',
+                                                EXEC_TIMEOUT))
 
     def _exec(self, cmd):
-        return _exec(cmd, cwd=self.infos['localcopy_path'], env=self.env)
+        args = cmd.split()
+        limiter = None
+        if len(args) > 1 and args[0] == 'git' and \
+           args[1] in REMOTE_GIT_COMMANDS:
+            limiter = get_ssh_limiter(self.conf)
+            start_ssh_master(self.wrapper_path, self.conf.admin['name'],
+                             self.conf.gerrit['host'],
+                             self.conf.gerrit['ssh_port'])
+        return _exec(cmd, cwd=self.infos['localcopy_path'], env=self.env,
+                     timeout=self.timeout, limiter=limiter)
 
     def clone(self):
         logger.info("[gerrit] Clone repository %s" % self.prj_name)
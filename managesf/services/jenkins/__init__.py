@@ -15,9 +15,10 @@
 # under the License.
 
 
-from jenkins import Jenkins
+import threading
 
 from managesf.services import base
+from managesf.services.jenkins import client
 from managesf.services.jenkins import job
 
 
@@ -39,8 +40,19 @@ class SoftwareFactoryJenkins(_Jenkins):
     def __init__(self, conf):
         super(SoftwareFactoryJenkins, self).__init__(conf)
         self.job = job.SFJenkinsJobManager(self)
+        self._client = None
+        self._client_lock = threading.Lock()
 
     def get_client(self, *args, **kwargs):
-        return Jenkins(url=self.conf['api_url'],
-                       username=self.conf['user'],
-                       password=self.conf['password'])
+        # The client is shared: it keeps its connections and crumb
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = client.SFJenkinsClient(
+                        url=self.conf['api_url'],
+                        username=self.conf['user'],
+                        password=self.conf['password'],
+                        timeout=self.conf.get('timeout'),
+                        pool_size=int(self.conf.get('pool_size',
+                                                    client.POOL_SIZE)))
+        return self._client
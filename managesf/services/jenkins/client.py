@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 Red Hat <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.error import HTTPError
+
+from jenkins import Jenkins
+from jenkins import JenkinsException, NotFoundException, TimeoutException
+
+
+logger = logging.getLogger(__name__)
+
+
+POOL_SIZE = 10
+# sent by the Jenkins CSRF filter as the reason and body of its 403
+INVALID_CRUMB = 'No valid crumb was included in the request'
+
+
+class SFJenkinsClient(Jenkins):
+    """Jenkins client sending its requests through a keep-alive session.
+
+    One instance is meant to be shared by every thread of the process: the
+    HTTP connections are pooled and the crumb is fetched once, then
+    refreshed when Jenkins rejects it as invalid."""
+    def __init__(self, url, username=None, password=None, timeout=None,
+                 pool_size=POOL_SIZE):
+        super(SFJenkinsClient, self).__init__(url, username, password)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._crumb_lock = threading.Lock()
+
+    def maybe_add_crumb(self, req):
+        with self._crumb_lock:
+            super(SFJenkinsClient, self).maybe_add_crumb(req)
+
+    def _session_open(self, req, add_crumb):
+        if self.auth:
+            req.add_header('Authorization', self.auth)
+        if add_crumb:
+            self.maybe_add_crumb(req)
+        try:
+            return self.session.request(req.get_method(),
+                                        req.get_full_url(),
+                                        data=req.get_data(),
+                                        headers=dict(req.header_items()),
+                                        timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise TimeoutException('Error in request: %s' % e)
+        except requests.exceptions.RequestException as e:
+            raise JenkinsException('Error in request: %s' % e)
+
+    def _invalid_crumb(self, response):
+        """tells if a 403 was caused by the crumb, not by a permission"""
+        reason = response.reason or ''
+        content = response.content or b''
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        return (INVALID_CRUMB in reason or
+                INVALID_CRUMB.encode('utf-8') in content)
+
+    def jenkins_open(self, req, add_crumb=True):
+        response = self._session_open(req, add_crumb)
+        if (response.status_code == 403 and add_crumb and self.crumb and
+                self._invalid_crumb(response)):
+            # The crumb may have expired (Jenkins restart, session timeout)
+            msg = u'request to %s refused, refreshing the crumb'
+            logger.debug(msg % req.get_full_url())
+            with self._crumb_lock:
+                self.crumb = None
+            response = self._session_open(req, add_crumb)
+        if response.status_code in (401, 403, 500):
+            raise JenkinsException(
+                'Error in request. ' +
+                'Possibly authentication failed [%s]: %s' % (
+                    response.status_code, response.reason))
+        if response.status_code == 404:
+            raise NotFoundException('Requested item could not be found')
+        if response.status_code >= 400:
+            raise HTTPError(req.get_full_url(), response.status_code,
+                            response.reason, response.headers, None)
+        return response.content.decode('utf-8')
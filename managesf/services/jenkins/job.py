@@ -16,41 +16,66 @@
 
 
 import logging
+import threading
+import time
 import urllib
 import urlparse
 
+from collections import OrderedDict
+
+from jenkins import NotFoundException
+
 from managesf.services import base
+from managesf.services import exceptions
 
 
 logger = logging.getLogger(__name__)
 
 
-GROOVY_JOB_FILTER = """import hudson.model.*
-def matchedJobs = Jenkins.instance.items.findAll { job ->
-    job.name == "%(JOB_NAME)s"
-}
+# Fetch number, status and parameters of the builds in a single query
+# instead of one get_build_info call per build. The optional range
+# ({M,N} url-encoded) lets Jenkins page through allBuilds server side.
+BUILDS_TREE = ('?tree=allBuilds[number,result,building,'
+               'actions[parameters[name,value]]]%(range)s')
+
+# Finished builds never change, they are kept until evicted by newer
+# entries. Builds in progress are only reused for a few seconds.
+BUILD_CACHE_SIZE = 512
+BUILD_CACHE_TTL = 5
+
 
-buildIds = ""
+class BuildInfoCache(object):
+    """Thread-safe LRU cache of build info, keyed by (job name, build id)"""
+    def __init__(self, size=BUILD_CACHE_SIZE, ttl=BUILD_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-matchedJobs.each { item ->
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            build_info, expires = entry
+            if expires is not None and expires < time.time():
+                return None
+            self._entries[key] = entry
+            return build_info
 
-    def builds = item.getBuilds()
+    def set(self, key, build_info):
+        expires = None
+        if build_info.get('building') or build_info.get('result') is None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (build_info, expires)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
 
-    builds.each { build ->
-        def params = build.getBuildVariables()
-        def status = build.getBuildStatusSummary().message
-        def change = params.get('ZUUL_CHANGE')
-        def patchset = params.get('ZUUL_PATCHSET')
-        if ( %(FILTER_CONDITION)s ) {
-            if (buildIds == "") {
-                buildIds = "${build.number}"
-            } else {
-                buildIds = "${buildIds} ${build.number}"
-            }
-        }
-    }
-}
-return buildIds"""
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
 
 
 class SFJenkinsJobManager(base.JobManager):
@@ -61,9 +86,12 @@ class SFJenkinsJobManager(base.JobManager):
     repository."""
     def __init__(self, plugin):
         super(SFJenkinsJobManager, self).__init__(plugin)
+        self.builds_cache = BuildInfoCache(
+            size=int(plugin.conf.get('build_cache_size', BUILD_CACHE_SIZE)),
+            ttl=int(plugin.conf.get('build_cache_ttl', BUILD_CACHE_TTL)))
 
-    def get_job(self, job_name, job_id=None,
-                change=None, patchset=None, **kwargs):
+    def get_job(self, job_name, job_id=None, change=None, patchset=None,
+                limit=None, offset=None, **kwargs):
         """lists one or several jobs depending on filtering with kwargs."""
         # TODO(mhu) add more filtering options depending on demand and needs
         if not job_name:
@@ -75,39 +103,77 @@ class SFJenkinsJobManager(base.JobManager):
         if job_id:
             job = self.get_job_status(job_name, int(job_id))
             return [job, ]
-        # use some filtering
-        filter = {"JOB_NAME": job_name, }
-        filter_condition = []
-        if change:
-            filter_condition.append('change == "%s"' % change)
-        if patchset:
-            filter_condition.append('patchset == "%s"' % patchset)
-        if filter_condition:
-            filter["FILTER_CONDITION"] = " && ".join(filter_condition)
-        else:
-            # Get all of the jobs
-            filter["FILTER_CONDITION"] = "1 == 1"
+        limit = self._get_paging_value('limit', limit)
+        offset = self._get_paging_value('offset', offset) or 0
+        # Without filters the paging can be delegated to Jenkins
+        builds_range = ''
+        if not change and limit is not None:
+            builds_range = urllib.quote('{%i,%i}' % (offset, offset + limit))
+        elif not change and offset:
+            builds_range = urllib.quote('{%i,}' % offset)
         client = self.plugin.get_client()
-        msg = u'[%s] querying jobs with filter: %r'
+        msg = u'[%s] querying jobs %s with change %s, patchset %s'
         logger.debug(msg % (self.plugin.service_name,
-                            filter))
-        script = urllib.quote_plus(GROOVY_JOB_FILTER % filter)
-        results = client.run_script(script)
-        # strip prefix and trailing \n
-        if results.startswith("Result: "):
-            if results.endswith('\n'):
-                results = results[:-1]
-            results = [u for u in results[len("Result: "):].split(" ")
-                       if u != '']
-        else:
+                            job_name, change, patchset))
+        try:
+            info = client.get_info(item='job/%s' % urllib.quote(job_name),
+                                   query=BUILDS_TREE % {
+                                       'range': builds_range})
+        except NotFoundException:
+            # an unknown job has no builds
             return []
-        return [self.get_job_status(job_name, int(i)) for i in results]
+        jobs = []
+        for build in info.get('allBuilds') or []:
+            params = {}
+            for a in build.get('actions') or []:
+                for p in (a or {}).get('parameters') or []:
+                    params[p.get('name')] = p.get('value')
+            if change and params.get('ZUUL_CHANGE') != str(change):
+                continue
+            if patchset and params.get('ZUUL_PATCHSET') != str(patchset):
+                continue
+            jobs.append(self._get_build_status(job_name, build))
+        if change:
+            jobs = jobs[offset:]
+            if limit is not None:
+                jobs = jobs[:limit]
+        return jobs
+
+    def _get_paging_value(self, name, value):
+        if value is None or value == '':
+            return None
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            number = -1
+        if number < 0:
+            raise exceptions.InvalidParameterError(
+                "Invalid %s value: %s" % (name, value))
+        return number
+
+    def _get_build_status(self, job_name, build_info):
+        status = {'job_name': job_name,
+                  'job_id': build_info.get('number'),
+                  'status': None}
+        if build_info.get('building'):
+            status['status'] = 'IN_PROGRESS'
+        else:
+            status['status'] = build_info.get('result')
+        return status
+
+    def _get_build_info(self, job_name, job_id):
+        key = (job_name, int(job_id))
+        build_info = self.builds_cache.get(key)
+        if build_info is None:
+            client = self.plugin.get_client()
+            build_info = client.get_build_info(job_name, int(job_id))
+            self.builds_cache.set(key, build_info)
+        return build_info
 
     def get_job_parameters(self, job_name, job_id):
         """get parameters used to run a job"""
-        client = self.plugin.get_client()
         try:
-            actions = client.get_build_info(job_name, int(job_id))['actions']
+            actions = self._get_build_info(job_name, job_id)['actions']
             params = {}
             for a in actions:
                 if a.get('parameters'):
@@ -129,28 +195,24 @@ class SFJenkinsJobManager(base.JobManager):
 
     def get_job_status(self, job_name, job_id):
         """get a job's current status. Does not account for queued jobs"""
-        client = self.plugin.get_client()
         status = {'job_name': job_name,
                   'job_id': job_id,
                   'status': None}
         try:
-            build_info = client.get_build_info(job_name, int(job_id))
-            if build_info.get('building'):
-                status['status'] = 'IN_PROGRESS'
-            else:
-                status['status'] = build_info.get('result')
+            build_info = self._get_build_info(job_name, job_id)
         except Exception:
             raise
+        status['status'] = self._get_build_status(job_name,
+                                                  build_info)['status']
         return status
 
     def get_job_logs(self, job_name, job_id):
         """get logs of a finished job"""
-        client = self.plugin.get_client()
         status = {'job_name': job_name,
                   'job_id': job_id,
                   'logs_url': None}
         try:
-            build_info = client.get_build_info(job_name, int(job_id))
+            build_info = self._get_build_info(job_name, job_id)
             status['logs_url'] = build_info.get('url')
             if status['logs_url']:
                 logs_suffix = "timestamps/?time=MMM+dd+HH:mm:ss.SSS&appendLog"
@@ -196,6 +258,7 @@ class SFJenkinsJobManager(base.JobManager):
         """stop a running job"""
         client = self.plugin.get_client()
         client.stop_build(job_name, int(job_id))
+        self.builds_cache.invalidate((job_name, int(job_id)))
         msg = u'[%s] job stopped manually: %s/%s'
         logger.debug(msg % (self.plugin.service_name,
                             job_name, job_id))
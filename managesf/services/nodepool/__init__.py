@@ -14,10 +14,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import paramiko
-
 from managesf.services import base
-from managesf.services.nodepool import node, image
+from managesf.services.nodepool import client, node, image
 
 
 class _Nodepool(base.BaseAgentProviderServicePlugin):
@@ -47,12 +45,12 @@ class SoftwareFactoryNodepool(_Nodepool):
         super(SoftwareFactoryNodepool, self).__init__(conf)
         self.node = node.SFNodepoolNodeManager(self)
         self.image = image.SFNodepoolImageManager(self)
+        self.client = client.SFNodepoolClient(
+            host=self.conf['host'],
+            user=self.conf['user'],
+            key=self.conf['key'],
+            keepalive=int(self.conf.get('keepalive', client.KEEPALIVE)))
 
     def get_client(self, *args, **kwargs):
-        k = paramiko.RSAKey.from_private_key_file(self.conf['key'])
-        c = paramiko.SSHClient()
-        c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        c.connect(hostname=self.conf['host'],
-                  username=self.conf['user'],
-                  pkey=k)
-        return c
+        """returns the SSH connection shared by the plugin's managers"""
+        return self.client
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 Red Hat <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import logging
+import socket
+import threading
+
+import paramiko
+
+
+logger = logging.getLogger(__name__)
+
+
+# seconds between two keepalive packets on an idle connection
+KEEPALIVE = 30
+
+
+class SFNodepoolClient(object):
+    """Persistent SSH connection to the nodepool host.
+
+    The connection is opened on first use and shared by every caller and
+    thread: each command runs in its own channel over the same transport.
+    The transport is checked before each command and reopened if it died.
+    Only read-only commands are retried when the transport fails while
+    they are sent."""
+
+    def __init__(self, host, user, key, keepalive=KEEPALIVE):
+        self.host = host
+        self.user = user
+        self.key = key
+        self.keepalive = keepalive
+        self._pkey = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_pkey(self):
+        if self._pkey is None:
+            self._pkey = paramiko.RSAKey.from_private_key_file(self.key)
+        return self._pkey
+
+    def _is_alive(self):
+        if self._client is None:
+            return False
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _close(self):
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception as e:
+                logger.debug("[nodepool] error closing connection: %s" % e)
+            self._client = None
+
+    def get_connection(self):
+        with self._lock:
+            if not self._is_alive():
+                self._close()
+                logger.debug("[nodepool] connecting to %s@%s" % (self.user,
+                                                                 self.host))
+                c = paramiko.SSHClient()
+                c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                c.connect(hostname=self.host,
+                          username=self.user,
+                          pkey=self._get_pkey())
+                transport = c.get_transport()
+                if transport is not None:
+                    transport.set_keepalive(self.keepalive)
+                self._client = c
+            return self._client
+
+    def exec_command(self, command, read_only=False, **kwargs):
+        """Runs command over the shared connection. The connection is
+        reopened and the command retried after a transport error only if
+        read_only, as the command may have run on the remote side."""
+        client = self.get_connection()
+        try:
+            return client.exec_command(command, **kwargs)
+        except (paramiko.SSHException, socket.error, EOFError) as e:
+            # the connection may have dropped since the health check
+            with self._lock:
+                if self._client is client:
+                    self._close()
+            if not read_only:
+                raise
+            logger.debug("[nodepool] reconnecting after error: %s" % e)
+            return self.get_connection().exec_command(command, **kwargs)
+
+    def close(self):
+        with self._lock:
+            self._close()
@@ -15,10 +15,18 @@
 # under the License.
 
 
+import logging
 import re
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
 
 
 INPUT_FORMAT = re.compile("^[a-zA-Z0-9_-]+$", re.U)
+# seconds between two refreshes of the nodes and images listings
+POLL_INTERVAL = 30
 
 
 def get_values(line):
@@ -43,3 +51,101 @@ def validate_ssh_key(public_key):
             raise ValueError("Invalid key data")
     except ValueError:
         raise ValueError("Invalid public key")
+
+
+class ListingSnapshot(object):
+    """Parsed output of a nodepool listing command, served from memory.
+
+    The listing is fetched on first use, then refreshed every `interval`
+    seconds by a background thread (never if interval is 0). Items are
+    indexed on the `indexes` fields so that filtering is a lookup."""
+
+    def __init__(self, name, fetch, indexes, interval=POLL_INTERVAL):
+        self.name = name
+        self.fetch = fetch
+        self.indexes = indexes
+        self.interval = interval
+        # (items, index, timestamp) is swapped in one assignment
+        self._data = ([], {}, None)
+        self._lock = threading.Lock()
+        self._poller = None
+        # bumped by invalidate, a fetch started before is dropped
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+
+    @property
+    def timestamp(self):
+        return self._data[2]
+
+    @property
+    def age(self):
+        """seconds since the last refresh, None if never fetched"""
+        if self.timestamp is None:
+            return None
+        return time.time() - self.timestamp
+
+    def refresh(self):
+        timestamp = self.timestamp
+        with self._lock:
+            if self.timestamp is not None and self.timestamp != timestamp:
+                # another caller refreshed it while we were waiting
+                return
+            generation = self._generation
+            items = self.fetch()
+            index = {}
+            for field in self.indexes:
+                index[field] = {}
+                for item in items:
+                    index[field].setdefault(item[field], []).append(item)
+            with self._generation_lock:
+                if generation != self._generation:
+                    logger.debug("[nodepool] %s listing invalidated while "
+                                 "fetched, dropped" % self.name)
+                    return
+                self._data = (items, index, time.time())
+            logger.debug("[nodepool] %s listing refreshed (%i items)" % (
+                self.name, len(items)))
+
+    def invalidate(self):
+        """forces a refresh on the next read. A refresh in progress, that
+        may have fetched the listing before the change, is dropped"""
+        with self._generation_lock:
+            self._generation += 1
+            items, index, timestamp = self._data
+            self._data = (items, index, None)
+
+    def get(self, refresh=False, **filters):
+        if refresh or self.timestamp is None:
+            self.refresh()
+        self._start_poller()
+        items, index, timestamp = self._data
+        matches = None
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if matches is None:
+                matches = index[field].get(value, [])
+            else:
+                matches = [i for i in matches if i[field] == value]
+        if matches is None:
+            matches = items
+        return list(matches)
+
+    def _start_poller(self):
+        if self.interval <= 0 or self._poller is not None:
+            return
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(
+                    target=self._poll, name='nodepool-%s' % self.name)
+                self._poller.daemon = True
+                self._poller.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                msg = "[nodepool] %s listing refresh failed: %s"
+                logger.error(msg % (self.name, e))
@@ -17,11 +17,16 @@
 
 import atexit
 import logging
+import threading
+import time
+
+from collections import deque
 
 from managesf import model
 from managesf.services import base
 from managesf.services.nodepool.common import get_values, get_age
 from managesf.services.nodepool.common import validate_input
+from managesf.services.nodepool.common import ListingSnapshot, POLL_INTERVAL
 
 
 logger = logging.getLogger(__name__)
@@ -36,52 +41,116 @@ LIST_FIELDS = ['id', 'provider_name', 'image_name', 'hostname', 'version',
 UPDATE_CMD = ('nodepool image-update %(provider)s %(image)s')
 
 
-UPDATES_CACHE = {}
-REFRESH_LOCKED = False
-
-
-def _refresh_cache():
-    global REFRESH_LOCKED
-    if REFRESH_LOCKED:
-        logger.debug("image update cache is locked, refresh it later")
-        return
-    to_remove = []
-    REFRESH_LOCKED = True
-    logger.debug("locking image update cache for refresh")
-    for u in UPDATES_CACHE:
-        if UPDATES_CACHE[u]['stdout'].channel.exit_status_ready():
-            stdout = UPDATES_CACHE[u]['stdout']
-            stderr = UPDATES_CACHE[u]['stderr']
-            client = UPDATES_CACHE[u]['client']
-            exit_code = int(stdout.channel.recv_exit_status())
+# seconds between two writes of the pending output to the database
+FLUSH_INTERVAL = 2
+# characters of output kept in memory for incremental polling
+TAIL_SIZE = 65536
+
+
+# running image updates, by update id
+UPDATES = {}
+UPDATES_LOCK = threading.Lock()
+
+
+class UpdateOutput(object):
+    """Bounded tail of an update output, addressed by absolute offsets"""
+    def __init__(self, size=TAIL_SIZE):
+        self.max_size = size
+        self.chunks = deque()
+        self.size = 0
+        # offset of the first character kept, and total characters received
+        self.start = 0
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def append(self, data):
+        with self.lock:
+            self.chunks.append(data)
+            self.size += len(data)
+            self.end += len(data)
+            while self.size > self.max_size and len(self.chunks) > 1:
+                c = self.chunks.popleft()
+                self.size -= len(c)
+                self.start += len(c)
+
+    def read(self, offset):
+        """returns the output from offset and the next offset, or None if
+        offset is no longer in the tail"""
+        with self.lock:
+            if offset < self.start or offset > self.end:
+                return None
+            data = u''.join(self.chunks)[offset - self.start:]
+            return data, self.end
+
+
+class ImageUpdateWorker(threading.Thread):
+    """Drains the output of an image update into its database row"""
+    def __init__(self, update_id, stdout, stderr):
+        super(ImageUpdateWorker, self).__init__(
+            name='image-update-%s' % update_id)
+        self.daemon = True
+        self.update_id = update_id
+        self.stdout = stdout
+        self.stderr = stderr
+        self.tail = UpdateOutput()
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
+    def flush(self, **kwargs):
+        with self.pending_lock:
+            output = u''.join(self.pending)
+            self.pending = []
+            if output:
+                crud.append_output(self.update_id, output)
+            if kwargs:
+                crud.update(id=self.update_id, **kwargs)
+
+    def run(self):
+        last_flush = time.time()
+        try:
+            for line in iter(self.stdout.readline, ''):
+                if isinstance(line, str):
+                    line = line.decode('utf-8', 'replace')
+                self.tail.append(line)
+                with self.pending_lock:
+                    self.pending.append(line)
+                if time.time() - last_flush > FLUSH_INTERVAL:
+                    self.flush()
+                    last_flush = time.time()
+            exit_code = int(self.stdout.channel.recv_exit_status())
             if exit_code > 0:
                 status = "FAILURE"
             else:
                 status = "SUCCESS"
-            crud.update(id=u, status=status, exit_code=str(exit_code),
-                        output=stdout.read(), stderr=stderr.read())
-            client.close()
-            to_remove.append(u)
-    for u in to_remove:
-        del UPDATES_CACHE[u]
-    REFRESH_LOCKED = False
-    logger.debug("image update cache unlocked")
+            self.flush(status=status, exit_code=str(exit_code),
+                       stderr=self.stderr.read())
+        except Exception as e:
+            msg = "[img-update] update %s interrupted: %s"
+            logger.error(msg % (self.update_id, e))
+            self.flush(status="INTERRUPTED")
+        finally:
+            # only the channel is closed, the connection is shared
+            self.stdout.channel.close()
+            with UPDATES_LOCK:
+                UPDATES.pop(self.update_id, None)
 
 
 class SFNodepoolImageManager(base.ImageManager):
     """Image related operations from Nodepool's CLI, via SSH"""
     def __init__(self, plugin):
         super(SFNodepoolImageManager, self).__init__(plugin)
+        interval = int(plugin.conf.get('poll_interval', POLL_INTERVAL))
+        self.snapshot = ListingSnapshot('images', self._list,
+                                        ['provider_name', 'image_name'],
+                                        interval)
 
-    def get(self, provider_name=None, image_name=None, **kwargs):
-        """lists one or several images depending on filtering options"""
+    def _list(self):
         images_info = []
         client = self.plugin.get_client()
         logger.debug("[%s] calling %s" % (self.plugin.service_name,
                                           LIST_CMD))
-        stdin, stdout, stderr = client.exec_command(LIST_CMD)
+        stdin, stdout, stderr = client.exec_command(LIST_CMD, read_only=True)
         return_code = int(stdout.channel.recv_exit_status())
-        client.close()
         if return_code > 0:
             e = stderr.read()
             m = "[%s] image get failed with exit code %i: %s"
@@ -92,23 +161,20 @@ class SFNodepoolImageManager(base.ImageManager):
             values = get_values(line)
             image = dict(zip(LIST_FIELDS, values))
             image['age'] = get_age(image['age'])
-            if provider_name and image_name:
-                if (provider_name == image['provider_name'] and
-                   image_name == image['image_name']):
-                    images_info.append(image)
-            elif provider_name:
-                if provider_name == image['provider_name']:
-                    images_info.append(image)
-            elif image_name:
-                if image_name == image['image_name']:
-                    images_info.append(image)
-            else:
-                images_info.append(image)
+            images_info.append(image)
         return images_info
 
+    def get(self, provider_name=None, image_name=None, refresh=False,
+            **kwargs):
+        """lists one or several images depending on filtering options.
+        The listing is served from the last snapshot unless refresh is
+        True"""
+        return self.snapshot.get(refresh=refresh,
+                                 provider_name=provider_name,
+                                 image_name=image_name)
+
     def start_update(self, provider_name, image_name):
         """updates (rebuild) the image image_name on provider provider_name"""
-        _refresh_cache()
         if (not validate_input(provider_name) or
            not validate_input(image_name)):
             msg = "invalid provider %r and/or image %r" % (provider_name,
@@ -122,52 +188,47 @@ class SFNodepoolImageManager(base.ImageManager):
                                           UPDATE_CMD % args))
         cmd = UPDATE_CMD % args
         stdin, stdout, stderr = client.exec_command(cmd, get_pty=True)
-        UPDATES_CACHE[update_id] = {'stdout': stdout,
-                                    'stderr': stderr,
-                                    'client': client}
-        UPDATES_CACHE[update_id].update(args)
+        worker = ImageUpdateWorker(update_id, stdout, stderr)
+        with UPDATES_LOCK:
+            UPDATES[update_id] = worker
+        worker.start()
         return update_id
 
-    def get_update_info(self, id):
+    def get_update_info(self, id, offset=None):
         """fetches relevant info on an image update possibly still
-        in progress"""
-        _refresh_cache()
+        in progress. With an offset, only the output produced after it is
+        returned, along with the offset to use for the next call"""
         x = crud.get(id)
-        if x:
-            return {'id': id,
-                    'status': x['status'],
-                    'provider': x['provider'],
-                    'image': x['image'],
-                    'exit_code': x['exit_code'],
-                    'output': x['output'],
-                    'error': x['stderr']}
-        elif int(id) in UPDATES_CACHE:
-            # TODO(mhu) Find a way to return the output in progress. Could we
-            # copy the file-like stdout object?
-            return {'id': id,
-                    'status': 'IN_PROGRESS',
-                    'provider': UPDATES_CACHE['provider'],
-                    'image': UPDATES_CACHE['image'],
-                    'exit_code': None,
-                    'output': None,
-                    'error': None}
-        else:
+        if not x:
             return {}
+        info = {'id': id,
+                'status': x['status'],
+                'provider': x['provider'],
+                'image': x['image'],
+                'exit_code': x['exit_code'],
+                'output': x['output'],
+                'error': x['stderr']}
+        if offset is not None:
+            offset = int(offset)
+            with UPDATES_LOCK:
+                worker = UPDATES.get(int(id))
+            tail = worker.tail.read(offset) if worker else None
+            if tail is None:
+                # the update is over or the offset is out of the tail
+                output = (x['output'] or u'')[offset:]
+                tail = output, offset + len(output)
+            info['output'], info['offset'] = tail
+        return info
 
 
 # For the DBZ fans
 def final_flush():
     from sqlalchemy.exc import OperationalError
     try:
-        _refresh_cache()
-        for u in UPDATES_CACHE:
-            stdout = UPDATES_CACHE[u]['stdout']
-            stderr = UPDATES_CACHE[u]['stderr']
-            client = UPDATES_CACHE[u]['client']
-            status = "INTERRUPTED"
-            crud.update(id=u, status=status, output=stdout.read(),
-                        stderr=stderr.read())
-            client.close()
+        with UPDATES_LOCK:
+            workers = UPDATES.values()
+        for worker in workers:
+            worker.flush(status="INTERRUPTED")
     except OperationalError as e:
         msg = "[img-update] Error handling final cache flush on db: %s"
         logger.error(msg % e)
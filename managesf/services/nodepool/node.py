@@ -20,6 +20,7 @@ import logging
 from managesf.services import base
 from managesf.services.nodepool.common import get_values, get_age
 from managesf.services.nodepool.common import validate_input, validate_ssh_key
+from managesf.services.nodepool.common import ListingSnapshot, POLL_INTERVAL
 
 
 logger = logging.getLogger(__name__)
@@ -41,19 +42,18 @@ class SFNodepoolNodeManager(base.NodeManager):
 
     def __init__(self, plugin):
         super(SFNodepoolNodeManager, self).__init__(plugin)
+        interval = int(plugin.conf.get('poll_interval', POLL_INTERVAL))
+        self.snapshot = ListingSnapshot('nodes', self._list,
+                                        ['node_id', 'provider_name', 'label'],
+                                        interval)
 
-    def get(self, node_id=None, **kwargs):
-        """lists one or several nodes depending on filtering with node's
-        id or kwargs"""
-        if node_id and not isinstance(node_id, int):
-            raise Exception("invalid node id %r" % node_id)
+    def _list(self):
         nodes_info = []
         client = self.plugin.get_client()
         logger.debug("[%s] calling %s" % (self.plugin.service_name,
                                           LIST_CMD))
-        stdin, stdout, stderr = client.exec_command(LIST_CMD)
+        stdin, stdout, stderr = client.exec_command(LIST_CMD, read_only=True)
         return_code = int(stdout.channel.recv_exit_status())
-        client.close()
         if return_code > 0:
             e = stderr.read()
             m = "[%s] node get failed with exit code %i: %s"
@@ -64,14 +64,21 @@ class SFNodepoolNodeManager(base.NodeManager):
             values = get_values(line)
             node = dict(zip(LIST_FIELDS, values))
             node['age'] = get_age(node['age'])
-            if node_id:
-                if node_id == int(node['node_id']):
-                    nodes_info = [node, ]
-                    break
-            else:
-                nodes_info.append(node)
+            nodes_info.append(node)
         return nodes_info
 
+    def get(self, node_id=None, refresh=False, **kwargs):
+        """lists one or several nodes depending on filtering with node's
+        id or kwargs. The listing is served from the last snapshot unless
+        refresh is True"""
+        if node_id and not isinstance(node_id, int):
+            raise Exception("invalid node id %r" % node_id)
+        if node_id:
+            return self.snapshot.get(refresh=refresh, node_id=str(node_id))
+        return self.snapshot.get(refresh=refresh,
+                                 provider_name=kwargs.get('provider_name'),
+                                 label=kwargs.get('label'))
+
     def hold(self, node_id):
         """prevents node node_id from being deleted after a completed job"""
         if not isinstance(node_id, int):
@@ -81,13 +88,13 @@ class SFNodepoolNodeManager(base.NodeManager):
                                           (HOLD_CMD % node_id)))
         stdin, stdout, stderr = client.exec_command(HOLD_CMD % node_id)
         return_code = int(stdout.channel.recv_exit_status())
-        client.close()
         if return_code > 0:
             e = stderr.read()
             m = "[%s] node hold failed with exit code %i: %s"
             m = m % (self.plugin.service_name, return_code, e)
             logger.error(m)
             raise Exception(m)
+        self.snapshot.invalidate()
 
     def delete(self, node_id):
         """schedules node node_id for deletion"""
@@ -98,13 +105,13 @@ class SFNodepoolNodeManager(base.NodeManager):
                                           (DELETE_CMD % node_id)))
         stdin, stdout, stderr = client.exec_command(DELETE_CMD % node_id)
         return_code = int(stdout.channel.recv_exit_status())
-        client.close()
         if return_code > 0:
             e = stderr.read()
             m = "[%s] node delete failed with exit code %i: %s"
             m = m % (self.plugin.service_name, return_code, e)
             logger.error(m)
             raise Exception(m)
+        self.snapshot.invalidate()
 
     def add_authorized_key(self, node_id, public_key, user=None):
         """adds public_key as an authorized key on user's account on node_id"""
@@ -119,6 +126,9 @@ class SFNodepoolNodeManager(base.NodeManager):
         except ValueError:
             raise Exception("invalid public key %s(...)" % public_key[:15])
         node = self.get(node_id=node_id)
+        if not node:
+            # the node may be younger than the snapshot
+            node = self.get(node_id=node_id, refresh=True)
         if not node:
             raise Exception('Node %i not found' % node_id)
         ip = node[0]['ip']
@@ -128,7 +138,6 @@ class SFNodepoolNodeManager(base.NodeManager):
                                           cmd))
         stdin, stdout, stderr = client.exec_command(cmd)
         return_code = int(stdout.channel.recv_exit_status())
-        client.close()
         if return_code > 0:
             e = stderr.read()
             m = "[%s] public key insertion failed with exit code %i: %s"
@@ -59,3 +59,7 @@ def add_yaml_data(repo_path, data, free_style=False):
     repo.update_environment(GIT_COMMITTER_NAME='test')
     repo.execute(['git', 'commit', '-m', 'add %s' % filename])
     return repo_path
+
+
+def get_head(repo_path):
+    return git.Git(repo_path).execute(['git', 'rev-parse', 'HEAD'])
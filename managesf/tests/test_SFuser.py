@@ -216,6 +216,37 @@ class SFuserController(TestCase):
         self.assertEqual({},
                          u.get(username=u'Bonnibel'))
 
+    def test_provision(self):
+        u = SFuser.SFUserManager()
+        user, known = u.provision(username=u'Marceline',
+                                  email='Vampire',
+                                  fullname=u'Marceline the Vampire Queen',
+                                  cauth_id=66)
+        self.assertFalse(known)
+        self.assertEqual(u'Marceline', user['username'])
+        self.assertEqual('66', user['cauth_id'])
+        self.assertEqual(user, u.get(id=user['id']))
+        user2, known = u.provision(username=u'Marceline',
+                                   email='Vampire',
+                                   fullname=u'Marceline the Vampire Queen',
+                                   cauth_id=66)
+        self.assertTrue(known)
+        self.assertEqual(user, user2)
+        # the user creation and its mappings share one transaction
+        try:
+            with u.transaction():
+                user, known = u.provision(username=u'Finn',
+                                          email='the Human',
+                                          fullname=u'Finn the Human',
+                                          cauth_id=67)
+                u.mapping.set(user['id'], 'SFGerrit', '12')
+                raise ValueError('Mathematical!')
+        except ValueError:
+            pass
+        self.assertEqual({}, u.get(username=u'Finn'))
+        self.assertEqual(None,
+                         u.mapping.get_user_mapping('SFGerrit', '12'))
+
     def test_unicode(self):
         """create and get a non ascii user"""
         u = SFuser.SFUserManager()
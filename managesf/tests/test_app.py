@@ -14,8 +14,12 @@
 
 import os
 import json
+import base64
+import hashlib
 import shutil
 import tempfile
+import threading
+import time
 
 from unittest import TestCase
 from webtest import TestApp
@@ -260,8 +264,9 @@ class TestManageSFAppBackupController(FunctionalTest):
     def tearDown(self):
         bkp = os.path.join(self.config['managesf']['backup_dir'],
                            'sf_backup.tar.gz')
-        if os.path.isfile(bkp):
-            os.unlink(bkp)
+        for path in (bkp, bkp + '.sha256'):
+            if os.path.isfile(path):
+                os.unlink(path)
 
     def test_backup_get(self):
         bkp = os.path.join(self.config['managesf']['backup_dir'],
@@ -277,6 +282,41 @@ class TestManageSFAppBackupController(FunctionalTest):
                                     extra_environ=environ,
                                     status="*")
             self.assertEqual(response.body, 'backup content')
+            checksum = hashlib.sha256('backup content').hexdigest()
+            self.assertEqual('"%s"' % checksum, response.headers['ETag'])
+            self.assertEqual('SHA-256=%s' % base64.b64encode(
+                hashlib.sha256('backup content').digest()),
+                response.headers['Digest'])
+            self.assertEqual('14', response.headers['Content-Length'])
+            self.assertTrue(os.path.isfile(bkp + '.sha256'))
+            # resumed download
+            response = self.app.get('/backup',
+                                    headers={'Range': 'bytes=7-',
+                                             'If-Range': '"%s"' % checksum},
+                                    extra_environ=environ,
+                                    status="*")
+            self.assertEqual(response.status_int, 206)
+            self.assertEqual(response.body, 'content')
+            self.assertEqual('bytes 7-13/14',
+                             response.headers['Content-Range'])
+            # the archive changed, all of it is sent again
+            response = self.app.get('/backup',
+                                    headers={'Range': 'bytes=7-',
+                                             'If-Range': '"outdated"'},
+                                    extra_environ=environ,
+                                    status="*")
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.body, 'backup content')
+            # the archive is not opened when its checksum fails
+            with patch('managesf.controllers.root.backup.get_checksum') as gc:
+                gc.side_effect = IOError('checksum failed')
+                with patch('managesf.controllers.root.open',
+                           create=True) as o:
+                    response = self.app.get('/backup',
+                                            extra_environ=environ,
+                                            status="*")
+                    self.assertEqual(response.status_int, 500)
+                    self.assertFalse(o.called)
             os.unlink(bkp)
             response = self.app.get('/backup',
                                     extra_environ=environ,
@@ -284,19 +324,72 @@ class TestManageSFAppBackupController(FunctionalTest):
             self.assertEqual(response.status_int, 404)
 
     def test_backup_post(self):
-        with patch('managesf.controllers.backup.'
-                   'backup_start') as backup_start, \
+        started = threading.Event()
+        done = threading.Event()
+
+        def ssh_stream(cmd, output):
+            output.append(u'dumping %s' % cmd)
+            started.set()
+            done.wait(5)
+            return 0
+
+        with patch('managesf.controllers.utils.RemoteUser.'
+                   '_ssh_stream') as _ssh_stream, \
                 patch.object(SFGerritProjectManager,
                              'get_user_groups') as gug:
             gug.return_value = []
+            _ssh_stream.side_effect = ssh_stream
             response = self.app.post('/backup', status="*")
             self.assertEqual(response.status_int, 401)
             environ = {'REMOTE_USER': 'admin'}
             response = self.app.post('/backup',
                                      extra_environ=environ,
                                      status="*")
-            self.assertEqual(response.status_int, 204)
-            self.assertTrue(backup_start.called)
+            self.assertEqual(response.status_int, 202)
+            job_id = response.json['job_id']
+            self.assertTrue(response.headers['Location'].endswith(
+                '/backup/jobs/%s' % job_id))
+            started.wait(5)
+            # the backup in progress is returned
+            response = self.app.post('/backup',
+                                     extra_environ=environ,
+                                     status="*")
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(job_id, response.json['job_id'])
+            self.assertEqual('RUNNING', response.json['status'])
+            done.set()
+            for i in range(50):
+                response = self.app.get('/backup/jobs/%s' % job_id,
+                                        extra_environ=environ,
+                                        status="*")
+                if response.json['status'] == 'SUCCESS':
+                    break
+                time.sleep(0.1)
+            self.assertEqual('SUCCESS', response.json['status'])
+            self.assertEqual({'exit_code': 0}, response.json['result'])
+            self.assertEqual(u'dumping sf_backup\n',
+                             response.json['output'])
+            self.assertEqual(1, _ssh_stream.call_count)
+            # a failed backup
+            _ssh_stream.side_effect = None
+            _ssh_stream.return_value = 3
+            response = self.app.post('/backup',
+                                     extra_environ=environ,
+                                     status="*")
+            self.assertEqual(response.status_int, 202)
+            job_id = response.json['job_id']
+            for i in range(50):
+                response = self.app.get('/backup/jobs/%s' % job_id,
+                                        extra_environ=environ,
+                                        status="*")
+                if response.json['status'] == 'FAILURE':
+                    break
+                time.sleep(0.1)
+            self.assertEqual('FAILURE', response.json['status'])
+            self.assertEqual({'exit_code': 3}, response.json['result'])
+            response = self.app.get('/backup/jobs/%s' % job_id,
+                                    status="*")
+            self.assertEqual(response.status_int, 401)
 
 
 class TestManageSFHtpasswdController(FunctionalTest):
@@ -520,6 +613,94 @@ class TestManageSFServicesUserController(FunctionalTest):
                                           extra_environ=environ, status="*")
             self.assertEqual(response.status_int, 201)
 
+    def wait_bulk_job(self, response, environ):
+        self.assertEqual(response.status_int, 202)
+        job_id = response.json['job_id']
+        self.assertTrue(response.headers['Location'].endswith(
+            '/services_users/bulk/jobs/%s' % job_id))
+        for i in range(50):
+            response = self.app.get('/services_users/bulk/jobs/%s' % job_id,
+                                    extra_environ=environ, status="*")
+            if response.json['status'] not in ('QUEUED', 'RUNNING'):
+                break
+            time.sleep(0.1)
+        self.assertEqual(response.status_int, 200)
+        return response.json
+
+    def test_bulk_add_users(self):
+        environ = {'REMOTE_USER': 'admin'}
+        users = [{'email': 'jojo@starplatinum.dom',
+                  'full_name': 'Jotaro Kujoh', 'username': 'jojo',
+                  'external_id': 42},
+                 {'email': 'polnareff@silverchariot.dom',
+                  'full_name': 'Jean Pierre Polnareff',
+                  'username': 'polnareff', 'external_id': 43},
+                 {'email': 'jojo@starplatinum.dom',
+                  'full_name': 'Jotaro Kujoh', 'username': 'jojo'},
+                 {'username': 'avdol'}]
+        with patch.object(SFGerritProjectManager, 'get_user_groups'):
+            response = self.app.post_json('/services_users/bulk', users,
+                                          extra_environ={'REMOTE_USER':
+                                                         'dio'},
+                                          status="*")
+            self.assertEqual(response.status_int, 401)
+        with patch.object(StoryboardUserManager, 'create') as sb_create, \
+                patch.object(g_user.SFGerritUserManager,
+                             'create') as gerrit_create, \
+                patch.object(StoryboardUserManager, 'get') as s_get, \
+                patch.object(g_user.SFGerritUserManager, 'get') as g_get, \
+                patch.object(SFGerritProjectManager,
+                             'get_user_groups') as gug:
+            s_get.return_value = None
+            g_get.return_value = None
+            sb_create.return_value = 10
+
+            def gerrit_fails(username, **kwargs):
+                if username == 'polnareff':
+                    raise Exception('Gerrit is down')
+                return 5
+            gerrit_create.side_effect = gerrit_fails
+            response = self.app.post_json('/services_users/bulk', users,
+                                          extra_environ=environ, status="*")
+            # the policy is checked once for the whole batch
+            self.assertEqual(1, gug.call_count)
+            job = self.wait_bulk_job(response, environ)
+            self.assertEqual('FAILURE', job['status'])
+            self.assertIn(u'jojo: created', job['output'])
+            results = job['result']
+            self.assertEqual(['jojo', 'polnareff', 'jojo', 'avdol'],
+                             [r['username'] for r in results])
+            self.assertEqual('created', results[0]['status'])
+            self.assertTrue(results[0]['id'])
+            self.assertEqual('error', results[1]['status'])
+            self.assertIn('Gerrit is down', results[1]['errors']['gerrit'])
+            # the user exists, the services that succeeded are mapped
+            self.assertTrue(results[1]['id'])
+            self.assertIn('Duplicate', results[2]['errors'])
+            self.assertIn('Incomplete', results[3]['errors'])
+            self.assertEqual(2, len(gerrit_create.mock_calls))
+
+            # the same users as NDJSON, jojo is known now
+            body = '\n'.join(json.dumps(u) for u in users[:2])
+            response = self.app.post('/services_users/bulk', body,
+                                     content_type='application/x-ndjson',
+                                     extra_environ=environ, status="*")
+            results = self.wait_bulk_job(response, environ)['result']
+            self.assertEqual(2, len(results))
+            self.assertEqual(job['result'][0]['id'], results[0]['id'])
+            self.assertNotEqual('created', results[0]['status'])
+
+            response = self.app.post('/services_users/bulk', '{"a": ',
+                                     content_type='application/x-ndjson',
+                                     extra_environ=environ, status="*")
+            self.assertEqual(response.status_int, 400)
+            response = self.app.post_json('/services_users/bulk', users[0],
+                                          extra_environ=environ, status="*")
+            self.assertEqual(response.status_int, 400)
+            response = self.app.get('/services_users/bulk/jobs/999999',
+                                    extra_environ=environ, status="*")
+            self.assertEqual(response.status_int, 404)
+
     def test_delete_user_in_backends_non_admin(self):
         environ = {'REMOTE_USER': 'dio'}
         params = {'username': 'iggy'}
@@ -621,6 +802,31 @@ class TestManageSFServicesUserController(FunctionalTest):
             self.assertTrue(len(user_list) >= 1,
                             user_list)
             self.assertTrue(any(x['username'] == 'kira' for x in user_list))
+            response = self.app.get('/services_users/?fields=id,username',
+                                    extra_environ=environ, status="*")
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual([dict((k, u[k]) for k in ('id', 'username'))
+                              for u in user_list],
+                             response.json)
+            first = int(user_list[0]['id'])
+            response = self.app.get('/services_users/?limit=1',
+                                    extra_environ=environ, status="*")
+            self.assertEqual([user_list[0]], response.json)
+            response = self.app.get('/services_users/?after=%s' % first,
+                                    extra_environ=environ, status="*")
+            self.assertEqual(user_list[1:], response.json)
+            response = self.app.get('/services_users/?username=kira'
+                                    '&fields=email',
+                                    extra_environ=environ, status="*")
+            self.assertEqual({'email': 'kira@jojolion.dom'}, response.json)
+            for query in ('limit=-1', 'offset=a', 'fields=password'):
+                response = self.app.get('/services_users/?%s' % query,
+                                        extra_environ=environ, status="*")
+                self.assertEqual(response.status_int, 400)
+            # the message shows the value sent
+            response = self.app.get('/services_users/?offset=a',
+                                    extra_environ=environ, status="*")
+            self.assertIn('Invalid offset value: a', response.body)
 
     def test_get_user(self):
         environ = {'REMOTE_USER': 'admin'}
@@ -907,6 +1113,18 @@ class TestJobsController(FunctionalTest):
                 self.assertTrue(all(get.return_value[0][u] == j[0][u]
                                     for u in get.return_value[0]),
                                 j)
+                # paging args
+                resp = self.app.get('/jobs/mockjob/?limit=10&offset=20',
+                                    extra_environ=environ, status="*")
+                self.assertEqual(200, resp.status_int)
+                get.assert_called_with('mockjob', limit='10', offset='20')
+                get.side_effect = exc.InvalidParameterError(
+                    'Invalid limit value: abc')
+                resp = self.app.get('/jobs/mockjob/?limit=abc',
+                                    extra_environ=environ, status="*")
+                self.assertEqual(400, resp.status_int)
+                self.assertEqual('Invalid limit value: abc',
+                                 resp.json['error_description'])
 
     def test_get_by_id(self):
         with patch.object(SFGerritProjectManager, 'get_user_groups'):
@@ -1041,7 +1259,7 @@ class TestNodesController(FunctionalTest):
                 # with id
                 resp = self.app.get('/nodes/id/27',
                                     extra_environ=environ, status="*")
-                get.assert_called_with(27)
+                get.assert_called_with(27, refresh=False)
                 self.assertEqual(200, resp.status_int)
                 j = json.loads(resp.body)
                 self.assertTrue('nodepool' in j.keys())
@@ -1053,6 +1271,11 @@ class TestNodesController(FunctionalTest):
                 resp = self.app.get('/nodes/id/yeah_no',
                                     extra_environ=environ, status="*")
                 self.assertEqual(400, resp.status_int)
+                # forced refresh of the listing
+                resp = self.app.get('/nodes/?refresh=true',
+                                    extra_environ=environ, status="*")
+                self.assertEqual(200, resp.status_int)
+                get.assert_called_with(refresh=True)
 
     def test_put(self):
         with patch.object(SFGerritProjectManager, 'get_user_groups'):
@@ -1185,7 +1408,7 @@ class TestNodesController(FunctionalTest):
                 resp = self.app.get('/nodes/images///',
                                     extra_environ=environ, status="*")
                 self.assertEqual(200, resp.status_int)
-                get.assert_called_with(None, None)
+                get.assert_called_with(None, None, refresh=False)
                 j = json.loads(resp.body)
                 self.assertTrue('nodepool' in j.keys())
                 j = j['nodepool']
@@ -1195,7 +1418,7 @@ class TestNodesController(FunctionalTest):
                 # with provider
                 resp = self.app.get('/nodes/images/blip//',
                                     extra_environ=environ, status="*")
-                get.assert_called_with("blip", None)
+                get.assert_called_with("blip", None, refresh=False)
                 self.assertEqual(200, resp.status_int)
                 j = json.loads(resp.body)
                 self.assertTrue('nodepool' in j.keys())
@@ -1206,7 +1429,7 @@ class TestNodesController(FunctionalTest):
                 # with both
                 resp = self.app.get('/nodes/images/blip/blop/',
                                     extra_environ=environ, status="*")
-                get.assert_called_with("blip", "blop")
+                get.assert_called_with("blip", "blop", refresh=False)
                 self.assertEqual(200, resp.status_int)
                 j = json.loads(resp.body)
                 self.assertTrue('nodepool' in j.keys())
@@ -1237,13 +1460,21 @@ class TestNodesController(FunctionalTest):
                 get_info.return_value = dummy
                 resp = self.app.get('/nodes/images/update/51/',
                                     extra_environ=environ, status="*")
-                get_info.assert_called_with(u'51')
+                get_info.assert_called_with(u'51', offset=None)
                 self.assertEqual(200, resp.status_int, resp.body)
                 j = json.loads(resp.body)
                 self.assertTrue('nodepool' in j.keys())
                 j = j['nodepool']
                 for u in dummy:
                     self.assertEqual(str(dummy[u]), str(j[u]))
+                # incremental polling
+                resp = self.app.get('/nodes/images/update/51/?offset=12',
+                                    extra_environ=environ, status="*")
+                get_info.assert_called_with(u'51', offset=12)
+                self.assertEqual(200, resp.status_int, resp.body)
+                resp = self.app.get('/nodes/images/update/51/?offset=bad',
+                                    extra_environ=environ, status="*")
+                self.assertEqual(400, resp.status_int, resp.body)
 
 
 class TestResourcesController(FunctionalTest):
@@ -1385,6 +1616,146 @@ class TestResourcesController(FunctionalTest):
                                              status="*")
                     self.assertEqual(resp.status_code, 400)
 
+    def test_put_async(self):
+        workdir = tempfile.mkdtemp()
+        self.to_delete.append(workdir)
+
+        environ = {'REMOTE_USER': 'SF_SERVICE_USER'}
+
+        data = {'resources': {'dummies': {}}}
+        repo_path = self.prepare_repo(data)
+        new_data = {'resources': {'dummies': {
+                    'id1': {'namespace': 'awesome',
+                            'name': 'p1'}}}}
+        rtu.add_yaml_data(repo_path, new_data)
+        with patch.object(SFGerritProjectManager, 'get_user_groups'):
+            with patch('managesf.controllers.root.conf') as conf:
+                conf.resources = {'workdir': workdir,
+                                  'subdir': 'resources',
+                                  'master_repo': repo_path}
+                with patch.dict('managesf.model.yamlbkd.engine.MAPPING',
+                                {'dummies': Dummy}):
+                    resp = self.app.put('/resources/?async=true',
+                                        extra_environ=environ,
+                                        status="*")
+                    self.assertEqual(resp.status_code, 202)
+                    job_id = resp.json['job_id']
+                    self.assertTrue(resp.headers['Location'].endswith(
+                        '/resources/jobs/%s' % job_id))
+                    for i in range(50):
+                        resp = self.app.get('/resources/jobs/%s' % job_id,
+                                            extra_environ=environ,
+                                            status="*")
+                        if resp.json['status'] not in ('QUEUED', 'RUNNING'):
+                            break
+                        time.sleep(0.1)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual('SUCCESS', resp.json['status'])
+                self.assertIn("Resource [type: dummies, ID: id1] has been "
+                              "created.",
+                              resp.json['output'])
+                offset = resp.json['offset']
+                resp = self.app.get('/resources/jobs/%s?offset=%s' % (
+                                    job_id, offset),
+                                    extra_environ=environ, status="*")
+                self.assertEqual(u'', resp.json['output'])
+                self.assertEqual(offset, resp.json['offset'])
+                resp = self.app.get('/resources/jobs/%s?offset=-1' % job_id,
+                                    extra_environ=environ, status="*")
+                self.assertEqual(resp.status_code, 400)
+                resp = self.app.get('/resources/jobs/999999',
+                                    extra_environ=environ, status="*")
+                self.assertEqual(resp.status_code, 404)
+
+    def test_apply_coalesce(self):
+        from managesf.controllers import root, tasks
+        workdir = tempfile.mkdtemp()
+        self.to_delete.append(workdir)
+
+        repo_path = self.prepare_repo({'resources': {'dummies': {}}})
+        shas = []
+        # kept alive, the data files are named after their id()
+        data = [{'resources': {'dummies': {
+                 'id%s' % i: {'namespace': 'awesome',
+                              'name': 'p%s' % i}}}} for i in range(1, 4)]
+        for d in data:
+            rtu.add_yaml_data(repo_path, d)
+            shas.append(rtu.get_head(repo_path))
+        with patch('managesf.controllers.root.conf') as conf:
+            conf.resources = {'workdir': workdir,
+                              'subdir': 'resources',
+                              'master_repo': repo_path}
+            with patch.dict('managesf.model.yamlbkd.engine.MAPPING',
+                            {'dummies': Dummy}):
+                # nothing recorded yet, the commit is applied alone
+                logs = []
+                self.assertTrue(root.run_apply({'COMMIT': shas[0]},
+                                               logs, 0))
+                self.assertEqual(2, len(logs))
+                self.assertEqual(shas[0],
+                                 root.applied_commits.get(repo_path))
+                # the queued commits are applied along
+                for sha in shas[1:]:
+                    tasks.crud.create(root.apply_queue.kind,
+                                      json.dumps({'COMMIT': sha}),
+                                      tasks.get_owner())
+                logs = []
+                self.assertTrue(root.run_apply({'COMMIT': shas[1][:8]},
+                                               logs, 0))
+                self.assertIn(u'Applying the commits from %s to %s at '
+                              u'once' % (shas[0], shas[2]), logs)
+                for i in (2, 3):
+                    self.assertIn("Resource [type: dummies, ID: id%s] has "
+                                  "been created." % i, logs)
+                self.assertEqual(shas[2],
+                                 root.applied_commits.get(repo_path))
+                # and have nothing left to do
+                logs = []
+                self.assertTrue(root.run_apply({'COMMIT': shas[2]},
+                                               logs, 0))
+                self.assertEqual([u'Commit %s is already applied (last '
+                                  u'applied commit: %s)' % (shas[2],
+                                                            shas[2])],
+                                 logs)
+
+    def test_apply_coalesce_direct_apply(self):
+        from managesf.controllers import root, tasks
+        workdir = tempfile.mkdtemp()
+        self.to_delete.append(workdir)
+
+        repo_path = self.prepare_repo({'resources': {'dummies': {}}})
+        shas = []
+        data = [{'resources': {'dummies': {
+                 'id%s' % i: {'namespace': 'awesome',
+                              'name': 'p%s' % i}}}} for i in range(1, 4)]
+        for d in data:
+            rtu.add_yaml_data(repo_path, d)
+            shas.append(rtu.get_head(repo_path))
+        with patch('managesf.controllers.root.conf') as conf:
+            conf.resources = {'workdir': workdir,
+                              'subdir': 'resources',
+                              'master_repo': repo_path}
+            with patch.dict('managesf.model.yamlbkd.engine.MAPPING',
+                            {'dummies': Dummy}):
+                self.assertTrue(root.run_apply({'COMMIT': shas[0]},
+                                               [], 0))
+                # a direct apply waits in the queue before the last commit
+                tasks.crud.create(root.apply_queue.kind,
+                                  json.dumps({'prev': 'a', 'new': 'b'}),
+                                  tasks.get_owner())
+                tasks.crud.create(root.apply_queue.kind,
+                                  json.dumps({'COMMIT': shas[2]}),
+                                  tasks.get_owner())
+                logs = []
+                self.assertTrue(root.run_apply({'COMMIT': shas[1]},
+                                               logs, 0))
+                self.assertIn("Resource [type: dummies, ID: id2] has "
+                              "been created.", logs)
+                self.assertNotIn("Resource [type: dummies, ID: id3] has "
+                                 "been created.", logs)
+                self.assertEqual(shas[1],
+                                 root.applied_commits.get(repo_path))
+
     def test_get_missing_resources(self):
         with patch('managesf.model.yamlbkd.engine.'
                    'SFResourceBackendEngine.get_missing_resources') as gmr:
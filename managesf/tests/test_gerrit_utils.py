@@ -13,9 +13,13 @@
 # under the License.
 
 from unittest import TestCase
-from mock import patch
+from mock import patch, MagicMock
 
 import os
+import shutil
+import socket
+import tempfile
+import time
 
 from managesf.services.gerrit import utils
 from managesf.tests import dummy_conf
@@ -34,10 +38,94 @@ class TestGerritRepo(TestCase):
         self.assertTrue(gr.env['GIT_COMMITTER_EMAIL'])
 
     def test_exec(self):
+        cwd = os.getcwd()
         gr = utils.GerritRepo('p1', self.conf)
         gr._exec('touch f')
         self.assertTrue(os.path.isfile(os.path.join(gr.infos['localcopy_path'],
                                                     'f')))
+        # the process working directory is left alone
+        self.assertEqual(cwd, os.getcwd())
+        self.assertEqual('%s\n' % os.path.realpath(
+                         gr.infos['localcopy_path']),
+                         utils._exec('pwd -P', cwd=gr.infos['localcopy_path']))
+        self.assertRaises(utils.LocalProcessError, utils._exec, 'false')
+        self.assertRaises(utils.LocalProcessError, utils._exec, 'sleep 5',
+                          timeout=0.2)
+        # the children holding the output pipe are killed too
+        start = time.time()
+        self.assertRaises(utils.LocalProcessError, utils._exec,
+                          'sh -c "sleep 5 & sleep 5"', timeout=0.2)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_ssh_wrapper(self):
+        gr = utils.GerritRepo('p1', self.conf)
+        gr2 = utils.GerritRepo('p2', self.conf)
+        # the wrapper is shared by the repos
+        self.assertEqual(gr.wrapper_path, gr2.wrapper_path)
+        wrapper = file(gr.wrapper_path).read()
+        self.assertIn('-o ControlMaster=no', wrapper)
+        self.assertIn('-o ControlPersist=60', wrapper)
+        tmpdir = os.path.dirname(gr.wrapper_path)
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(os.path.join(tmpdir, 'user1@gerrit.test.dom:29418'))
+        with patch('subprocess.call') as call:
+            utils.close_ssh_wrappers()
+            self.assertEqual(1, call.call_count)
+            self.assertIn('-O', call.call_args[0][0])
+        sock.close()
+        self.assertFalse(os.path.exists(tmpdir))
+        # a new one is made when needed again
+        gr3 = utils.GerritRepo('p3', self.conf)
+        self.assertTrue(os.path.isfile(gr3.wrapper_path))
+        self.assertNotEqual(gr.wrapper_path, gr3.wrapper_path)
+
+    def test_exec_through_ssh_wrapper(self):
+        gr = utils.GerritRepo('p1', self.conf)
+        bindir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bindir)
+        # an ssh that, as older OpenSSH, leaves its master in the
+        # background with the standard streams it was given
+        fake_ssh = os.path.join(bindir, 'ssh')
+        file(fake_ssh, 'w').write('''#!/bin/sh
+case "$*" in
+    *"-O check"*) exit 1 ;;
+    *-fNM*|*ControlMaster=auto*) sleep 5 & ;;
+esac
+echo "connected with $*"
+''')
+        os.chmod(fake_ssh, 0700)
+        env = dict(gr.env, PATH='%s:%s' % (bindir, os.environ['PATH']))
+        with patch.dict(os.environ, {'PATH': env['PATH']}):
+            start = time.time()
+            utils.start_ssh_master(gr.wrapper_path, 'admin',
+                                   'gerrit.test.dom', 29418)
+            output = utils._exec('%s -p 29418 admin@gerrit.test.dom '
+                                 'git-upload-pack p1' % gr.wrapper_path,
+                                 env=env, timeout=10)
+        # neither the master nor the command waited for the master to exit
+        self.assertTrue(time.time() - start < 2)
+        self.assertIn('ControlMaster=no', output)
+        self.assertIn('git-upload-pack p1', output)
+
+    def test_ssh_limiter(self):
+        gr = utils.GerritRepo('p1', self.conf)
+        limiter = MagicMock()
+        with patch('managesf.services.gerrit.utils._exec') as ex, \
+                patch('managesf.services.gerrit.utils.start_ssh_master') \
+                as master, \
+                patch('managesf.services.gerrit.utils.get_ssh_limiter') as gl:
+            gl.return_value = limiter
+            gr._exec('git fetch origin')
+            self.assertEqual(limiter, ex.call_args[1]['limiter'])
+            self.assertEqual(1, master.call_count)
+            gr._exec('git add f')
+            self.assertEqual(None, ex.call_args[1]['limiter'])
+            self.assertEqual(1, master.call_count)
+        self.assertEqual(None, utils.get_ssh_limiter(self.conf))
+        with patch.dict(self.conf.gerrit, {'ssh_concurrency': 2}), \
+                patch('managesf.services.gerrit.utils._ssh_limiter', None):
+            limiter = utils.get_ssh_limiter(self.conf)
+            self.assertTrue(limiter is utils.get_ssh_limiter(self.conf))
 
     def test_clone(self):
         gr = utils.GerritRepo('p1', self.conf)
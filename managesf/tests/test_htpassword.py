@@ -14,7 +14,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import threading
+
 from unittest import TestCase
+from mock import patch
+
 from managesf.controllers import htp
 from managesf.tests import dummy_conf
 
@@ -34,3 +39,44 @@ class TestHtpasswd(TestCase):
     def test_set_api_password(self):
         self.assertEqual(12,
                          len(self.htp.set_api_password('alice')))
+
+    def test_reload_on_change(self):
+        self.htp.delete('carol')
+        self.htp.set_api_password('bob')
+        # reads are served from memory
+        with patch('managesf.controllers.htp.open', create=True) as o:
+            self.assertTrue(self.htp.user_has_api_password('bob'))
+            self.assertFalse(o.called)
+        # another worker writing the file is noticed
+        other = htp.Htpasswd(self.conf)
+        other.set_api_password('carol')
+        self.assertTrue(self.htp.user_has_api_password('carol'))
+        with open(self.conf.htpasswd['filename'], 'a') as f:
+            f.write('dave:xxx\n')
+        self.assertTrue(self.htp.user_has_api_password('dave'))
+        self.htp.delete('dave')
+        self.assertFalse(other.user_has_api_password('dave'))
+
+    def test_concurrent_writes(self):
+        workers = [htp.Htpasswd(self.conf) for _ in range(4)]
+        users = ['user%s' % i for i in range(20)]
+
+        def set_passwords(worker, names):
+            for name in names:
+                worker.set_api_password(name)
+        threads = [threading.Thread(target=set_passwords,
+                                    args=(w, users[i::4]))
+                   for i, w in enumerate(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # no update was lost and the file is well formed
+        with open(self.conf.htpasswd['filename']) as f:
+            lines = f.read().splitlines()
+        names = [line.split(':', 1)[0] for line in lines]
+        self.assertTrue(set(users) <= set(names))
+        self.assertEqual(len(names), len(set(names)))
+        directory = os.path.dirname(self.conf.htpasswd['filename'])
+        self.assertFalse([n for n in os.listdir(directory)
+                          if n.startswith('.htpasswd')])
@@ -19,6 +19,8 @@ import os
 from unittest import TestCase
 
 from basicauth import encode
+from mock import patch
+from passlib.hash import pbkdf2_sha256
 
 from managesf.controllers import localuser
 from managesf.tests import dummy_conf
@@ -33,6 +35,7 @@ class TestLocaluserController(TestCase):
 
     def setUp(self):
         localuser.model.init_model()
+        localuser._bind_cache = None
 
     def tearDown(self):
         os.unlink(self.conf.sqlalchemy['url'][len('sqlite:///'):])
@@ -161,3 +164,81 @@ class TestLocaluserController(TestCase):
         self.assertDictEqual(expected,
                              localuser.bind_user(authorization),
                              localuser.bind_user(authorization))
+
+    def test_bind_cache(self):
+        infos = {'fullname': u'John Doe',
+                 'email': 'john@tests.dom',
+                 'password': "abc"}
+        localuser.update_user(u'john', infos)
+        authorization = encode('john', "abc")
+        expected = localuser.bind_user(authorization)
+        with patch.object(localuser.pbkdf2_sha256, 'verify') as verify:
+            verify.return_value = False
+            self.assertEqual(expected, localuser.bind_user(authorization))
+            self.assertFalse(verify.called)
+            # a wrong password is not served from the cache
+            self.assertRaises(localuser.BindForbidden,
+                              localuser.bind_user, encode('john', "abd"))
+            self.assertTrue(verify.called)
+        # no plaintext is kept
+        digest, _ = localuser.get_bind_cache()._entries[u'john']
+        self.assertNotIn('abc', digest)
+        # the cache is invalidated when the password changes
+        localuser.update_user(u'john', {'password': "def"})
+        self.assertRaises(localuser.BindForbidden,
+                          localuser.bind_user, authorization)
+        self.assertEqual(expected,
+                         localuser.bind_user(encode('john', "def")))
+        localuser.delete_user(u'john')
+        self.assertRaises(localuser.UserNotFound,
+                          localuser.bind_user, encode('john', "def"))
+
+    def test_bind_cache_other_process(self):
+        infos = {'fullname': u'John Doe',
+                 'email': 'john@tests.dom',
+                 'password': "abc"}
+        localuser.update_user(u'john', infos)
+        authorization = encode('john', "abc")
+        localuser.bind_user(authorization)
+        # another API process changes the password, this process cache
+        # is not invalidated but its entry no longer matches the hash
+        hashed = localuser.encrypt_password('def')
+        localuser.model.update_user(u'john', {'hashed_password': hashed})
+        self.assertRaises(localuser.BindForbidden,
+                          localuser.bind_user, authorization)
+        localuser.model.delete_user(u'john')
+        self.assertRaises(localuser.UserNotFound,
+                          localuser.bind_user, encode('john', "def"))
+
+    def test_bind_cache_expiry(self):
+        cache = localuser.BindCache(size=2, ttl=60)
+        for user in ('john', 'maria', 'denis'):
+            cache.set(user, 'abc', 'hash')
+        self.assertFalse(cache.get('john', 'abc', 'hash'))
+        self.assertTrue(cache.get('denis', 'abc', 'hash'))
+        self.assertFalse(cache.get('denis', 'abc', 'other hash'))
+        self.assertFalse(cache.get('denis', 'abd', 'hash'))
+        cache.invalidate('maria')
+        self.assertFalse(cache.get('maria', 'abc', 'hash'))
+        cache.ttl = 0
+        self.assertFalse(cache.get('denis', 'abc', 'hash'))
+
+    def test_rehash_on_bind(self):
+        infos = {'fullname': u'John Doe',
+                 'email': 'john@tests.dom',
+                 'password': "abc"}
+        localuser.update_user(u'john', infos)
+
+        def rounds():
+            hashed = localuser.model.get_user(u'john')['hashed_password']
+            return pbkdf2_sha256.from_string(hashed).rounds
+        self.assertEqual(localuser.HASH_ROUNDS, rounds())
+        self.conf.localuser = {'hash_rounds': 1000}
+        try:
+            localuser.bind_user(encode('john', "abc"))
+            self.assertEqual(1000, rounds())
+            localuser._bind_cache = None
+            # the new hash still matches the password
+            localuser.bind_user(encode('john', "abc"))
+        finally:
+            del self.conf.localuser
@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from managesf import model
+from managesf.tests import dummy_conf
+
+
+class BaseModelTest(TestCase):
+    @classmethod
+    def setupClass(cls):
+        cls.conf = dummy_conf()
+        model.conf = cls.conf
+
+    def setUp(self):
+        model.init_model()
+
+    def tearDown(self):
+        os.unlink(self.conf.sqlalchemy['url'][len('sqlite:///'):])
+
+
+class TestSessionScope(BaseModelTest):
+    def test_session_reused(self):
+        with model.session_scope() as s1:
+            pass
+        with model.session_scope() as s2:
+            # nested scopes share the session
+            with model.session_scope() as s3:
+                self.assertTrue(s2 is s3)
+        self.assertTrue(s1 is s2)
+        model.SessionHook().after(None)
+        with model.session_scope() as s4:
+            self.assertFalse(s1 is s4)
+
+    def test_nested_commit(self):
+        crud = model.SFUserCRUD()
+        with model.session_scope() as session:
+            with model.session_scope():
+                session.add(model.SFUser(username=u'SpongeBob',
+                                         email='SquarePants',
+                                         fullname=u'Sp. Sq.',
+                                         cauth_id=17))
+            self.assertTrue(session.new)
+        self.assertEqual('17', crud.get(username=u'SpongeBob')['cauth_id'])
+
+    def test_rollback(self):
+        crud = model.SFUserCRUD()
+        try:
+            with model.session_scope() as session:
+                with model.session_scope():
+                    session.add(model.SFUser(username=u'SpongeBob',
+                                             email='SquarePants',
+                                             fullname=u'Sp. Sq.',
+                                             cauth_id=17))
+                raise ValueError('Rollback')
+        except ValueError:
+            pass
+        self.assertEqual({}, crud.get(username=u'SpongeBob'))
+
+
+class TestIndexes(BaseModelTest):
+    def get_indexes(self, table):
+        return dict((i['name'], i['column_names'])
+                    for i in inspect(model.engine).get_indexes(table))
+
+    def test_migrate_indexes(self):
+        self.assertEqual(['cauth_id'],
+                         self.get_indexes('SF_USERS')['ix_SF_USERS_cauth_id'])
+        mapping = 'SF_USERS_SERVICES_MAPPING'
+        self.assertEqual(['service', 'service_user_id'],
+                         self.get_indexes(mapping)['ix_service_user_id'])
+        # tables created by a previous version get the indexes
+        model.engine.execute('DROP INDEX ix_SF_USERS_cauth_id')
+        model.engine.execute('DROP INDEX ix_service_user_id')
+        self.assertNotIn('ix_SF_USERS_cauth_id', self.get_indexes('SF_USERS'))
+        model.init_model()
+        self.assertIn('ix_SF_USERS_cauth_id', self.get_indexes('SF_USERS'))
+        self.assertIn('ix_service_user_id', self.get_indexes(mapping))
+        # and running it again is harmless
+        model.migrate_indexes(model.engine)
+
+
+class TestIterate(BaseModelTest):
+    def setUp(self):
+        super(TestIterate, self).setUp()
+        self.crud = model.SFUserCRUD()
+        self.ids = [self.crud.create(username=u'user%s' % i,
+                                     email='user%s@sftests.com' % i,
+                                     fullname=u'User %s' % i,
+                                     cauth_id=i + 1)
+                    for i in range(7)]
+
+    def test_iterate(self):
+        users = list(self.crud.iterate(page_size=3))
+        self.assertEqual([str(i) for i in self.ids],
+                         [u['id'] for u in users])
+        self.assertEqual(self.crud.get(id=self.ids[0]), users[0])
+
+    def test_pagination(self):
+        ids = [str(i) for i in self.ids]
+        users = list(self.crud.iterate(limit=4, page_size=3))
+        self.assertEqual(ids[:4], [u['id'] for u in users])
+        users = list(self.crud.iterate(limit=4, offset=5, page_size=3))
+        self.assertEqual(ids[5:], [u['id'] for u in users])
+        users = list(self.crud.iterate(after=self.ids[1], page_size=2))
+        self.assertEqual(ids[2:], [u['id'] for u in users])
+        self.assertEqual([], list(self.crud.iterate(after=self.ids[-1])))
+
+    def test_fields(self):
+        users = list(self.crud.iterate(fields=['username', 'cauth_id'],
+                                       page_size=2))
+        self.assertEqual(7, len(users))
+        self.assertEqual({'username': u'user0', 'cauth_id': '1'}, users[0])
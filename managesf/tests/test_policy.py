@@ -16,6 +16,7 @@
 
 import yaml
 import os
+import threading
 from unittest import TestCase
 from webtest import TestApp
 import tempfile
@@ -50,6 +51,27 @@ class TestPolicyEngine(TestCase):
         # Remove the sqlite db
         os.unlink(self.config['sqlalchemy']['url'][len('sqlite:///'):])
 
+    def test_shared_enforcer(self):
+        """Test that the enforcer is not rebuilt for every check"""
+        policy.authorize('managesf.config:get', {}, {})
+        enforcer = policy._ENFORCER
+        errors = []
+
+        def check():
+            try:
+                for i in range(20):
+                    policy.authorize('managesf.config:get', {},
+                                     {'username': 'RickSanchez'})
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertTrue(enforcer is policy._ENFORCER)
+
     def test_config_policies(self):
         """Test the default config endpoint policies"""
         credentials = {}
@@ -19,7 +19,7 @@ import shutil
 import tempfile
 
 from unittest import TestCase
-from mock import patch
+from mock import patch, call, ANY
 
 from managesf.model.yamlbkd import engine
 from managesf.model.yamlbkd.engine import SFResourceBackendEngine
@@ -429,6 +429,14 @@ class EngineTest(TestCase):
             self.assertSetEqual(
                 ret['dummies']['update']['myprojectid']['changed'],
                 set(['members']))
+            # Test the changed keys are unknown on a type change
+            prev = {'resources': {'dummies': {'myprojectid': {
+                    'namespace': 'sf'}}}}
+            new = {'resources': {'dummies': {'myprojectid': {
+                   'namespace': ['sf']}}}}
+            ret = eng._get_data_diff(prev, new)
+            self.assertIsNone(
+                ret['dummies']['update']['myprojectid']['changed'])
 
     def test_validate_changes(self):
         eng = SFResourceBackendEngine(None, None)
@@ -631,6 +639,21 @@ class EngineTest(TestCase):
             self.assertEqual(len(changes['masters']['update']), 1)
             self.assertNotIn('dummies', changes)
 
+        # Engine dectected masters:m1:name and dummies:d1 have been
+        # updated. The changed keys of masters:m1 are no longer
+        # relevant as its dependency must be refreshed too.
+        changes = {'dummies': {'update': {'d1': {}}},
+                   'masters': {'update': {'m1': {'data': {},
+                                                 'changed': set(['name'])}}}}
+
+        en = SFResourceBackendEngine(None, None)
+        with patch.dict(engine.MAPPING,
+                        {'dummies': Dummy,
+                         'masters': Master}):
+            logs = en._resolv_resources_need_refresh(changes, tree)
+            self.assertEqual(len(logs), 0)
+            self.assertNotIn('changed', changes['masters']['update']['m1'])
+
         class Master2(BaseResource):
             MODEL_TYPE = 'master2'
             MODEL = {
@@ -748,6 +771,31 @@ class EngineTest(TestCase):
                               'has been updated.',
                               apply_logs)
 
+            # Verify changed keys are given to the update callback
+            apply_logs = []
+            with patch('managesf.model.yamlbkd.resources.'
+                       'dummy.Dummy.CALLBACKS') as callbacks:
+                changes = {
+                    'dummies': {
+                        'update': {
+                            'myprojectid': {
+                                'data': {'key': 'value'},
+                                'changed': set(['key'])
+                            },
+                            'myprojectid2': {
+                                'data': {'key': 'value'},
+                            }
+                        }
+                    }
+                }
+                callbacks.__getitem__.return_value.return_value = []
+                self.assertFalse(eng._apply_changes(changes, apply_logs, {}))
+                update = callbacks.__getitem__.return_value
+                self.assertIn(call(ANY, {}, {'key': 'value'}, set(['key'])),
+                              update.call_args_list)
+                self.assertIn(call(ANY, {}, {'key': 'value'}, None),
+                              update.call_args_list)
+
             # Verify an unexpected exception is properly catched
             apply_logs = []
             with patch('managesf.model.yamlbkd.resources.'
@@ -20,6 +20,8 @@ from mock import patch
 
 from managesf.tests import dummy_conf
 from managesf.model.yamlbkd.resources.project import ProjectOps
+from managesf.model.yamlbkd.resources.project import Project
+from managesf.model.yamlbkd.resources.storyboard import StoryboardCatalog
 
 
 class ProjectOpsTest(TestCase):
@@ -69,6 +71,30 @@ class ProjectOpsTest(TestCase):
                 self.assertEqual(len(logs), 1)
                 self.assertIn('xyz', logs[0])
 
+    def test_update_changed_keys(self):
+        p = ProjectOps(self.conf, {}, Project.new_run_context())
+        with patch.object(p.stb_ops, 'is_activated') as is_activated:
+            is_activated.return_value = True
+            with patch.object(p.stb_ops, 'update_project_groups') as c:
+                logs = p.update(changed=set(['website', 'contacts']))
+                self.assertFalse(c.called)
+                self.assertEqual(len(logs), 0)
+                logs = p.update(changed=set(['website',
+                                             'source-repositories']))
+                self.assertTrue(c.called)
+                self.assertEqual(len(logs), 0)
+                # Unknown changed keys always sync
+                c.reset_mock()
+                logs = p.update(changed=None)
+                self.assertTrue(c.called)
+        self.assertListEqual(
+            Project.get_apply_summary(p.stb_ops.catalog),
+            ['Storyboard: 1 write(s) skipped as the project '
+             'data was unchanged.'])
+        self.assertListEqual(
+            Project.get_apply_summary(StoryboardCatalog()), [])
+        self.assertListEqual(Project.get_apply_summary(None), [])
+
     def test_delete(self):
         p = ProjectOps(self.conf, None)
         with patch.object(p.stb_ops, 'is_activated') as is_activated:
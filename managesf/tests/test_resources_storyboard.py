@@ -21,6 +21,14 @@ from contextlib import nested
 
 from managesf.tests import dummy_conf
 from managesf.model.yamlbkd.resources.storyboard import StoryboardOps
+from managesf.model.yamlbkd.resources.storyboard import StoryboardCatalog
+
+
+def listing(*items):
+    """get_all side effect serving items as a single page"""
+    def get_all(offset=0, limit=None):
+        return list(items) if offset == 0 else []
+    return get_all
 
 
 class StoryboardOpsTest(TestCase):
@@ -59,23 +67,89 @@ class StoryboardOpsTest(TestCase):
                 self.name = name
                 self.id = id
         conf = dummy_conf()
-        s = StoryboardOps(conf, None)
         patches = [
             patch('storyboardclient.v1.projects.ProjectsManager.get_all'),
             patch('storyboardclient.v1.projects.ProjectsManager.update'),
             patch('storyboardclient.v1.projects.ProjectsManager.create')]
         with nested(*patches) as (get_all, update, create):
-            get_all.return_value = [FakeItem('project1', 1)]
+            s = StoryboardOps(conf, {})
+            get_all.side_effect = listing(FakeItem('project1', 1))
             s.update_project('project1', 'A desc')
             self.assertTrue(get_all.called)
             self.assertTrue(update.called)
             self.assertFalse(create.called)
         with nested(*patches) as (get_all, update, create):
-            get_all.return_value = [FakeItem('project1', 1)]
+            s = StoryboardOps(conf, {})
+            get_all.side_effect = listing(FakeItem('project1', 1))
+            create.return_value = FakeItem('project2', 2)
             s.update_project('project2', 'A desc')
             self.assertTrue(get_all.called)
             self.assertFalse(update.called)
             self.assertTrue(create.called)
+            # The created project is now known by the catalog
+            self.assertEqual(s.catalog.get_project('project2').id, 2)
+        with nested(*patches) as (get_all, update, create):
+            s = StoryboardOps(conf, {})
+            project = FakeItem('project1', 1)
+            project.description = 'A desc'
+            get_all.side_effect = listing(project)
+            s.update_project('project1', 'A desc')
+            self.assertFalse(update.called)
+            self.assertFalse(create.called)
+            self.assertEqual(s.catalog.skipped_writes, 1)
+
+    def test_catalog_shared_by_run(self):
+        class FakeItem(object):
+            def __init__(self, name, id):
+                self.name = name
+                self.id = id
+        conf = dummy_conf()
+        patches = [
+            patch('storyboardclient.v1.projects.ProjectsManager.get_all'),
+            patch('storyboardclient.v1.projects.ProjectsManager.update'),
+            patch('storyboardclient.v1.projects.ProjectsManager.create')]
+        with nested(*patches) as (get_all, update, create):
+            new = {'resources': {}}
+            catalog = StoryboardCatalog()
+            get_all.side_effect = [[FakeItem('project1', 1)], [],
+                                   [FakeItem('project1', 1)], []]
+            create.return_value = FakeItem('project2', 2)
+            StoryboardOps(conf, new, catalog).update_project(
+                'project1', 'A desc')
+            StoryboardOps(conf, new, catalog).update_project(
+                'project2', 'A desc')
+            StoryboardOps(conf, new, catalog).update_project(
+                'project2', 'B desc')
+            # Only one listing has been done for the whole run
+            self.assertEqual(len(get_all.mock_calls), 2)
+            # The catalog is not stored in the resources tree
+            self.assertListEqual(new.keys(), ['resources'])
+            self.assertEqual(len(create.mock_calls), 1)
+            self.assertEqual(len(update.mock_calls), 2)
+            # A new run starts with a fresh catalog
+            StoryboardOps(conf, new, StoryboardCatalog()).update_project(
+                'project1', 'A desc')
+            self.assertEqual(len(get_all.mock_calls), 4)
+
+    def test_catalog_paging(self):
+        class FakeItem(object):
+            def __init__(self, name, id):
+                self.name = name
+                self.id = id
+        with patch('managesf.model.yamlbkd.resources.storyboard.'
+                   'CATALOG_PAGE_SIZE', 2):
+            client = Mock()
+            client.projects.get_all.side_effect = [
+                [FakeItem('project1', 1), FakeItem('project2', 2)],
+                [FakeItem('project3', 3)],
+                []]
+            c = StoryboardCatalog(client)
+            self.assertEqual(c.get_project('project3').id, 3)
+            self.assertIsNone(c.get_project('project4'))
+            self.assertListEqual(client.projects.get_all.call_args_list,
+                                 [call(offset=0, limit=2),
+                                  call(offset=2, limit=2),
+                                  call(offset=3, limit=2)])
 
     def test_update_project_group(self):
         class FakeItem(object):
@@ -92,22 +166,25 @@ class StoryboardOpsTest(TestCase):
             patch('storyboardclient.v1.project_groups.'
                   'ProjectGroupsManager.get'),
             patch('storyboardclient.v1.project_groups.'
-                  'ProjectGroupsManager.update'),
-            patch('storyboardclient.v1.projects.'
-                  'ProjectsManager.get_all')]
+                  'ProjectGroupsManager.update')]
         with nested(*patches) as (get_all, create, update_project,
-                                  get, update, p_get_all):
-            new = {
-                'resources': {
-                    'repos': {
-                        'project1': {'description': 'A desc'},
-                        'project2': {'description': 'A desc'}
+                                  get, update):
+            def get_new():
+                return {
+                    'resources': {
+                        'repos': {
+                            'project1': {'description': 'A desc'},
+                            'project2': {'description': 'A desc'}
+                        }
                     }
                 }
-            }
-            s = StoryboardOps(conf, new)
-            get_all.return_value = [FakeItem('pg1', 1)]
+            get_all.side_effect = listing(FakeItem('pg1', 1))
 
+            projects = {
+                'project1': FakeItem('project1', 1),
+                'project2': FakeItem('project2', 2)}
+            update_project.side_effect = (
+                lambda name, description: projects[name])
             fake_subprojects = [
                 FakeItem('project1', 1),
                 FakeItem('project2', 2)]
@@ -130,17 +207,17 @@ class StoryboardOpsTest(TestCase):
 
             get.return_value = NestedProjects()
             update.return_value = NestedProjects()
-            p_get_all.return_value = fake_subprojects
 
             # Here projects are already included in the project
             # group so nothing will be added/removed in the project
             # group. Just projects will be updated.
+            s = StoryboardOps(conf, get_new())
             s.update_project_groups(
                 **{'name': 'pg1',
                    'source-repositories': ['project1', 'project2']})
             self.assertFalse(mput.called)
             self.assertFalse(mdelete.called)
-            self.assertTrue(len(update_project.mock_calls), 2)
+            self.assertEqual(len(update_project.mock_calls), 2)
 
             # Here project1 and project2 are already included but
             # the resources project decription only defines the
@@ -149,13 +226,23 @@ class StoryboardOpsTest(TestCase):
             mput.reset_mock()
             mdelete.reset_mock()
             update_project.reset_mock()
+            s = StoryboardOps(conf, get_new())
             s.update_project_groups(
                 **{'name': 'pg1',
                    'source-repositories': ['project2']})
             self.assertFalse(mput.called)
             self.assertTrue(mdelete.called)
             self.assertListEqual(mdelete.call_args_list, [call(1)])
-            self.assertTrue(len(update_project.mock_calls), 1)
+            self.assertEqual(len(update_project.mock_calls), 1)
+            # The catalog tracks the membership change so a second
+            # call within the same run has nothing to do
+            mdelete.reset_mock()
+            get.reset_mock()
+            s.update_project_groups(
+                **{'name': 'pg1',
+                   'source-repositories': ['project2']})
+            self.assertFalse(mdelete.called)
+            self.assertFalse(get.called)
 
             # Here only project1 is already included but
             # the resources project decription defines the
@@ -166,33 +253,32 @@ class StoryboardOpsTest(TestCase):
             update_project.reset_mock()
             fake_subprojects = [
                 FakeItem('project1', 1)]
+            s = StoryboardOps(conf, get_new())
             s.update_project_groups(
                 **{'name': 'pg1',
                    'source-repositories': ['project1', 'project2']})
             self.assertTrue(mput.called)
             self.assertListEqual(mput.call_args_list, [call(2)])
             self.assertFalse(mdelete.called)
-            self.assertTrue(len(update_project.mock_calls), 1)
+            self.assertEqual(len(update_project.mock_calls), 2)
 
             # Here the project group does not exist. So we verify
             # it is created and provisionned with two projects
-            # included.
-            get_all.return_value = []
-            p_get_all.return_value = [
-                FakeItem('project1', 1),
-                FakeItem('project2', 2)]
-            fake_subprojects = []
-            get.return_value = NestedProjects()
-            update.return_value = NestedProjects()
+            # included without listing its (empty) content.
+            get_all.side_effect = listing()
+            create.return_value = FakeItem('pg1', 1)
+            get.reset_mock()
             mput.reset_mock()
             mdelete.reset_mock()
             update_project.reset_mock()
+            s = StoryboardOps(conf, get_new())
             s.update_project_groups(
                 **{'name': 'pg1',
                    'source-repositories': ['project1', 'project2']})
             self.assertTrue(create.called)
-            self.assertTrue(len(update_project.mock_calls), 2)
-            self.assertTrue(len(mput.mock_calls), 2)
+            self.assertFalse(get.called)
+            self.assertEqual(len(update_project.mock_calls), 2)
+            self.assertEqual(len(mput.mock_calls), 2)
             self.assertFalse(mdelete.called)
 
     def test_delete_project_group(self):
@@ -212,7 +298,7 @@ class StoryboardOpsTest(TestCase):
                   'ProjectGroupsManager.delete')]
         with nested(*patches) as (get_all, get, update, delete):
             s = StoryboardOps(conf, None)
-            get_all.return_value = [FakeItem('pg1', 3)]
+            get_all.side_effect = listing(FakeItem('pg1', 3))
             mdelete = Mock()
             fake_subprojects = [
                 FakeItem('project1', 1),
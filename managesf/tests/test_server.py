@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import threading
+import time
+import urllib2
+
+from unittest import TestCase
+
+from mock import call, patch
+
+from managesf import server
+
+
+def slow_app(environ, start_response):
+    time.sleep(0.5)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['done']
+
+
+class TestThreadPoolWSGIServer(TestCase):
+    def setUp(self):
+        self.sock = server.listen('127.0.0.1', 0)
+        self.url = 'http://127.0.0.1:%s/' % self.sock.getsockname()[1]
+        self.server = server.ThreadPoolWSGIServer(self.sock, slow_app,
+                                                  threads=4, timeout=5)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop(timeout=5)
+        self.thread.join()
+        self.sock.close()
+
+    def get(self, results):
+        results.append(urllib2.urlopen(self.url).read())
+
+    def test_concurrent_requests(self):
+        results = []
+        clients = [threading.Thread(target=self.get, args=(results, ))
+                   for _ in range(4)]
+        start = time.time()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        self.assertEqual(['done'] * 4, results)
+        # the requests were not served one after the other
+        self.assertTrue(time.time() - start < 1.5)
+
+    def test_graceful_stop(self):
+        results = []
+        client = threading.Thread(target=self.get, args=(results, ))
+        client.start()
+        time.sleep(0.2)
+        self.server.stop(timeout=5)
+        self.thread.join()
+        client.join()
+        # the request in progress was completed
+        self.assertEqual(['done'], results)
+
+
+def broken_load_app():
+    raise ImportError('no module named managesf')
+
+
+class TestSupervisor(TestCase):
+    def setUp(self):
+        self.sock = server.listen('127.0.0.1', 0)
+        self.supervisor = server.Supervisor(self.sock, lambda: slow_app,
+                                            threads=1, ready_timeout=10,
+                                            backoff=0.01, crash_limit=3)
+
+    def tearDown(self):
+        self.supervisor.kill(self.supervisor.children)
+        for pid in self.supervisor.children:
+            os.waitpid(pid, 0)
+        self.sock.close()
+
+    def alive(self, pid):
+        return os.waitpid(pid, os.WNOHANG) == (0, 0)
+
+    def test_ready(self):
+        self.assertEqual(2, self.supervisor.start(2))
+        self.assertEqual(set(), self.supervisor.retiring)
+        self.supervisor.load_app = broken_load_app
+        self.assertEqual(0, self.supervisor.start(2))
+        self.assertEqual(2, len(self.supervisor.retiring))
+
+    def test_reload_keeps_old_workers(self):
+        self.supervisor.start(1)
+        old = set(self.supervisor.children)
+        # the new workers cannot load the application
+        self.supervisor.load_app = broken_load_app
+        self.supervisor.reload()
+        for pid in old:
+            self.assertTrue(self.alive(pid))
+        self.assertEqual(self.supervisor.children - old,
+                         self.supervisor.retiring)
+        # the new workers replace the old ones once they are ready
+        self.supervisor.load_app = lambda: slow_app
+        self.supervisor.reload()
+        self.assertTrue(old.issubset(self.supervisor.retiring))
+
+    def test_replace_backoff(self):
+        self.supervisor.load_app = broken_load_app
+        with patch.object(self.supervisor, 'sleep') as sleep:
+            self.supervisor.replace()
+        self.assertEqual(3, self.supervisor.failures)
+        self.assertTrue(self.supervisor._stop)
+        self.assertEqual([call(0.01), call(0.02)], sleep.call_args_list)
+        self.supervisor.load_app = lambda: slow_app
+        self.supervisor._stop = False
+        self.supervisor.failures = 1
+        with patch.object(self.supervisor, 'sleep'):
+            self.supervisor.replace()
+        self.assertEqual(0, self.supervisor.failures)
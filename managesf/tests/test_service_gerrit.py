@@ -14,8 +14,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import threading
+import time
+
 from unittest import TestCase
-from mock import patch, call
+from mock import patch, call, MagicMock
+from requests.exceptions import HTTPError
 
 from managesf.tests import dummy_conf
 from managesf.services import gerrit
@@ -95,20 +99,49 @@ class TestSFGerritUserManager(BaseSFGerritService):
             sql = """DELETE FROM account_group_members WHERE account_id=5;
 DELETE FROM accounts WHERE account_id=5;
 DELETE FROM account_external_ids WHERE account_id=5;"""
+            flush = ('gerrit flush-caches --cache accounts '
+                     '--cache accounts_byemail --cache accounts_byname '
+                     '--cache groups_members')
             self.gerrit.user.delete(email='jojo@starplatinum.dom')
             session.execute.assert_called_with(sql)
-            calls = [call('gerrit flush-caches --cache %s' % c)
-                     for c in ('accounts', 'accounts_byemail',
-                               'accounts_byname', 'groups_members')]
-            ssh.assert_has_calls(calls)
+            ssh.assert_called_once_with(flush)
             session.reset_mock()
             ssh.reset_mock()
             self.gerrit.user.delete(username='jojo@starplatinum.dom')
             session.execute.assert_called_with(sql)
-            calls = [call('gerrit flush-caches --cache %s' % c)
-                     for c in ('accounts', 'accounts_byemail',
-                               'accounts_byname', 'groups_members')]
-            ssh.assert_has_calls(calls)
+            ssh.assert_called_once_with(flush)
+
+    def test_delete_many(self):
+        accounts = {'jojo': 5, 'dio@world.dom': 9, 'polnareff': 7}
+        with patch.object(self.gerrit.user, 'get') as get, \
+                patch.object(self.gerrit.user, 'session') as session, \
+                patch('managesf.services.gerrit.user.G.Gerrit._ssh') as ssh:
+            get.side_effect = lambda email=None, username=None: \
+                accounts.get(email or username)
+            ids = self.gerrit.user.delete_many(
+                emails=['dio@world.dom'],
+                usernames=['jojo', 'polnareff', 'unknown', 'jojo'])
+            self.assertEqual([5, 7, 9], ids)
+            session.execute.assert_has_calls(
+                [call('DELETE FROM %s WHERE account_id IN (5, 7, 9);' % t)
+                 for t in ('account_group_members', 'accounts',
+                           'account_external_ids')])
+            self.assertEqual(1, session.commit.call_count)
+            self.assertEqual(1, ssh.call_count)
+            self.assertIn('--cache groups_members', ssh.call_args[0][0])
+            # nothing to delete
+            session.reset_mock()
+            ssh.reset_mock()
+            self.assertEqual([], self.gerrit.user.delete_many(
+                usernames=['unknown']))
+            self.assertFalse(session.execute.called)
+            self.assertFalse(ssh.called)
+            # the transaction is rolled back on error
+            session.execute.side_effect = Exception('Deadlock')
+            self.assertRaises(Exception, self.gerrit.user.delete_many,
+                              usernames=['jojo'])
+            self.assertTrue(session.rollback.called)
+            self.assertFalse(ssh.called)
 
 
 def ggi_side_effect(grp_name):
@@ -130,3 +163,44 @@ class TestSFGerritGroupManager(BaseSFGerritService):
             d.return_value = ['user1@sftests.com']
             ret = self.gerrit.group.get('grp1')
             self.assertIn('user1@sftests.com', ret['grp1'])
+
+
+class TestGerritClientPool(TestCase):
+    def test_single_flight(self):
+        calls = []
+
+        def get_cookie():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'cookie%s' % len(calls)
+        pool = gerrit.GerritClientPool('http://gerrit/', get_cookie)
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(pool.get()))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # one thread fetched the cookie for all of them
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, len(set(id(c) for c in clients)))
+        self.assertEqual({'hits': 4, 'misses': 1}, pool.stats())
+        # renewed once expired
+        pool._date -= gerrit.COOKIE_VALIDITY + 1
+        self.assertEqual('cookie2', pool.get().auth_cookie)
+
+    def test_renew_on_401(self):
+        pool = gerrit.GerritClientPool('http://gerrit/', lambda: 'cookie')
+        client = gerrit.PooledGerritClient(pool)
+        denied = HTTPError(response=MagicMock(status_code=401))
+        with patch('pysflib.sfgerrit.GerritUtils.get_account') as ga:
+            ga.side_effect = [denied, {'username': 'jojo'}]
+            self.assertEqual({'username': 'jojo'}, client.get_account('jojo'))
+            self.assertEqual({'hits': 0, 'misses': 2}, pool.stats())
+            ga.side_effect = HTTPError(response=MagicMock(status_code=404))
+            self.assertRaises(HTTPError, client.get_account, 'dio')
+            self.assertEqual({'hits': 1, 'misses': 2}, pool.stats())
+        # the pool is shared by the plugins of the same Gerrit
+        conf = dummy_conf()
+        self.assertTrue(gerrit.SoftwareFactoryGerrit(conf).get_pool() is
+                        gerrit.SoftwareFactoryGerrit(conf).get_pool())
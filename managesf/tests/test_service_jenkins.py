@@ -15,13 +15,16 @@
 # under the License.
 
 import json
-from urllib import quote_plus
+from urllib import quote
 from unittest import TestCase
-from mock import patch
+from mock import patch, Mock
+from six.moves.urllib.request import Request
 
-from jenkins import Jenkins as SFJenkins
+from jenkins import JenkinsException, NotFoundException
 
+from managesf.services import exceptions
 from managesf.services import jenkins
+from managesf.services.jenkins.client import SFJenkinsClient as SFJenkins
 from managesf.tests import dummy_conf
 
 
@@ -53,6 +56,31 @@ SAMPLE_JENKINS_JOB_DESC = json.dumps(
      u'timestamp': 1479820746633,
      u'url': u'https://sftests.com/jenkins/sample-unit-tests/3700/'})
 
+SAMPLE_JENKINS_BUILDS = json.dumps(
+    {u'allBuilds': [
+        {u'number': 4, u'building': False, u'result': u'SUCCESS',
+         u'actions': [{u'parameters': [{u'name': u'ZUUL_CHANGE',
+                                        u'value': u'5424'},
+                                       {u'name': u'ZUUL_PATCHSET',
+                                        u'value': u'1'}]}, {}]},
+        {u'number': 3, u'building': True, u'result': None,
+         u'actions': [{u'parameters': [{u'name': u'ZUUL_CHANGE',
+                                        u'value': u'5423'},
+                                       {u'name': u'ZUUL_PATCHSET',
+                                        u'value': u'13'}]}, {}]},
+        {u'number': 2, u'building': False, u'result': u'FAILURE',
+         u'actions': [{u'parameters': [{u'name': u'ZUUL_CHANGE',
+                                        u'value': u'5423'},
+                                       {u'name': u'ZUUL_PATCHSET',
+                                        u'value': u'12'}]}, {}]},
+        {u'number': 1, u'building': False, u'result': u'SUCCESS',
+         u'actions': [{}, {u'parameters': [{u'name': u'ZUUL_CHANGE',
+                                            u'value': u'5423'},
+                                           {u'name': u'ZUUL_PATCHSET',
+                                            u'value': u'12'}]}]},
+        {u'number': 0, u'building': False, u'result': u'ABORTED',
+         u'actions': [{}]}]})
+
 
 class BaseSFJenkinsService(TestCase):
     @classmethod
@@ -68,6 +96,9 @@ class BaseSFJenkinsService(TestCase):
 
 
 class TestSFJenkinsManager(BaseSFJenkinsService):
+    def setUp(self):
+        self.jenkins.job.builds_cache = jenkins.job.BuildInfoCache()
+
     def test_get_job(self):
         with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
             jenkins_open.return_value = SAMPLE_JENKINS_JOB_DESC
@@ -92,38 +123,47 @@ class TestSFJenkinsManager(BaseSFJenkinsService):
                              jobs[0]['job_id'])
             self.assertEqual('SUCCESS',
                              jobs[0]['status'])
-        with patch.object(SFJenkins, 'jenkins_open') as jenkins_open, \
-                patch.object(SFJenkins, 'run_script') as run_script:
-            jenkins_open.return_value = SAMPLE_JENKINS_JOB_DESC
-            expected_filter = {'JOB_NAME': 'myjob',
-                               'FILTER_CONDITION': None}
-            filter = 'change == "5423"'
-            expected_filter['FILTER_CONDITION'] = filter
-            run_script.return_value = "Result: 1 2 3 4\n"
+        with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
+            jenkins_open.return_value = SAMPLE_JENKINS_BUILDS
             jobs = self.jenkins.job.get_job('myjob', change=5423)
-            expected_script = quote_plus(
-                jenkins.job.GROOVY_JOB_FILTER % expected_filter)
-            run_script.assert_called_with(expected_script)
-            self.assertEqual(4,
-                             len(jobs))
-            filter = 'change == "5423" && patchset == "12"'
-            expected_filter['FILTER_CONDITION'] = filter
-            run_script.return_value = "Result: 1 3"
+            # A single query is done for all the builds
+            self.assertEqual(1, len(jenkins_open.mock_calls))
+            url = jenkins_open.call_args[0][0].get_full_url()
+            self.assertIn('/job/myjob/api/json?tree=allBuilds', url)
+            self.assertEqual([3, 2, 1],
+                             [j['job_id'] for j in jobs])
+            self.assertEqual(['IN_PROGRESS', 'FAILURE', 'SUCCESS'],
+                             [j['status'] for j in jobs])
             jobs = self.jenkins.job.get_job('myjob', change=5423,
                                             patchset=12)
-            expected_script = quote_plus(
-                jenkins.job.GROOVY_JOB_FILTER % expected_filter)
-            run_script.assert_called_with(expected_script)
-            self.assertEqual(2,
-                             len(jobs))
-            run_script.return_value = "Result: "
-            jobs = self.jenkins.job.get_job('myjob', change=5423)
+            self.assertEqual([2, 1],
+                             [j['job_id'] for j in jobs])
+            jobs = self.jenkins.job.get_job('myjob', change=5423,
+                                            limit=1, offset=1)
+            self.assertEqual([2],
+                             [j['job_id'] for j in jobs])
+            jobs = self.jenkins.job.get_job('myjob', change=1)
             self.assertEqual(0,
                              len(jobs))
-            run_script.return_value = ""
-            jobs = self.jenkins.job.get_job('myjob', change=5423)
+            self.assertRaisesRegexp(exceptions.InvalidParameterError,
+                                    "Invalid limit value: abc",
+                                    self.jenkins.job.get_job,
+                                    job_name='myjob', limit='abc')
+        with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
+            jenkins_open.return_value = SAMPLE_JENKINS_BUILDS
+            # Without filter the paging is done by Jenkins
+            jobs = self.jenkins.job.get_job('myjob', limit='2', offset='1')
+            url = jenkins_open.call_args[0][0].get_full_url()
+            self.assertTrue(url.endswith(quote('{1,3}')))
+            jenkins_open.return_value = json.dumps({'allBuilds': []})
+            jobs = self.jenkins.job.get_job('myjob')
+            url = jenkins_open.call_args[0][0].get_full_url()
+            self.assertTrue(url.endswith('[name,value]]]'))
             self.assertEqual(0,
                              len(jobs))
+        with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
+            jenkins_open.side_effect = NotFoundException
+            self.assertEqual([], self.jenkins.job.get_job('nojob'))
 
     def test_get_job_parameters(self):
         with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
@@ -155,14 +195,49 @@ class TestSFJenkinsManager(BaseSFJenkinsService):
         job_in_progress['result'] = None
         with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
             jenkins_open.return_value = json.dumps(job_in_progress)
-            job = self.jenkins.job.get_job_status('myjob', 1234)
+            job = self.jenkins.job.get_job_status('myjob', 1235)
             self.assertEqual('myjob',
                              job['job_name'])
-            self.assertEqual(1234,
+            self.assertEqual(1235,
                              job['job_id'])
             self.assertEqual('IN_PROGRESS',
                              job['status'])
 
+    def test_build_info_cache(self):
+        job_in_progress = json.loads(SAMPLE_JENKINS_JOB_DESC)
+        job_in_progress['building'] = True
+        job_in_progress['result'] = None
+        with patch.object(SFJenkins, 'jenkins_open') as jenkins_open:
+            jenkins_open.return_value = SAMPLE_JENKINS_JOB_DESC
+            self.jenkins.job.get_job_status('myjob', 1234)
+            self.jenkins.job.get_job_logs('myjob', 1234)
+            self.jenkins.job.get_job_parameters('myjob', '1234')
+            # A finished build is only fetched once
+            self.assertEqual(1, len(jenkins_open.mock_calls))
+            jenkins_open.return_value = json.dumps(job_in_progress)
+            self.jenkins.job.get_job_status('myjob', 1235)
+            self.jenkins.job.get_job_status('myjob', 1235)
+            self.assertEqual(2, len(jenkins_open.mock_calls))
+        with patch.object(SFJenkins, 'jenkins_open') as jenkins_open, \
+                patch('managesf.services.jenkins.job.time.time') as t:
+            # In progress builds expire after the TTL
+            t.return_value = 2000000000
+            jenkins_open.return_value = SAMPLE_JENKINS_JOB_DESC
+            job = self.jenkins.job.get_job_status('myjob', 1235)
+            self.assertEqual(1, len(jenkins_open.mock_calls))
+            self.assertEqual('SUCCESS',
+                             job['status'])
+        cache = jenkins.job.BuildInfoCache(size=2)
+        cache.set(('myjob', 1), {'result': 'SUCCESS'})
+        cache.set(('myjob', 2), {'result': 'SUCCESS'})
+        cache.get(('myjob', 1))
+        cache.set(('myjob', 3), {'result': 'SUCCESS'})
+        # The least recently used entry has been evicted
+        self.assertIsNone(cache.get(('myjob', 2)))
+        self.assertIsNotNone(cache.get(('myjob', 1)))
+        cache.invalidate(('myjob', 1))
+        self.assertIsNone(cache.get(('myjob', 1)))
+
     def test_get_job_logs(self):
         l = ('https://sftests.com/jenkins/sample-unit-tests/'
              '3700/timestamps/?time=MMM+dd+HH:mm:ss.SSS&appendLog')
@@ -195,3 +270,56 @@ class TestSFJenkinsManager(BaseSFJenkinsService):
             jenkins_open.return_value = SAMPLE_JENKINS_JOB_DESC
             self.jenkins.job.stop('myjob', 4567)
             stop_build.assert_called_with('myjob', 4567)
+
+
+class TestSFJenkinsClient(BaseSFJenkinsService):
+    def test_get_client(self):
+        c = self.jenkins.get_client()
+        self.assertTrue(isinstance(c, SFJenkins))
+        self.assertTrue(c is self.jenkins.get_client())
+
+    def test_jenkins_open(self):
+        def resp(status_code, content='', reason='reason'):
+            r = Mock()
+            r.status_code = status_code
+            r.reason = reason
+            r.content = content
+            return r
+        crumb = json.dumps({'crumbRequestField': 'Jenkins-Crumb',
+                            'crumb': 'abc'})
+        c = SFJenkins('http://jenkins.tests.dom/', 'user', 'password')
+        with patch.object(c.session, 'request') as request:
+            request.side_effect = [resp(200, crumb), resp(200, 'data'),
+                                   resp(200, 'data')]
+            url = 'http://jenkins.tests.dom/api/json'
+            self.assertEqual('data', c.jenkins_open(Request(url)))
+            self.assertEqual('data', c.jenkins_open(Request(url)))
+            # The crumb is fetched only once
+            self.assertEqual(3, len(request.mock_calls))
+            headers = request.call_args[1]['headers']
+            self.assertEqual('abc', headers['Jenkins-crumb'])
+            self.assertIn('Authorization', headers)
+            # An expired crumb is refreshed and the request retried
+            crumb2 = json.dumps({'crumbRequestField': 'Jenkins-Crumb',
+                                 'crumb': 'def'})
+            request.reset_mock()
+            invalid = 'No valid crumb was included in the request'
+            request.side_effect = [resp(403, reason=invalid),
+                                   resp(200, crumb2), resp(200, 'data')]
+            self.assertEqual('data', c.jenkins_open(Request(url)))
+            self.assertEqual(3, len(request.mock_calls))
+            headers = request.call_args[1]['headers']
+            self.assertEqual('def', headers['Jenkins-crumb'])
+            # A permission denial is not retried
+            request.reset_mock()
+            request.side_effect = [resp(403, 'Access denied', 'Forbidden')]
+            self.assertRaises(JenkinsException,
+                              c.jenkins_open, Request(url))
+            self.assertEqual(1, len(request.mock_calls))
+            self.assertEqual('def', c.crumb['crumb'])
+            request.side_effect = [resp(404)]
+            self.assertRaises(NotFoundException,
+                              c.jenkins_open, Request(url))
+            request.side_effect = [resp(401)]
+            self.assertRaises(JenkinsException,
+                              c.jenkins_open, Request(url))
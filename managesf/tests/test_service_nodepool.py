@@ -17,6 +17,7 @@
 
 import os
 import time
+from Queue import Queue
 from StringIO import StringIO
 from unittest import TestCase
 from mock import patch, ANY
@@ -45,6 +46,9 @@ class Fakechannel:
     def recv_exit_status(self):
         return self.code
 
+    def close(self):
+        pass
+
     # simulate execution time
     def exit_status_ready(self):
         if time.time() - self.start_time > self.exec_time:
@@ -58,6 +62,25 @@ class Stdout(StringIO):
         self.channel = Fakechannel(exit_code)
 
 
+class BlockingStdout(object):
+    """stdout of a command still running, fed line by line"""
+    def __init__(self, exit_code=0):
+        self.lines = Queue()
+        self.channel = Fakechannel(exit_code)
+
+    def feed(self, line):
+        # None ends the output
+        self.lines.put(line)
+        # let the worker drain it
+        time.sleep(0.1)
+
+    def readline(self):
+        line = self.lines.get(timeout=10)
+        if line is None:
+            return ''
+        return line
+
+
 class BaseSFNodepoolService(TestCase):
     @classmethod
     def setupClass(cls):
@@ -67,6 +90,18 @@ class BaseSFNodepoolService(TestCase):
 
     def setUp(self):
         nodepool.image.model.init_model()
+        # do not reuse a connection opened with another test's mocks
+        self.nodepool.client.close()
+        self.nodepool.client._pkey = None
+        # listings are refreshed on demand only
+        for manager in (self.nodepool.node, self.nodepool.image):
+            manager.snapshot.interval = 0
+            manager.snapshot.invalidate()
+
+    def wait_for_update(self, update_id):
+        worker = nodepool.image.UPDATES.get(update_id)
+        if worker is not None:
+            worker.join(10)
 
     def tearDown(self):
         os.unlink(self.conf.sqlalchemy['url'][len('sqlite:///'):])
@@ -74,18 +109,31 @@ class BaseSFNodepoolService(TestCase):
 
 class TestSFNodepoolManager(BaseSFNodepoolService):
 
-    @patch('managesf.services.nodepool.paramiko')
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_get_client(self, paramiko):
-        with self.nodepool.get_client() as client:
-            client.do_something('dummy command')
-            k = self.conf.nodepool['key']
-            paramiko.RSAKey.from_private_key_file.assert_called_with(k)
-            paramiko.SSHClient().connect.assert_called_with(
-                hostname=self.conf.nodepool['host'],
-                username=self.conf.nodepool['user'],
-                pkey=ANY)
-
-    @patch('managesf.services.nodepool.paramiko')
+        client = self.nodepool.get_client()
+        self.assertTrue(client is self.nodepool.get_client())
+        client.exec_command('dummy command')
+        client.exec_command('another command')
+        k = self.conf.nodepool['key']
+        paramiko.RSAKey.from_private_key_file.assert_called_once_with(k)
+        paramiko.SSHClient().connect.assert_called_once_with(
+            hostname=self.conf.nodepool['host'],
+            username=self.conf.nodepool['user'],
+            pkey=ANY)
+        paramiko.SSHClient().get_transport().set_keepalive.assert_called_with(
+            30)
+        self.assertEqual(2, len(paramiko.SSHClient().exec_command.mock_calls))
+        # a dead transport is detected and the connection reopened
+        paramiko.SSHClient().get_transport().is_active.return_value = False
+        client.exec_command('dummy command')
+        self.assertEqual(2, len(paramiko.SSHClient().connect.mock_calls))
+        self.assertTrue(paramiko.SSHClient().close.called)
+        # the key is parsed only once
+        self.assertEqual(
+            1, len(paramiko.RSAKey.from_private_key_file.mock_calls))
+
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_node_get(self, paramiko):
         self.assertRaisesRegexp(Exception, "invalid node id 'WRYYY'",
                                 self.nodepool.node.get, "WRYYY")
@@ -115,11 +163,11 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
                                                           Stdout(stdout, 3),
                                                           StringIO(stderr))
         self.assertRaisesRegexp(Exception, stderr,
-                                self.nodepool.node.get)
+                                self.nodepool.node.get, refresh=True)
         self.assertRaisesRegexp(Exception, "3",
-                                self.nodepool.node.get)
+                                self.nodepool.node.get, refresh=True)
 
-    @patch('managesf.services.nodepool.paramiko')
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_node_hold(self, paramiko):
         self.assertRaisesRegexp(Exception, "invalid node id 'WRYYY'",
                                 self.nodepool.node.hold, "WRYYY")
@@ -139,7 +187,7 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
         self.assertRaisesRegexp(Exception, "5",
                                 self.nodepool.node.hold, 66)
 
-    @patch('managesf.services.nodepool.paramiko')
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_node_delete(self, paramiko):
         self.assertRaisesRegexp(Exception, "invalid node id 'WRYYY'",
                                 self.nodepool.node.hold, "WRYYY")
@@ -160,7 +208,7 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
         self.assertRaisesRegexp(Exception, "17",
                                 self.nodepool.node.delete, 66)
 
-    @patch('managesf.services.nodepool.paramiko')
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_node_add_authorized_key(self, paramiko):
         k = "ssh-rsa blahblahblah iggy@fool"
         self.assertRaisesRegexp(Exception, "invalid node id 'WRYYY'",
@@ -198,7 +246,7 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
                                     self.nodepool.node.add_authorized_key,
                                     2, k)
 
-    @patch('managesf.services.nodepool.paramiko')
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_image_get(self, paramiko):
         stdout = IMAGE_GET_STDOUT
         stderr = ''
@@ -239,11 +287,70 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
                                                           Stdout(stdout, 99),
                                                           StringIO(stderr))
         self.assertRaisesRegexp(Exception, stderr,
-                                self.nodepool.image.get)
+                                self.nodepool.image.get, refresh=True)
         self.assertRaisesRegexp(Exception, "99",
-                                self.nodepool.image.get)
+                                self.nodepool.image.get, refresh=True)
 
-    @patch('managesf.services.nodepool.paramiko')
+    @patch('managesf.services.nodepool.client.paramiko')
+    def test_listing_snapshot(self, paramiko):
+        exec_command = paramiko.SSHClient().exec_command
+        exec_command.side_effect = lambda *a, **kw: (StringIO(''),
+                                                     Stdout(NODE_GET_STDOUT),
+                                                     StringIO(''))
+        self.assertIsNone(self.nodepool.node.snapshot.age)
+        self.assertEqual(3, len(self.nodepool.node.get()))
+        nodes = self.nodepool.node.get(node_id=99242)
+        self.assertEqual('c', nodes[0]['server_id'])
+        nodes = self.nodepool.node.get(label='sfstack-centos-7')
+        self.assertEqual('102639', nodes[0]['node_id'])
+        nodes = self.nodepool.node.get(provider_name='rcip-dev',
+                                       label='skydive-centos-7')
+        self.assertEqual('99242', nodes[0]['node_id'])
+        # reads are served from memory
+        self.assertEqual(1, len(exec_command.mock_calls))
+        self.assertTrue(self.nodepool.node.snapshot.age >= 0)
+        self.nodepool.node.get(refresh=True)
+        self.assertEqual(2, len(exec_command.mock_calls))
+        # a node action makes the snapshot stale
+        self.nodepool.node.hold(99242)
+        self.nodepool.node.get()
+        self.assertEqual(4, len(exec_command.mock_calls))
+
+    def test_listing_snapshot_invalidated_while_fetched(self):
+        listings = [[{'id': 'stale'}], [{'id': 'fresh'}]]
+
+        def fetch():
+            # a node action invalidates the listing while it is fetched
+            if len(listings) == 2:
+                snapshot.invalidate()
+            return listings.pop(0)
+        snapshot = nodepool.common.ListingSnapshot('test', fetch, ['id'],
+                                                   interval=0)
+        snapshot.refresh()
+        self.assertIsNone(snapshot.timestamp)
+        self.assertEqual([{'id': 'fresh'}], snapshot.get())
+        self.assertEqual([], listings)
+
+    @patch('managesf.services.nodepool.client.paramiko')
+    def test_client_retry(self, paramiko):
+        paramiko.SSHException = Exception
+        exec_command = paramiko.SSHClient().exec_command
+        client = self.nodepool.get_client()
+        exec_command.side_effect = [Exception('dropped'), 'listed']
+        self.assertEqual('listed',
+                         client.exec_command('nodepool list', read_only=True))
+        self.assertEqual(2, len(paramiko.SSHClient().connect.mock_calls))
+        # a command that may have run is not sent twice
+        exec_command.side_effect = [Exception('dropped'), 'deleted']
+        self.assertRaises(Exception,
+                          client.exec_command, 'nodepool delete 4')
+        self.assertEqual(3, len(exec_command.mock_calls))
+        # but the broken connection is reopened for the next command
+        exec_command.side_effect = None
+        client.exec_command('nodepool hold 4')
+        self.assertEqual(3, len(paramiko.SSHClient().connect.mock_calls))
+
+    @patch('managesf.services.nodepool.client.paramiko')
     def test_image_update(self, paramiko):
         self.assertRaisesRegexp(Exception, "invalid provider",
                                 self.nodepool.image.start_update,
@@ -256,7 +363,6 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
 
         # Simple workflow
         stdout = Stdout(u'rebuilding image')
-        stdout.channel.exec_time = 0
         stderr = u''
         process = (StringIO(''),
                    stdout,
@@ -266,50 +372,73 @@ class TestSFNodepoolManager(BaseSFNodepoolService):
         m = ('nodepool image-update provider image')
         paramiko.SSHClient().exec_command.assert_called_with(m, get_pty=True)
         self.assertTrue(isinstance(u, int), type(u))
-        self.assertTrue(u in nodepool.image.UPDATES_CACHE)
+        self.wait_for_update(u)
         v = self.nodepool.image.get_update_info(u)
         self.assertEqual(u, v['id'])
         self.assertEqual(0, int(v['exit_code']))
         self.assertEqual('SUCCESS', v['status'])
         self.assertEqual('rebuilding image', v['output'])
         self.assertEqual(stderr, v['error'])
-        # cache should have been updated
-        self.assertTrue(u not in nodepool.image.UPDATES_CACHE)
+        # the worker is gone once the update is over
+        self.assertTrue(u not in nodepool.image.UPDATES)
 
-        # Long operation
-        stdout = Stdout(u'rebuilding image another time')
-        stdout.channel.exec_time = 10000
+        # Long operation, the output is followed while in progress
+        stdout = BlockingStdout()
         process = (StringIO(''),
                    stdout,
                    StringIO(stderr))
         paramiko.SSHClient().exec_command.return_value = process
         u = self.nodepool.image.start_update('provider', 'image')
-        v = self.nodepool.image.get_update_info(u)
+        v = self.nodepool.image.get_update_info(u, offset=0)
         self.assertEqual(u, v['id'])
         self.assertEqual('IN_PROGRESS', v['status'])
-        # still cached, until completion
-        self.assertTrue(u in nodepool.image.UPDATES_CACHE)
+        self.assertEqual('', v['output'])
+        self.assertEqual(0, v['offset'])
+        stdout.feed(u'rebuilding image\n')
+        v = self.nodepool.image.get_update_info(u, offset=0)
+        self.assertEqual('IN_PROGRESS', v['status'])
+        self.assertEqual('rebuilding image\n', v['output'])
+        self.assertEqual(17, v['offset'])
+        stdout.feed(u'another time\n')
+        v = self.nodepool.image.get_update_info(u, offset=17)
+        self.assertEqual('another time\n', v['output'])
+        self.assertEqual(30, v['offset'])
+        self.assertTrue(u in nodepool.image.UPDATES)
         # finish the build
-        stdout.channel.exec_time = 0
+        stdout.feed(None)
+        self.wait_for_update(u)
         v = self.nodepool.image.get_update_info(u)
         self.assertEqual(u, v['id'])
         self.assertEqual(0, int(v['exit_code']))
         self.assertEqual('SUCCESS', v['status'])
-        self.assertEqual('rebuilding image another time', v['output'])
-        # cache should have been updated
-        self.assertTrue(u not in nodepool.image.UPDATES_CACHE)
+        self.assertEqual('rebuilding image\nanother time\n', v['output'])
+        v = self.nodepool.image.get_update_info(u, offset=17)
+        self.assertEqual('another time\n', v['output'])
+        self.assertEqual(30, v['offset'])
 
         # Error during image update
         stdout = Stdout(u'Uh oh!', exit_code=128)
-        stdout.channel.exec_time = 0
         stderr = u'A very helpful error message'
         process = (StringIO(''),
                    stdout,
                    StringIO(stderr))
         paramiko.SSHClient().exec_command.return_value = process
         u = self.nodepool.image.start_update('provider', 'image')
+        self.wait_for_update(u)
         v = self.nodepool.image.get_update_info(u)
         self.assertEqual(u, v['id'])
         self.assertEqual('FAILURE', v['status'])
         self.assertEqual(stderr, v['error'])
         self.assertEqual(128, int(v['exit_code']))
+
+    def test_update_output(self):
+        o = nodepool.image.UpdateOutput(size=10)
+        o.append(u'0123456')
+        o.append(u'789')
+        self.assertEqual((u'56789', 10), o.read(5))
+        o.append(u'abcd')
+        # the oldest chunk has been dropped from the tail
+        self.assertIsNone(o.read(5))
+        self.assertEqual((u'9abcd', 14), o.read(9))
+        self.assertEqual((u'', 14), o.read(14))
+        self.assertIsNone(o.read(15))
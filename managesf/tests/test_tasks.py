@@ -0,0 +1,128 @@
+#
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import socket
+
+from unittest import TestCase
+
+from managesf import model
+from managesf.controllers import tasks
+from managesf.tests import dummy_conf
+
+
+def run(params, logs, worker):
+    logs.append('applying %s' % params['commit'])
+    logs.extend(['step 1', 'step 2'])
+    if params['commit'] == 'bad':
+        raise Exception('Bad commit')
+    return params['commit'] != 'partial'
+
+
+class TestTaskQueue(TestCase):
+    @classmethod
+    def setupClass(cls):
+        cls.conf = dummy_conf()
+        model.conf = cls.conf
+
+    def setUp(self):
+        model.init_model()
+        self.queue = tasks.TaskQueue('test', run)
+
+    def tearDown(self):
+        tasks.QUEUES.remove(self.queue)
+        os.unlink(self.conf.sqlalchemy['url'][len('sqlite:///'):])
+
+    def test_submit(self):
+        self.assertEqual((True, ['applying abc', 'step 1', 'step 2']),
+                         self.queue.submit({'commit': 'abc'}, wait=True))
+        self.assertFalse(self.queue.submit({'commit': 'partial'},
+                                           wait=True)[0])
+        success, logs = self.queue.submit({'commit': 'bad'}, wait=True)
+        self.assertFalse(success)
+        self.assertEqual('Bad commit', logs[-1])
+        task = self.queue.get(1)
+        self.assertEqual('SUCCESS', task['status'])
+        self.assertEqual(u'applying abc\nstep 1\nstep 2\n', task['output'])
+        self.assertEqual(u'step 2\n', self.queue.get(1, 20)['output'])
+        self.assertEqual('FAILURE', self.queue.get(3)['status'])
+        # tasks of other kinds are not visible
+        self.assertEqual({}, tasks.TaskQueue('other', run).get(1))
+
+    def test_recover(self):
+        crud = model.TasksCRUD()
+        dead = '%s:%s' % (socket.gethostname(), os.getpid())
+        other_host = 'elsewhere:1'
+        params = json.dumps({'commit': 'abc'})
+        running = crud.create('test', params, dead)
+        crud.claim(running, dead)
+        queued = crud.create('test', params, dead)
+        remote = crud.create('test', params, other_host)
+        # the tasks are recovered when the app is loaded, before any submit
+        tasks.start_queues()
+        self.assertEqual('INTERRUPTED', self.queue.get(running)['status'])
+        self.assertEqual(u'Interrupted by a restart of managesf\n',
+                         self.queue.get(running)['output'])
+        # another process of the host does not interrupt it again
+        self.assertFalse(crud.interrupt(running))
+        # the queued task is run by the new process
+        for i in range(50):
+            if self.queue.get(queued)['status'] == 'SUCCESS':
+                break
+            import time
+            time.sleep(0.1)
+        self.assertEqual('SUCCESS', self.queue.get(queued)['status'])
+        # tasks of other hosts are left alone
+        self.assertEqual('QUEUED', self.queue.get(remote)['status'])
+        # a task is run once
+        self.assertFalse(crud.claim(queued, dead))
+
+    def test_log_batches(self):
+        crud = model.TasksCRUD()
+        task_id = crud.create('test', '{}', 'elsewhere:1')
+        logs = tasks.TaskLog(task_id, flush_lines=3, flush_interval=60)
+        logs.append('one')
+        logs.extend(['two'])
+        self.assertEqual((u'', 0), crud.get_output(task_id))
+        logs.append('three')
+        self.assertEqual(u'one\ntwo\nthree\n', crud.get_output(task_id)[0])
+        logs.append('four')
+        logs.flush()
+        self.assertEqual(u'one\ntwo\nthree\nfour\n',
+                         crud.get_output(task_id)[0])
+        # a single write per batch
+        with model.session_scope() as session:
+            self.assertEqual(2, session.query(model.TaskOutput).filter_by(
+                task_id=task_id).count())
+        logs.flush_interval = 0
+        logs.append('five')
+        self.assertEqual(u'five\n', crud.get_output(task_id, 19)[0])
+        self.assertEqual(['one', 'two', 'three', 'four', 'five'], logs)
+
+    def test_output_chunks(self):
+        crud = model.TasksCRUD()
+        task_id = crud.create('test', '{}', 'elsewhere:1')
+        self.assertEqual((u'', 0), crud.get_output(task_id))
+        for line in (u'one\n', u'two\n', u'three\n'):
+            crud.append_output(task_id, line)
+        self.assertEqual((u'one\ntwo\nthree\n', 14), crud.get_output(task_id))
+        # an offset within a chunk
+        self.assertEqual((u'o\nthree\n', 14), crud.get_output(task_id, 6))
+        self.assertEqual((u'three\n', 14), crud.get_output(task_id, 8))
+        self.assertEqual((u'', 14), crud.get_output(task_id, 14))
+        task = self.queue.get(task_id, 4)
+        self.assertEqual(u'two\nthree\n', task['output'])
+        self.assertEqual(14, task['offset'])
@@ -17,9 +17,12 @@
 from unittest import TestCase
 from mock import patch
 from managesf.controllers import utils
+from managesf.services import exceptions
 from managesf.tests import dummy_conf
 
 import json
+import threading
+import time
 
 
 class FakeResponse():
@@ -91,3 +94,71 @@ class TestRemoteUser(TestCase):
             cmd = ['scp'] + self.ru.opt + [src, dest]
             self.ru._scpToRemote('dummy_host1', 'dummy_host2')
             exe_mock.assert_called_once_with(cmd)
+
+
+class TestServicesFanout(TestCase):
+    class FakeService(object):
+        def __init__(self, service_name, delay=0, error=None):
+            self.service_name = service_name
+            self.delay = delay
+            self.error = error
+
+    def call(self, service):
+        time.sleep(service.delay)
+        if service.error:
+            raise service.error
+        return service.service_name.upper()
+
+    def test_map(self):
+        fanout = utils.ServicesFanout(timeout=5)
+        unavailable = exceptions.UnavailableActionError()
+        services = [self.FakeService('gerrit', delay=0.3),
+                    self.FakeService('storyboard', delay=0.3),
+                    self.FakeService('jenkins', error=unavailable),
+                    self.FakeService('nodepool', error=ValueError('ko'))]
+        start = time.time()
+        results = fanout.map(self.call, services)
+        # the services are called concurrently
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual(services, [r[0] for r in results])
+        self.assertEqual(['GERRIT', 'STORYBOARD', None, None],
+                         [r[1] for r in results])
+        errors = utils.fanout_errors(results)
+        self.assertEqual(['nodepool'], errors.keys())
+        self.assertIn('nodepool: ko', str(exceptions.ServicesError(errors)))
+
+    def test_timeout(self):
+        fanout = utils.ServicesFanout(timeout=0.2,
+                                      timeouts={'jenkins': 2})
+        services = [self.FakeService('gerrit'),
+                    self.FakeService('storyboard', delay=1),
+                    self.FakeService('jenkins', delay=0.5)]
+        results = fanout.map(self.call, services)
+        self.assertEqual(['GERRIT', None, 'JENKINS'],
+                         [r[1] for r in results])
+        # the late service is named in the error
+        error = results[1][2]
+        self.assertTrue(isinstance(error, exceptions.ServiceTimeoutError))
+        self.assertIn('[storyboard] no answer after 0.2s', str(error))
+        self.assertEqual(['storyboard'],
+                         utils.fanout_errors(results).keys())
+
+    def test_bounded_pool(self):
+        fanout = utils.ServicesFanout(workers=2, timeout=0.3)
+        services = [self.FakeService('gerrit', delay=1),
+                    self.FakeService('storyboard', delay=1)]
+        results = fanout.map(self.call, services)
+        self.assertEqual(2, len(utils.fanout_errors(results)))
+        # both workers still run the hung calls, no thread is added and
+        # the queued calls time out instead of waiting for them
+        count = threading.active_count()
+        start = time.time()
+        results = fanout.map(self.call, [self.FakeService('jenkins')])
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertIn('[jenkins] no worker free after 0.3s',
+                      str(results[0][2]))
+        self.assertEqual(count, threading.active_count())
+        # the cancelled call is skipped once a worker is free
+        time.sleep(1)
+        results = fanout.map(self.call, [self.FakeService('jenkins')])
+        self.assertEqual('JENKINS', results[0][1])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measures the per-call overhead of managesf.model.session_scope.
+
+Usage: bench_model_session.py [sqlalchemy url] [iterations]
+
+Defaults to a temporary sqlite database and 2000 iterations."""
+
+import os
+import sys
+import tempfile
+import timeit
+
+from managesf import model
+
+
+class conf(object):
+    sqlalchemy = {}
+
+
+def main():
+    tmp = None
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    else:
+        tmp = tempfile.mkstemp()[1]
+        url = 'sqlite:///%s' % tmp
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    conf.sqlalchemy = {'url': url}
+    model.conf = conf
+    model.init_model()
+    crud = model.SFUserCRUD()
+    crud.create(username=u'bench', email='bench@tests.dom',
+                fullname=u'Bench', cauth_id=1)
+
+    def empty_scope():
+        with model.session_scope():
+            pass
+
+    def get_user():
+        crud.get(username=u'bench')
+
+    def nested_gets():
+        with model.session_scope():
+            for i in range(5):
+                crud.get(username=u'bench')
+
+    try:
+        for f in (empty_scope, get_user, nested_gets):
+            t = timeit.timeit(f, number=number)
+            print("%-12s %8.1f us/call" % (f.__name__, t * 1e6 / number))
+    finally:
+        if tmp:
+            os.unlink(tmp)
+
+
+if __name__ == '__main__':
+    main()